@@ -0,0 +1,29 @@
+from dataclasses import dataclass
+
+import tyro
+
+from benchmarks.ppo_runs import run_ppo
+
+
+@dataclass
+class Args:
+    policy: str = "GNN"
+    num_envs: int = 30
+    num_steps: int = 200
+    iterations: int = 5
+    """number of PPO iterations per run, the SPS of the last iteration is reported"""
+    extra_args: tuple[str, ...] = ()
+    """further arguments passed to ppo.py in both runs"""
+
+
+def main():
+    args = tyro.cli(Args)
+    sync_sps = run_ppo(args.policy, args.num_envs, args.num_steps, args.iterations, args.extra_args)
+    async_sps = run_ppo(args.policy, args.num_envs, args.num_steps, args.iterations, ("--async-actor", *args.extra_args))
+    print(f"{'mode':>6} {'SPS':>7}")
+    print(f"{'sync':>6} {sync_sps:>7}")
+    print(f"{'async':>6} {async_sps:>7} ({async_sps / sync_sps:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
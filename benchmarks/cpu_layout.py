@@ -0,0 +1,31 @@
+from dataclasses import dataclass
+
+import tyro
+
+from benchmarks.ppo_runs import run_ppo
+
+
+@dataclass
+class Args:
+    policy: str = "GNN"
+    num_envs: int = 30
+    num_steps: int = 200
+    iterations: int = 5
+    """number of PPO iterations per run, the SPS of the last iteration is reported"""
+    layouts: tuple[str, ...] = ("default", "budget", "pinned")
+    extra_args: tuple[str, ...] = ()
+    """further arguments passed to ppo.py in all runs"""
+
+
+def main():
+    args = tyro.cli(Args)
+    base_sps = None
+    print(f"{'layout':>8} {'SPS':>7}")
+    for layout in args.layouts:
+        sps = run_ppo(args.policy, args.num_envs, args.num_steps, args.iterations, ("--cpu-layout", layout, *args.extra_args))
+        base_sps = base_sps or sps
+        print(f"{layout:>8} {sps:>7} ({sps / base_sps:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+from dataclasses import dataclass
+
+import tyro
+
+from benchmarks.ppo_runs import run_ppo
+
+
+@dataclass
+class Args:
+    policy: str = "GNN"
+    envs_per_rank: int = 8
+    """number of envs of every rank, the total number of envs grows with the ranks (weak scaling)"""
+    num_steps: int = 200
+    iterations: int = 5
+    """number of PPO iterations per run, the SPS of the last iteration is reported"""
+    ranks: tuple[int, ...] = (1, 2, 4, 8)
+    extra_args: tuple[str, ...] = ()
+    """further arguments passed to ppo.py in all runs"""
+
+
+def main():
+    args = tyro.cli(Args)
+    base_sps = None
+    print(f"{'ranks':>5} {'SPS':>7} {'speedup':>7} {'efficiency':>10}")
+    for ranks in args.ranks:
+        launcher = ("torchrun", "--standalone", "--nproc_per_node", str(ranks))
+        sps = run_ppo(args.policy, args.envs_per_rank * ranks, args.num_steps, args.iterations, args.extra_args, launcher)
+        base_sps = base_sps or sps / ranks
+        speedup = sps / base_sps
+        print(f"{ranks:>5} {sps:>7} {speedup:>7.2f} {speedup / ranks:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
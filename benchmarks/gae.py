@@ -0,0 +1,65 @@
+import time
+from dataclasses import dataclass
+
+import torch
+import tyro
+
+from environment.agents.policy.gae import compute_gae
+
+
+@dataclass
+class Args:
+    num_steps: int = 200
+    num_envs: int = 30
+    done_prob: float = 0.05
+    """probability that an observation starts a new episode (deadline 40 by default)"""
+    block_sizes: tuple[int, ...] = (4, 8, 16, 32)
+    repeats: int = 100
+    seed: int = 1
+
+
+def reference_gae(rewards, values, dones, next_value, next_done, gamma, gae_lambda):
+    # the loop from ppo.py before vectorization, also the reference of tests/test_gae.py
+    num_steps = rewards.shape[0]
+    advantages = torch.zeros_like(rewards)
+    lastgaelam = 0
+    for t in reversed(range(num_steps)):
+        if t == num_steps - 1:
+            nextnonterminal = 1.0 - next_done
+            nextvalues = next_value
+        else:
+            nextnonterminal = 1.0 - dones[t + 1]
+            nextvalues = values[t + 1]
+        delta = rewards[t] + gamma * nextvalues * nextnonterminal - values[t]
+        advantages[t] = lastgaelam = delta + gamma * gae_lambda * nextnonterminal * lastgaelam
+    return advantages, advantages + values
+
+
+def time_gae(fn, data, repeats, **kwargs):
+    fn(*data, 1.0, 0.95, **kwargs)  # warmup
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn(*data, 1.0, 0.95, **kwargs)
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def main():
+    args = tyro.cli(Args)
+    torch.manual_seed(args.seed)
+    data = (
+        torch.rand(args.num_steps, args.num_envs),
+        torch.randn(args.num_steps, args.num_envs),
+        (torch.rand(args.num_steps, args.num_envs) < args.done_prob).float(),
+        torch.randn(1, args.num_envs),
+        (torch.rand(args.num_envs) < args.done_prob).float(),
+    )
+
+    reference = time_gae(reference_gae, data, args.repeats)
+    print(f"{'block size':>10} {'reference (ms)':>15} {'vectorized (ms)':>16} {'speedup':>8}")
+    for block_size in args.block_sizes:
+        vectorized = time_gae(compute_gae, data, args.repeats, block_size=block_size)
+        print(f"{block_size:>10} {reference:>15.3f} {vectorized:>16.3f} {reference / vectorized:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+import time
+from dataclasses import dataclass
+
+import torch
+import tyro
+
+from environment.agents.policy.PPO import FusedMultiCategorical, MultiCategorical
+
+
+@dataclass
+class Args:
+    batch_size: int = 200
+    """number of observations per call (a PPO minibatch by default)"""
+    max_values: int = 5
+    num_objectives: tuple[int, ...] = (3, 5, 9, 16, 32)
+    repeats: int = 200
+    seed: int = 1
+
+
+def time_distribution(dist_class, logits, nvec, action, repeats):
+    def run():
+        probs = dist_class(logits, nvec)
+        loss = probs.log_prob(action).sum() + probs.entropy().sum()
+        loss.backward()
+        probs.sample()
+
+    run()  # warmup
+    start = time.perf_counter()
+    for _ in range(repeats):
+        run()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def main():
+    args = tyro.cli(Args)
+    torch.manual_seed(args.seed)
+
+    print(f"{'objectives':>10} {'reference (ms)':>15} {'fused (ms)':>11} {'speedup':>8}")
+    for num_objectives in args.num_objectives:
+        nvec = (2,) + tuple(torch.randint(2, args.max_values + 1, (num_objectives,)).tolist())
+        logits = torch.randn(args.batch_size, sum(nvec), requires_grad=True)
+        action = MultiCategorical(logits.detach(), nvec).sample()
+
+        reference = time_distribution(MultiCategorical, logits, nvec, action, args.repeats)
+        fused = time_distribution(FusedMultiCategorical, logits, nvec, action, args.repeats)
+        print(f"{num_objectives:>10} {reference:>15.3f} {fused:>11.3f} {reference / fused:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
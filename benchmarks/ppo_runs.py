@@ -0,0 +1,22 @@
+import re
+import subprocess
+import sys
+
+
+def run_ppo(policy: str, num_envs: int, num_steps: int, iterations: int, extra_args=(), launcher=(sys.executable,)) -> int:
+    """SPS of the last iteration of a ppo.py run, started with launcher (e.g. torchrun).
+
+    The SPS of a single iteration excludes the start of the run (worker startup, the first
+    rollout) that is in the average ppo.py reports as SPS.
+    """
+    command = [
+        *launcher, "ppo.py",
+        "--policy", policy,
+        "--num-envs", str(num_envs),
+        "--num-steps", str(num_steps),
+        "--total-timesteps", str(iterations * num_envs * num_steps),
+        "--checkpoint-interval", "0",
+        *extra_args,
+    ]
+    output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+    return int(re.findall(r"^iteration SPS: (\d+)$", output, re.MULTILINE)[-1])
@@ -0,0 +1,70 @@
+import time
+from dataclasses import dataclass
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import tyro
+from numpy.random import default_rng
+from tensordict import TensorDict
+
+from environment.agents.policy.PPO import GNN
+from environment.agents.rl_agent import GraphObs
+from environment.deadline import Deadline
+from environment.scenario import Scenario
+
+
+@dataclass
+class Args:
+    batch_sizes: tuple[int, ...] = (1, 30, 200)
+    """1: evaluation, 30: rollout with num_envs=30, 200: PPO minibatch"""
+    scenario_size: int = 1000
+    repeats: int = 50
+    seed: int = 1
+
+
+def observation_batch(batch_size, scenario):
+    agent = GraphObs("RL_GNN", scenario.utility_functions[0], 1)
+    obs = agent.get_observation([], Deadline(rounds=40), 0)
+    batch = {k: torch.from_numpy(np.stack([v] * batch_size)) for k, v in obs.items() if k != "opponent_encoding"}
+    return TensorDict(batch, batch_size=batch_size)
+
+
+def time_policy(agent, batch, repeats, backward):
+    def run():
+        if backward:
+            agent.zero_grad()
+            agent.get_value(batch).sum().backward()
+        else:
+            with torch.no_grad():
+                agent.get_value(batch)
+
+    run()  # warmup
+    start = time.perf_counter()
+    for _ in range(repeats):
+        run()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def main():
+    args = tyro.cli(Args)
+    torch.manual_seed(args.seed)
+    scenario = Scenario.create_random(args.scenario_size, default_rng(args.seed))
+    policy_args = dict(hidden_size=256, heads=4, gnn_layers=4, out_layers=1, gat_v2=False, add_self_loops=True)
+    pyg = GNN(None, SimpleNamespace(star_tree_gat=False, **policy_args))
+    star_tree = GNN(None, SimpleNamespace(star_tree_gat=True, **policy_args))
+    star_tree.load_state_dict(pyg.state_dict())
+
+    print(f"objectives: {len(scenario.objectives)}, values: {sum(len(v) for v in scenario.objectives.values())}")
+    print(f"{'batch':>6} {'mode':>9} {'pyg (ms)':>9} {'star tree (ms)':>15} {'speedup':>8}")
+    for batch_size in args.batch_sizes:
+        batch = observation_batch(batch_size, scenario)
+        for backward in (False, True):
+            reference = time_policy(pyg, batch, args.repeats, backward)
+            specialised = time_policy(star_tree, batch, args.repeats, backward)
+            mode = "train" if backward else "inference"
+            print(f"{batch_size:>6} {mode:>9} {reference:>9.2f} {specialised:>15.2f} {reference / specialised:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
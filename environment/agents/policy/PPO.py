@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 import numpy as np
 import torch
 import torch.nn.functional as F
@@ -6,9 +8,11 @@ from torch import Tensor, nn
 from torch.distributions import Categorical
 from torch.distributions.distribution import Distribution
 from torch.distributions.kl import kl_divergence
-from torch_geometric.data import Batch, Data
+from torch.profiler import record_function
 from torch_geometric.nn import GAT
 
+from environment.agents.policy.star_tree_gat import StarTreeGAT
+
 
 def layer_init(layer, std=np.sqrt(2), bias_const=0.0):
     torch.nn.init.orthogonal_(layer.weight, std)
@@ -17,6 +21,9 @@ def layer_init(layer, std=np.sqrt(2), bias_const=0.0):
 
 
 class GNN(nn.Module):
+    # actions are the mode of the distribution when not training
+    greedy_evaluation = True
+
     def __init__(self, envs, args):
         super().__init__()
 
@@ -26,7 +33,10 @@ class GNN(nn.Module):
         self.objective_encoder = layer_init(nn.Linear(2, hidden_size))
         self.value_encoder = layer_init(nn.Linear(5, hidden_size))
 
-        self.gnn_layers = GAT(hidden_size, hidden_size, args.gnn_layers, hidden_size, v2=args.gat_v2, heads=args.heads, add_self_loops=args.add_self_loops)
+        if args.star_tree_gat and not args.gat_v2:
+            self.gnn_layers = StarTreeGAT(hidden_size, hidden_size, args.gnn_layers, hidden_size, heads=args.heads, add_self_loops=args.add_self_loops)
+        else:
+            self.gnn_layers = GAT(hidden_size, hidden_size, args.gnn_layers, hidden_size, v2=args.gat_v2, heads=args.heads, add_self_loops=args.add_self_loops)
 
         if args.out_layers == 1:
             self.accept_head = layer_init(nn.Linear(hidden_size, 2), std=0.01)
@@ -59,23 +69,52 @@ class GNN(nn.Module):
     def action_nvec(self, value):
         self._action_nvec = value
 
+    @staticmethod
+    def batch_edge_index(edge_indices: Tensor, num_nodes: int) -> Tensor:
+        """Edge index of the disjoint union of equally sized graphs, as torch_geometric.data.Batch builds it."""
+        offsets = torch.arange(edge_indices.shape[0], device=edge_indices.device) * num_nodes
+        return (edge_indices + offsets.view(-1, 1, 1)).transpose(0, 1).reshape(2, -1)
+
+    def collate(self, batch):
+        """Add the graph structure that forward_graph otherwise derives from the edge indices on every call.
+
+        For a batch that is indexed many times, like a rollout in the PPO update.
+        """
+        if isinstance(self.gnn_layers, StarTreeGAT):
+            with record_function("GNN.collate"):
+                batch["value_objective"] = StarTreeGAT.value_objective_index(
+                    batch["edge_indices"], batch["objective_nodes"].shape[1], batch["value_nodes"].shape[1]
+                )
+        return batch
+
     def forward_graph(self, batch):
         head_node: Tensor = batch["head_node"]
         objective_nodes: Tensor = batch["objective_nodes"]
         value_nodes: Tensor = batch["value_nodes"]
         edge_indices: Tensor = batch["edge_indices"]
 
-        h_head_node = F.relu(self.head_encoder(head_node))
-        h_objective_nodes = F.relu(self.objective_encoder(objective_nodes))
-        h_value_nodes = F.relu(self.value_encoder(value_nodes))
-
-        h_nodes = torch.cat((h_head_node.unsqueeze(1), h_objective_nodes, h_value_nodes), dim=1)
-
-
-        graph_batch = Batch.from_data_list([Data(h, e).to("cuda:0" if torch.cuda.is_available() else "cpu") for h, e in zip(h_nodes, edge_indices)])
-        h_nodes_out = F.relu(self.gnn_layers(graph_batch.x, graph_batch.edge_index)).reshape_as(h_nodes)
-        h_value_nodes_out = h_nodes_out[:, -value_nodes.shape[1]:, :]
-        h_head_node_out = h_nodes_out[:, 0, :]
+        with record_function("GNN.encoders"):
+            h_head_node = F.relu(self.head_encoder(head_node))
+            h_objective_nodes = F.relu(self.objective_encoder(objective_nodes))
+            h_value_nodes = F.relu(self.value_encoder(value_nodes))
+
+        if isinstance(self.gnn_layers, StarTreeGAT):
+            with record_function("GNN.graph_batching"):
+                if "value_objective" in batch.keys():
+                    value_objective = batch["value_objective"]
+                else:
+                    value_objective = StarTreeGAT.value_objective_index(edge_indices, objective_nodes.shape[1], value_nodes.shape[1])
+            with record_function("GNN.gnn_layers"):
+                h_head_node_out, _, h_value_nodes_out = self.gnn_layers((h_head_node.unsqueeze(1), h_objective_nodes, h_value_nodes), value_objective)
+                h_head_node_out, h_value_nodes_out = F.relu(h_head_node_out[:, 0, :]), F.relu(h_value_nodes_out)
+        else:
+            with record_function("GNN.graph_batching"):
+                h_nodes = torch.cat((h_head_node.unsqueeze(1), h_objective_nodes, h_value_nodes), dim=1)
+                edge_index = self.batch_edge_index(edge_indices, h_nodes.shape[1])
+            with record_function("GNN.gnn_layers"):
+                h_nodes_out = F.relu(self.gnn_layers(h_nodes.reshape(-1, h_nodes.shape[-1]), edge_index)).reshape_as(h_nodes)
+                h_value_nodes_out = h_nodes_out[:, -value_nodes.shape[1]:, :]
+                h_head_node_out = h_nodes_out[:, 0, :]
 
         return h_head_node_out, h_value_nodes_out
 
@@ -84,22 +123,28 @@ class GNN(nn.Module):
         vf_out = self.vf(h_head_node_out)
         return vf_out
     
-    def get_action_and_value(self, batch, action=None) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
-        h_head_node_out, h_value_nodes_out = self.forward_graph(batch)
-        accept_mask: Tensor = batch["accept_mask"]
+    def action_logits(self, h_head_node_out, h_value_nodes_out, accept_mask) -> torch.Tensor:
+        with record_function("GNN.action_logits"):
+            offer_action_logits = self.offer_head(h_value_nodes_out).squeeze(-1)
 
-        offer_action_logits = self.offer_head(h_value_nodes_out).squeeze(-1)
+            accept_inf_mask = torch.log(accept_mask.to(h_head_node_out.dtype)).clamp(min=torch.finfo(torch.float32).min)
+            accept_action_logits = self.accept_head(h_head_node_out) + accept_inf_mask
 
-        accept_inf_mask = torch.max(torch.log(accept_mask), torch.Tensor([torch.finfo(torch.float32).min]).to("cuda:0" if torch.cuda.is_available() else "cpu"))
-        accept_action_logits = self.accept_head(h_head_node_out) + accept_inf_mask
+            # gather action logits
+            return torch.cat((accept_action_logits, offer_action_logits), dim=-1)
+
+    def get_action_logits(self, batch) -> torch.Tensor:
+        h_head_node_out, h_value_nodes_out = self.forward_graph(batch)
+        return self.action_logits(h_head_node_out, h_value_nodes_out, batch["accept_mask"])
+
+    def get_action_and_value(self, batch, action=None) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        h_head_node_out, h_value_nodes_out = self.forward_graph(batch)
+        action_logits = self.action_logits(h_head_node_out, h_value_nodes_out, batch["accept_mask"])
 
         # head node to value function
         vf_out = self.vf(h_head_node_out)
 
-        # gather action logits
-        action_logits = torch.cat((accept_action_logits, offer_action_logits), dim=-1)
-
-        probs = MultiCategorical(action_logits, self.action_nvec)
+        probs = FusedMultiCategorical(action_logits, self.action_nvec)
 
         if action is None and self.training:
             action = probs.sample()
@@ -109,6 +154,9 @@ class GNN(nn.Module):
 
 
 class HigaEtAl(nn.Module):
+    # actions are always sampled, also when not training
+    greedy_evaluation = False
+
     def __init__(self, envs, args):
         super().__init__()
         self.action_nvec = tuple(envs.single_action_space.nvec)
@@ -135,6 +183,10 @@ class HigaEtAl(nn.Module):
             nn.Linear(64, sum(self.action_nvec))
         )
 
+    def collate(self, batch):
+        # flat observations, there is nothing to precompute
+        return batch
+
     def get_value(self, batch):
         self_bid: Tensor = batch["self_bid"]
         opponent_bid: Tensor = batch["opponent_bid"]
@@ -145,6 +197,14 @@ class HigaEtAl(nn.Module):
         vf_out = self.vf(H)
 
         return vf_out
+
+    def get_action_logits(self, batch) -> torch.Tensor:
+        self_bid: Tensor = batch["self_bid"]
+        opponent_bid: Tensor = batch["opponent_bid"]
+        time: Tensor = batch["time"]
+        X = torch.cat((self_bid, opponent_bid, time), dim=-1)
+
+        return self.pi(self.encoder(X))
     
     def get_action_and_value(self, batch, action=None) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
         self_bid: Tensor = batch["self_bid"]
@@ -158,7 +218,7 @@ class HigaEtAl(nn.Module):
         # gather action logits
         action_logits = self.pi(H)
 
-        probs = MultiCategorical(action_logits, self.action_nvec)
+        probs = FusedMultiCategorical(action_logits, self.action_nvec)
 
         if action is None:
             action = probs.sample()
@@ -195,4 +255,121 @@ class MultiCategorical(Distribution):
             [kl_divergence(cat, oth_cat) for cat, oth_cat in zip(self.cats, other.cats)],
             dim=-1,
         )
-        return torch.sum(kls, dim=-1)
\ No newline at end of file
+        return torch.sum(kls, dim=-1)
+
+def select_action(action_logits: Tensor, nvec: Tensor, greedy: bool) -> Tensor:
+    """Greedy or sampled action from flat MultiDiscrete logits without building a distribution.
+
+    The action space is passed as a tensor, so that traced modules can be reused across
+    scenarios with a different number of objectives and values.
+    """
+    num_logits = action_logits.shape[-1]
+    segment = torch.repeat_interleave(torch.arange(nvec.shape[0], device=nvec.device), nvec)
+    position = torch.arange(num_logits, device=nvec.device) - (torch.cumsum(nvec, 0) - nvec)[segment]
+
+    scores = action_logits
+    if not greedy:
+        # Gumbel-max trick
+        scores = scores - torch.empty_like(scores).exponential_().clamp_(min=torch.finfo(scores.dtype).tiny).log()
+
+    segment = segment.expand_as(scores)
+    segment_max = scores.new_full(scores.shape[:-1] + nvec.shape, float("-inf"))
+    segment_max = segment_max.scatter_reduce(-1, segment, scores, reduce="amax")
+    # lowest position that reaches the maximum, like argmax
+    candidates = torch.where(scores == segment_max.gather(-1, segment), position, num_logits)
+    action = torch.full_like(segment_max, num_logits, dtype=torch.int64)
+    return action.scatter_reduce(-1, segment, candidates, reduce="amin")
+
+
+class InferencePolicy(nn.Module):
+    """Inference only wrapper around GNN or HigaEtAl that only returns actions.
+
+    It skips the value head, entropy and distribution objects of get_action_and_value and
+    is meant to be exported with export_inference_policy.
+    """
+    def __init__(self, agent: nn.Module, greedy: bool | None = None):
+        super().__init__()
+        self.agent = agent
+        self.greedy = agent.greedy_evaluation if greedy is None else greedy
+
+    def forward(self, batch: dict[str, Tensor], nvec: Tensor) -> Tensor:
+        return select_action(self.agent.get_action_logits(batch), nvec, self.greedy)
+
+
+def export_inference_policy(agent: nn.Module, example_batch, greedy: bool | None = None) -> torch.jit.ScriptModule:
+    """Trace an InferencePolicy to TorchScript.
+
+    The exported module takes a dict of batched observation tensors and the action space
+    nvec as tensor, and supports any batch size and scenario size. Only the star tree GAT
+    can be traced for GNN, as torch_geometric batching depends on the batch size.
+    """
+    if isinstance(agent, GNN) and not isinstance(agent.gnn_layers, StarTreeGAT):
+        raise ValueError("Exporting a GNN policy requires the star tree GAT layers")
+
+    policy = InferencePolicy(agent, greedy).eval()
+    example_batch = {k: v for k, v in example_batch.items()}
+    nvec = torch.tensor(agent.action_nvec, device=next(agent.parameters()).device)
+    with torch.no_grad():
+        exported = torch.jit.trace(policy, (example_batch, nvec), check_trace=False, strict=False)
+    return torch.jit.freeze(exported)
+
+
+@lru_cache(maxsize=None)
+def _padding_index(nvec: tuple[int, ...], device: torch.device) -> tuple[Tensor, Tensor]:
+    # position of every flat logit in the (num_objectives, max_values) padded layout
+    max_values = max(nvec)
+    index = torch.cat([torch.arange(n) + i * max_values for i, n in enumerate(nvec)]).to(device)
+    mask = torch.zeros(len(nvec) * max_values, dtype=torch.bool)
+    mask[index] = True
+    return index, mask.view(len(nvec), max_values).to(device)
+
+
+class FusedMultiCategorical(Distribution):
+    """Drop-in replacement for MultiCategorical that handles all objectives at once.
+
+    The flat logits are scattered into a single (num_objectives, max_values) tensor that is
+    padded with the smallest finite float, so that a single log_softmax normalises every
+    objective and padded entries get zero probability.
+    """
+    arg_constraints = {}
+
+    def __init__(self, multi_logits, nvec, validate_args=None):
+        with record_function("FusedMultiCategorical.normalize"):
+            nvec = tuple(int(n) for n in nvec)
+            index, self.mask = _padding_index(nvec, multi_logits.device)
+            batch_shape = multi_logits.size()[:-1]
+            min_real = torch.finfo(multi_logits.dtype).min
+
+            padded = multi_logits.new_full(batch_shape + (self.mask.numel(),), min_real)
+            padded = padded.index_copy(-1, index, multi_logits)
+            self.logits = torch.log_softmax(padded.view(batch_shape + self.mask.shape), dim=-1)
+            self.probs = self.logits.exp()
+        super().__init__(batch_shape, validate_args=validate_args)
+
+    def sample(self) -> Tensor:
+        # Gumbel-max trick, padded entries are excluded explicitly
+        with record_function("FusedMultiCategorical.sample"), torch.no_grad():
+            exponentials = torch.empty_like(self.logits).exponential_().clamp_(min=torch.finfo(self.logits.dtype).tiny)
+            gumbels = -exponentials.log()
+            scores = (self.logits + gumbels).masked_fill(~self.mask, float("-inf"))
+            return scores.argmax(dim=-1)
+
+    def mode(self) -> Tensor:
+        return self.probs.argmax(dim=-1)
+
+    def log_prob(self, value: Tensor) -> Tensor:
+        with record_function("FusedMultiCategorical.log_prob"):
+            logps = self.logits.gather(-1, value.long().unsqueeze(-1)).squeeze(-1)
+            return logps.sum(dim=-1)
+
+    def entropy(self) -> Tensor:
+        with record_function("FusedMultiCategorical.entropy"):
+            min_real = torch.finfo(self.logits.dtype).min
+            logits = torch.clamp(self.logits, min=min_real)
+            return -(logits * self.probs).sum(dim=(-2, -1))
+
+    def kl(self, other):
+        t = self.probs * (self.logits - other.logits)
+        t = t.masked_fill(other.probs == 0, float("inf"))
+        t = t.masked_fill(self.probs == 0, 0)
+        return t.sum(dim=(-2, -1))
@@ -0,0 +1,52 @@
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+
+
+def compute_gae(rewards: Tensor, values: Tensor, dones: Tensor, next_value: Tensor, next_done: Tensor,
+                gamma: float, gae_lambda: float, block_size: int = 8) -> tuple[Tensor, Tensor]:
+    """Generalized advantage estimation over a (num_steps, num_envs) rollout.
+
+    Same semantics as the CleanRL loop: dones[t] marks that the observation at step t
+    starts a new episode, so the value of step t + 1 is not bootstrapped into step t.
+    next_value and next_done belong to the observation after the last step.
+
+    The recursion A_t = delta_t + gamma * lambda * nonterminal_t * A_{t+1} is split in
+    blocks of block_size steps. Within a block every advantage is a discounted sum of the
+    deltas up to the first episode boundary, plus the discounted advantage at the start
+    of the next block. All blocks are solved at once with (steps x steps) weight matrices,
+    only carrying the advantage over the blocks is sequential.
+
+    Returns:
+        tuple[Tensor, Tensor]: advantages and returns, both (num_steps, num_envs)
+    """
+    num_steps, num_envs = rewards.shape
+    next_nonterminal = 1.0 - torch.cat((dones[1:], next_done.view(1, -1)))
+    next_values = torch.cat((values[1:], next_value.view(1, -1)))
+    deltas = rewards + gamma * next_values * next_nonterminal - values
+
+    # pad to whole blocks, the padded steps have no reward and do not end an episode
+    num_blocks = -(-num_steps // block_size)
+    padding = (0, 0, 0, num_blocks * block_size - num_steps)
+    deltas = F.pad(deltas, padding).view(num_blocks, block_size, num_envs)
+    episode_ends = F.pad(1.0 - next_nonterminal, padding).view(num_blocks, block_size, num_envs)
+
+    # number of episode boundaries before every step of a block (and after its last step)
+    boundaries = F.pad(torch.cumsum(episode_ends, 1), (0, 0, 1, 0))
+    same_episode = boundaries[:, :-1].unsqueeze(2) == boundaries.unsqueeze(1)
+
+    # weight of delta_k in advantage t of the same block, k = block_size is the next block
+    steps = torch.arange(block_size + 1, device=deltas.device)
+    exponent = steps.unsqueeze(0) - steps[:-1].unsqueeze(1)
+    discount = torch.where(exponent >= 0, (gamma * gae_lambda) ** exponent.clamp(min=0).to(deltas.dtype), 0.0)
+    weights = discount.unsqueeze(-1) * same_episode
+
+    advantages = torch.einsum("btkn,bkn->btn", weights[:, :, :-1], deltas)
+    carry_weights = weights[:, :, -1]
+    carry = torch.zeros_like(deltas[0, 0])
+    for block in reversed(range(num_blocks)):
+        advantages[block] += carry_weights[block] * carry
+        carry = advantages[block, 0]
+
+    advantages = advantages.reshape(-1, num_envs)[:num_steps]
+    return advantages, advantages + values
@@ -0,0 +1,76 @@
+from pathlib import Path
+
+import onnx
+import torch
+from torch import Tensor, nn
+
+from environment.agents.policy.PPO import GNN, HigaEtAl
+from environment.agents.policy.star_tree_gat import StarTreeGAT
+
+# ScatterElements with max reduction is exported since opset 16, opset 18 is not yet
+# exported correctly by torch 2.2 (ReduceMax axes attribute)
+OPSET_VERSION = 17
+
+# observation inputs of the exported models and their dynamic axes
+INPUTS = {
+    GNN: {
+        "head_node": {0: "batch"},
+        "objective_nodes": {0: "batch", 1: "objectives"},
+        "value_nodes": {0: "batch", 1: "values"},
+        "edge_indices": {0: "batch", 2: "edges"},
+        "accept_mask": {0: "batch"},
+    },
+    HigaEtAl: {
+        "self_bid": {0: "batch"},
+        "opponent_bid": {0: "batch"},
+        "time": {0: "batch"},
+    },
+}
+
+
+class ActionLogits(nn.Module):
+    """Wraps get_action_logits of a policy with the observation as positional inputs."""
+    def __init__(self, agent: nn.Module, input_names: list[str]):
+        super().__init__()
+        self.agent = agent
+        self.input_names = input_names
+
+    def forward(self, *inputs: Tensor) -> Tensor:
+        return self.agent.get_action_logits(dict(zip(self.input_names, inputs)))
+
+
+def export_onnx(agent: nn.Module, example_batch, path, greedy: bool | None = None) -> Path:
+    """Export the action logits of a GNN or HigaEtAl policy to ONNX.
+
+    The batch size and, for GNN, the number of objectives, values and edges are dynamic
+    axes, so the model can be used for any scenario. Action selection is done outside of
+    the model by environment.agents.policy.onnx_runtime.OnnxPolicy, whether it is greedy
+    is stored in the model metadata. Only the star tree GAT can be exported for GNN.
+    """
+    if isinstance(agent, GNN) and not isinstance(agent.gnn_layers, StarTreeGAT):
+        raise ValueError("Exporting a GNN policy requires the star tree GAT layers")
+
+    inputs = INPUTS[type(agent)]
+    greedy = agent.greedy_evaluation if greedy is None else greedy
+    training = agent.training
+    module = ActionLogits(agent.to("cpu"), list(inputs)).eval()
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    example_inputs = tuple(torch.as_tensor(example_batch[k]).cpu() for k in inputs)
+    with torch.no_grad():
+        torch.onnx.export(
+            module,
+            example_inputs,
+            str(path),
+            input_names=list(inputs),
+            output_names=["action_logits"],
+            dynamic_axes={**inputs, "action_logits": {0: "batch", 1: "logits"}},
+            opset_version=OPSET_VERSION,
+        )
+    agent.train(training)
+
+    model = onnx.load(str(path))
+    onnx.helper.set_model_props(model, {"policy": type(agent).__name__, "greedy": str(int(greedy))})
+    onnx.save(model, str(path))
+    return path
@@ -0,0 +1,37 @@
+# Only depends on numpy and onnxruntime, so that policies can run in worker processes
+# that do not import torch or torch_geometric.
+import numpy as np
+import onnxruntime as ort
+
+
+def select_action(action_logits: np.ndarray, nvec, greedy: bool, rng: np.random.Generator | None = None) -> np.ndarray:
+    """Greedy or sampled (Gumbel-max) action from flat MultiDiscrete logits, see PPO.select_action."""
+    scores = action_logits
+    if not greedy:
+        rng = np.random.default_rng() if rng is None else rng
+        scores = scores + rng.gumbel(size=scores.shape).astype(scores.dtype)
+    segments = np.split(scores, np.cumsum(nvec)[:-1], axis=-1)
+    return np.stack([segment.argmax(-1) for segment in segments], axis=-1)
+
+
+class OnnxPolicy:
+    """Action selection with a policy exported by onnx_export.export_onnx, on CPU."""
+    def __init__(self, model_path, seed: int | None = None, num_threads: int = 1):
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = 1
+        # shape inference of the exported scatter reductions is incomplete and only warns
+        options.log_severity_level = 3
+        self.session = ort.InferenceSession(str(model_path), options, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.policy = metadata["policy"]
+        self.greedy = bool(int(metadata["greedy"]))
+        self.rng = np.random.default_rng(seed)
+
+    def action_logits(self, batch: dict[str, np.ndarray]) -> np.ndarray:
+        return self.session.run(None, {k: np.asarray(batch[k]) for k in self.input_names})[0]
+
+    def __call__(self, batch: dict[str, np.ndarray], nvec) -> np.ndarray:
+        return select_action(self.action_logits(batch), nvec, self.greedy, self.rng)
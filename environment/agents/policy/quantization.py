@@ -0,0 +1,72 @@
+import importlib
+import pickle
+from types import ModuleType, SimpleNamespace
+
+import torch
+from torch import nn
+from torch.ao.quantization import per_channel_dynamic_qconfig, quantize_dynamic
+
+# Linear layers with fewer inputs are kept in float. For the GNN node encoders (2 to 5
+# input features) quantizing the activations dominates the error, while they are cheap.
+MIN_QUANTIZED_IN_FEATURES = 8
+
+
+def quantize_policy(agent: nn.Module) -> nn.Module:
+    """Dynamic int8 quantization of a GNN or HigaEtAl policy for CPU inference.
+
+    nn.Linear layers are quantized with per channel weights: the output heads, the
+    HigaEtAl encoder and, for the star tree GAT, the attention projections. The
+    torch_geometric GAT layers are left in float. The returned policy is a copy and only
+    runs on CPU.
+    """
+    qconfig_spec = {
+        name: per_channel_dynamic_qconfig
+        for name, module in agent.named_modules()
+        if isinstance(module, nn.Linear) and module.in_features >= MIN_QUANTIZED_IN_FEATURES
+    }
+    agent = quantize_dynamic(agent.to("cpu"), qconfig_spec, dtype=torch.qint8, inplace=False)
+    agent.train(False)
+    return agent
+
+
+def is_quantized_state_dict(state_dict: dict) -> bool:
+    return any(key.endswith("_packed_params") for key in state_dict)
+
+
+def is_quantized_policy(agent: nn.Module) -> bool:
+    return any(isinstance(module, torch.ao.nn.quantized.dynamic.Linear) for module in agent.modules())
+
+
+class _QSchemePickler(pickle.Pickler):
+    # Quantized state dicts contain torch.qscheme objects, which pickle looks up by
+    # searching sys.modules. That fails once supersuit is imported, its module
+    # __getattr__ raises ImportError instead of AttributeError.
+    def reducer_override(self, obj):
+        if isinstance(obj, torch.qscheme):
+            return getattr, (torch, str(obj).removeprefix("torch."))
+        if isinstance(obj, ModuleType):
+            return importlib.import_module, (obj.__name__,)
+        return NotImplemented
+
+
+_qscheme_pickle = SimpleNamespace(Pickler=_QSchemePickler, Unpickler=pickle.Unpickler, __name__="pickle")
+
+
+def save_policy(agent: nn.Module, model_path):
+    """torch.save the state dict of a float or quantized policy, loadable with load_policy."""
+    torch.save(agent.state_dict(), model_path, pickle_module=_qscheme_pickle)
+
+
+def load_policy(agent: nn.Module, model_path, device="cpu") -> nn.Module:
+    """Load a float or quantized checkpoint into a freshly created policy.
+
+    Quantized checkpoints (saved from the output of quantize_policy) are detected from
+    their state dict and always loaded on CPU.
+    """
+    state_dict = torch.load(model_path, map_location="cpu")
+    if is_quantized_state_dict(state_dict):
+        agent = quantize_policy(agent)
+    else:
+        agent = agent.to(device)
+    agent.load_state_dict(state_dict)
+    return agent
@@ -0,0 +1,169 @@
+import torch
+import torch.nn.functional as F
+from torch import Tensor, nn
+
+
+def _softmax(logits: Tensor, dim: int) -> Tensor:
+    # same formulation as torch_geometric.utils.softmax
+    logits = (logits - logits.detach().amax(dim=dim, keepdim=True)).exp()
+    return logits / (logits.sum(dim=dim, keepdim=True) + 1e-16)
+
+
+class StarTreeGATConv(nn.Module):
+    """GATConv specialised to the three level tree of GraphObs.
+
+    Node 0 is the head node, followed by the objective nodes and the value nodes. Every
+    edge in the tree is bidirectional. Instead of gathering per edge, the attention of
+    the head node is a dense softmax over the objectives, every value node attends only
+    to its objective and the objective nodes use a segment softmax over their values.
+    Aggregation is done with small dense (objectives x values) attention matrices.
+    The three node types are passed as separate tensors.
+    Parameters are named identically to torch_geometric.nn.GATConv so that state dicts
+    are interchangeable.
+    """
+    def __init__(self, in_channels: int, out_channels: int, heads: int = 1, concat: bool = True,
+                 negative_slope: float = 0.2, add_self_loops: bool = True):
+        super().__init__()
+        self.in_channels = in_channels
+        self.out_channels = out_channels
+        self.heads = heads
+        self.concat = concat
+        self.negative_slope = negative_slope
+        self.add_self_loops = add_self_loops
+
+        self.lin_src = nn.Linear(in_channels, heads * out_channels, bias=False)
+        self.lin_dst = self.lin_src
+        self.att_src = nn.Parameter(torch.empty(1, heads, out_channels))
+        self.att_dst = nn.Parameter(torch.empty(1, heads, out_channels))
+        self.bias = nn.Parameter(torch.empty(heads * out_channels if concat else out_channels))
+
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        nn.init.xavier_uniform_(self.lin_src.weight)
+        nn.init.xavier_uniform_(self.att_src)
+        nn.init.xavier_uniform_(self.att_dst)
+        nn.init.zeros_(self.bias)
+
+    def forward(self, x: tuple[Tensor, Tensor, Tensor], value_objective: Tensor) -> tuple[Tensor, Tensor, Tensor]:
+        """
+        Args:
+            x (tuple[Tensor, Tensor, Tensor]): features of the head node (batch, 1, in_channels),
+                objective nodes (batch, objectives, in_channels) and value nodes (batch, values, in_channels)
+            value_objective (Tensor): objective index of every value node (batch, values)
+
+        Returns:
+            tuple[Tensor, Tensor, Tensor]: updated head, objective and value node features
+        """
+        H, C = self.heads, self.out_channels
+
+        # (batch, heads, nodes, channels) so that aggregation can be done with batched matmuls.
+        # The node types are kept in separate tensors, slicing a joint tensor is expensive in backward.
+        x_head, x_obj, x_val = [self.lin_src(h).view(h.shape[0], h.shape[1], H, C).transpose(1, 2).contiguous() for h in x]
+
+        att = torch.stack((self.att_src, self.att_dst), dim=2).view(H, 2, C)
+        if isinstance(self.lin_src, nn.Linear):
+            # attention coefficients are folded into the projection: (W x) . att = x . (W^T att)
+            att = torch.bmm(att, self.lin_src.weight.view(H, C, -1)).view(2 * H, -1).T
+            alphas = [(h @ att).transpose(1, 2).view(h.shape[0], H, 2, -1).unbind(2) for h in x]
+        else:
+            # dynamically quantized projection, the weights are not available in float
+            alphas = [(h @ att.transpose(1, 2)).unbind(-1) for h in (x_head, x_obj, x_val)]
+        (src_head, dst_head), (src_obj, dst_obj), (src_val, dst_val) = alphas
+
+        B, K, V = x_obj.shape[0], x_obj.shape[2], x_val.shape[2]
+        index = value_objective.unsqueeze(1).expand(-1, H, -1)
+
+        def attention(a_src: Tensor, a_dst: Tensor) -> Tensor:
+            return F.leaky_relu(a_src + a_dst, self.negative_slope)
+
+        # head node: dense softmax over the objectives (and itself)
+        if self.add_self_loops:
+            alpha = _softmax(attention(torch.cat((src_head, src_obj), dim=-1), dst_head), dim=-1)
+            out_head = alpha[..., :1].unsqueeze(-1) * x_head + alpha[..., 1:].unsqueeze(-2) @ x_obj
+        else:
+            alpha = _softmax(attention(src_obj, dst_head), dim=-1)
+            out_head = alpha.unsqueeze(-2) @ x_obj
+
+        # objective nodes: head node, itself and a segment softmax over their values
+        e_head = attention(src_head, dst_obj)
+        e_val = attention(src_val, dst_obj.gather(-1, index))
+        e_max = e_head.detach()
+        if self.add_self_loops:
+            e_self = attention(src_obj, dst_obj)
+            e_max = torch.maximum(e_max, e_self.detach())
+        e_max = e_max.scatter_reduce(-1, index, e_val.detach(), reduce="amax", include_self=True)
+
+        w_head = (e_head - e_max).exp()
+        w_val = (e_val - e_max.gather(-1, index)).exp()
+        w_sum = w_head + torch.zeros_like(w_head).scatter_add(-1, index, w_val)
+        if self.add_self_loops:
+            w_self = (e_self - e_max).exp()
+            w_sum = w_sum + w_self
+        w_sum = w_sum + 1e-16
+
+        alpha_val = w_val / w_sum.gather(-1, index)
+        objective_to_values = alpha_val.new_zeros(B, H, K, V).scatter(-2, index.unsqueeze(-2), alpha_val.unsqueeze(-2))
+        out_obj = objective_to_values @ x_val + (w_head / w_sum).unsqueeze(-1) * x_head
+        if self.add_self_loops:
+            out_obj = out_obj + (w_self / w_sum).unsqueeze(-1) * x_obj
+
+        # value nodes: their objective node (and themselves)
+        e_obj = attention(src_obj.gather(-1, index), dst_val)
+        if self.add_self_loops:
+            alpha = _softmax(torch.stack((e_obj, attention(src_val, dst_val))), dim=0)
+            alpha_obj, alpha_self = alpha[0], alpha[1]
+        else:
+            alpha_obj = _softmax(e_obj.unsqueeze(0), dim=0)[0]
+        value_to_objective = alpha_obj.new_zeros(B, H, V, K).scatter(-1, index.unsqueeze(-1), alpha_obj.unsqueeze(-1))
+        out_val = value_to_objective @ x_obj
+        if self.add_self_loops:
+            out_val = torch.addcmul(out_val, alpha_self.unsqueeze(-1), x_val)
+
+        if self.concat:
+            out = [h.transpose(1, 2).flatten(2) for h in (out_head, out_obj, out_val)]
+        else:
+            out = [h.mean(dim=1) for h in (out_head, out_obj, out_val)]
+
+        return tuple(h + self.bias for h in out)
+
+
+class StarTreeGAT(nn.Module):
+    """Stack of StarTreeGATConv layers mirroring torch_geometric.nn.GAT (v1, no jumping knowledge).
+
+    Loads the same state dict as GAT(in_channels, hidden_channels, num_layers, out_channels, heads=heads).
+    """
+    def __init__(self, in_channels: int, hidden_channels: int, num_layers: int, out_channels: int,
+                 heads: int = 1, add_self_loops: bool = True):
+        super().__init__()
+        if hidden_channels % heads != 0:
+            raise ValueError(f"hidden_channels ({hidden_channels}) must be divisible by heads ({heads})")
+
+        self.convs = nn.ModuleList()
+        for i in range(num_layers):
+            last = i == num_layers - 1
+            self.convs.append(
+                StarTreeGATConv(
+                    in_channels if i == 0 else hidden_channels,
+                    out_channels if last else hidden_channels // heads,
+                    heads=heads,
+                    concat=not last,
+                    add_self_loops=add_self_loops,
+                )
+            )
+
+    @staticmethod
+    def value_objective_index(edge_indices: Tensor, num_objectives: int, num_values: int) -> Tensor:
+        """Recover the objective index of every value node from batched GraphObs edge indices."""
+        src, dst = edge_indices[:, 0], edge_indices[:, 1]
+        objective_to_value = (src > 0) & (src <= num_objectives) & (dst > num_objectives)
+        src = src[objective_to_value].view(-1, num_values) - 1
+        dst = dst[objective_to_value].view(-1, num_values) - num_objectives - 1
+        return torch.empty_like(src).scatter_(1, dst, src)
+
+    def forward(self, x: tuple[Tensor, Tensor, Tensor], value_objective: Tensor) -> tuple[Tensor, Tensor, Tensor]:
+        for i, conv in enumerate(self.convs):
+            x = conv(x, value_objective)
+            if i < len(self.convs) - 1:
+                x = tuple(F.relu(h) for h in x)
+        return x
@@ -0,0 +1,110 @@
+import json
+import os
+import socket
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable
+
+
+@dataclass(frozen=True)
+class TuneConfig:
+    """Parallelism of training: env worker processes, envs per worker and learner torch threads."""
+    num_workers: int
+    envs_per_worker: int
+    torch_threads: int
+
+    @property
+    def num_envs(self) -> int:
+        return self.num_workers * self.envs_per_worker
+
+
+@dataclass
+class Calibration:
+    config: TuneConfig
+    sps: float
+    """estimated env steps per second of a training iteration"""
+    learner_utilization: float
+    """fraction of an iteration the learner computes (inference and update) instead of waiting for the envs"""
+
+
+def powers_of_two(maximum: int) -> tuple[int, ...]:
+    """1, 2, 4, ... up to and including maximum."""
+    values = [1]
+    while values[-1] * 2 < maximum:
+        values.append(values[-1] * 2)
+    return tuple(sorted({*values, max(maximum, 1)}))
+
+
+def staged_search(
+    measure: Callable[[TuneConfig], Calibration],
+    workers: tuple[int, ...] = (),
+    envs_per_worker: tuple[int, ...] = (1, 2, 4),
+    torch_threads: tuple[int, ...] = (),
+    default_threads: int = 1,
+    max_trials: int = 0,
+    cpu_count: int | None = None,
+) -> list[Calibration]:
+    """Calibrations of a two stage search over the configurations, instead of the full grid.
+
+    First every (workers, envs per worker) pair is measured with the thread count closest to
+    default_threads, then the other thread counts with the fastest pair. Empty workers or
+    torch_threads default to powers of two up to the CPU count. With max_trials only the first
+    max_trials configurations are measured.
+    """
+    cpu_count = cpu_count or os.cpu_count() or 1
+    torch_threads = torch_threads or powers_of_two(cpu_count)
+    first_threads = min(torch_threads, key=lambda t: abs(t - default_threads))
+    calibrations = []
+
+    def trial(config: TuneConfig):
+        if not max_trials or len(calibrations) < max_trials:
+            calibrations.append(measure(config))
+
+    for w in workers or powers_of_two(cpu_count):
+        for e in envs_per_worker:
+            trial(TuneConfig(w, e, first_threads))
+    best = max(calibrations, key=lambda c: c.sps).config
+    for t in torch_threads:
+        if t != first_threads:
+            trial(TuneConfig(best.num_workers, best.envs_per_worker, t))
+    return calibrations
+
+
+def iteration_estimate(
+    num_envs: int, steps: int, rollout_seconds: float, inference_seconds: float, update_seconds: float, update_epochs: int,
+) -> tuple[float, float]:
+    """SPS and learner utilization of a training iteration from a calibration rollout of steps steps.
+
+    update_seconds is a single forward/backward pass over the calibration batch, which the
+    training loop does update_epochs times. Both the rollout and the update scale linearly with
+    the number of steps, so the estimate holds for any num_steps.
+    """
+    total = rollout_seconds + update_epochs * update_seconds
+    return num_envs * steps / total, (inference_seconds + update_epochs * update_seconds) / total
+
+
+def cache_key(policy: str, opponent: str, opponent_sets: tuple[str, ...], host: str | None = None) -> str:
+    return f"{host or socket.gethostname()}/{policy}/{opponent}:{'+'.join(sorted(opponent_sets))}"
+
+
+def load_cached(path: str | Path, key: str) -> TuneConfig | None:
+    path = Path(path)
+    if not path.exists():
+        return None
+    entry = json.loads(path.read_text()).get(key)
+    return None if entry is None else TuneConfig(**entry["config"])
+
+
+def save_cached(path: str | Path, key: str, calibration: Calibration):
+    """Store the chosen configuration under key, keeping the entries of other hosts and opponents."""
+    path = Path(path)
+    cache = json.loads(path.read_text()) if path.exists() else {}
+    cache[key] = {
+        "config": asdict(calibration.config),
+        "sps": calibration.sps,
+        "learner_utilization": calibration.learner_utilization,
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    tmp_path.write_text(json.dumps(cache, indent=2))
+    os.replace(tmp_path, path)
@@ -0,0 +1,101 @@
+import copy
+import os
+import random
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import torch
+from numpy.random import Generator
+
+
+def rng_state(scenario_rng: Generator) -> dict:
+    """State of every random number generator used in training."""
+    return {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        "scenario": copy.deepcopy(scenario_rng.bit_generator.state),
+    }
+
+
+def set_rng_state(state: dict, scenario_rng: Generator):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+    scenario_rng.bit_generator.state = state["scenario"]
+
+
+def _detached(state):
+    # tensors are copied, the optimizer and the model keep updating theirs in place
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    elif isinstance(state, dict):
+        return {k: _detached(v) for k, v in state.items()}
+    elif isinstance(state, (list, tuple)):
+        return type(state)(_detached(v) for v in state)
+    return copy.deepcopy(state)
+
+
+class CheckpointManager:
+    """Writes training checkpoints to directory from a background thread.
+
+    The state is copied on the calling thread, so training can continue while the
+    previous checkpoint is written. Checkpoints are written to a temporary file and
+    renamed, so a crash never leaves a partial checkpoint behind, and only the last
+    keep_last checkpoints are kept.
+    """
+    def __init__(self, directory: str | Path, interval: int, keep_last: int = 3):
+        self.directory = Path(directory)
+        self.interval = interval
+        self.keep_last = keep_last
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending: Future | None = None
+
+    def due(self, iteration: int, last: bool = False) -> bool:
+        return self.interval > 0 and (iteration % self.interval == 0 or last)
+
+    def save(self, iteration: int, state: dict) -> Future:
+        """Copy state and write it as the checkpoint of iteration in the background."""
+        state = _detached(state)
+        self.wait()
+        self._pending = self._executor.submit(self._write, iteration, state)
+        return self._pending
+
+    def _write(self, iteration: int, state: dict) -> Path:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f"checkpoint_{iteration:06d}.pt"
+        tmp_path = path.with_suffix(".pt.tmp")
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)
+        for old in self.checkpoints(self.directory)[:-self.keep_last]:
+            old.unlink()
+        return path
+
+    def wait(self):
+        """Block until the checkpoint in progress is written, raising its error if it failed."""
+        if self._pending is not None:
+            self._pending.result()
+            self._pending = None
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
+
+    @staticmethod
+    def checkpoints(directory: str | Path) -> list[Path]:
+        return sorted(Path(directory).glob("checkpoint_*.pt"))
+
+    @classmethod
+    def load(cls, path: str | Path, map_location=None) -> dict:
+        """Load a checkpoint file, or the latest checkpoint in a directory."""
+        path = Path(path)
+        if path.is_dir():
+            checkpoints = cls.checkpoints(path)
+            if not checkpoints:
+                raise FileNotFoundError(f"No checkpoints in {path}")
+            path = checkpoints[-1]
+        return torch.load(path, map_location=map_location)
@@ -0,0 +1,73 @@
+import hashlib
+import json
+from functools import lru_cache
+from pathlib import Path
+
+from environment.scenario import Scenario
+
+
+@lru_cache(maxsize=None)
+def file_hash(path: str | Path) -> str:
+    """SHA-256 of the content of a file, e.g. a model, computed once per path and process."""
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def scenario_hash(scenario: str | Path | Scenario) -> str:
+    """SHA-256 of the objectives and utility functions of a scenario object or directory."""
+    if isinstance(scenario, Scenario):
+        content = {"objectives": scenario.objectives}
+        if scenario.utility_functions:
+            content["utility_functions"] = [
+                {"objective_weights": u.objective_weights, "value_weights": u.value_weights} for u in scenario.utility_functions
+            ]
+        data = json.dumps(content, sort_keys=True, default=str).encode()
+    elif Path(scenario).is_dir():
+        data = b"".join(
+            file.name.encode() + file.read_bytes() for file in sorted(Path(scenario).glob("*.json")) if file.name != "specials.json"
+        )
+    else:
+        # e.g. "random", a new scenario every episode
+        data = str(scenario).encode()
+    return hashlib.sha256(data).hexdigest()
+
+
+class EvaluationCache:
+    """Append-only store of the results of evaluation episodes, a JSON line per episode.
+
+    An episode is identified by the model (content hash), the opponent, the scenario (content
+    hash), the config (environment settings and action backend) and its seed. Results are appended
+    as soon as they are added, so an interrupted evaluation keeps its finished episodes. Single
+    line appends are atomic, so multiple processes can add to the same file.
+    """
+    KEY = ("model", "opponent", "scenario", "config", "seed")
+    # version of how an episode follows from its key (env and opponent seeding), bumped when that
+    # changes, entries of other versions are ignored
+    VERSION = 3
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.results: dict[tuple, dict[str, float]] = {}
+        if self.path.exists():
+            with open(self.path) as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        if record.pop("version", 1) == self.VERSION:
+                            self.results[tuple(record.pop(k) for k in self.KEY)] = record
+
+    @staticmethod
+    def key(model: str, opponent: str, scenario: str, config: dict, seed: int) -> tuple:
+        return model, opponent, scenario, json.dumps(config, sort_keys=True), seed
+
+    def get(self, key: tuple) -> dict[str, float] | None:
+        return self.results.get(key)
+
+    def __contains__(self, key: tuple) -> bool:
+        return key in self.results
+
+    def add(self, key: tuple, metrics: dict[str, float]):
+        self.results[key] = metrics
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"version": self.VERSION, **dict(zip(self.KEY, key)), **metrics}) + "\n")
@@ -0,0 +1,185 @@
+import csv
+import json
+import queue
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+import torch
+from torch.profiler import ProfilerActivity, record_function
+
+
+class PhaseTimer:
+    """Named wall clock timers that accumulate until reset, e.g. over a training iteration.
+
+    With CUDA a phase only measures the kernel launches, unless it ends with a call that
+    synchronizes (like copying the result to the CPU). Phases are also labelled in
+    torch.profiler traces.
+    """
+    def __init__(self):
+        self.totals: dict[str, float] = defaultdict(float)
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            with record_function(name):
+                yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float):
+        self.totals[name] += seconds
+
+    def summary(self, prefix: str = "time/") -> dict[str, float]:
+        """Seconds spent in every phase since the last reset."""
+        return {f"{prefix}{name}": total for name, total in self.totals.items()}
+
+    def reset(self):
+        self.totals = defaultdict(float)
+
+
+class JsonlSink:
+    """Appends every record as a line of JSON."""
+    def __init__(self, path: str | Path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(path, "a")
+
+    def write(self, record: dict[str, float], step: int):
+        self.file.write(json.dumps({"step": step, **record}) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class CsvSink:
+    """Appends every value as a step,metric,value row (long format, metrics can appear at any step)."""
+    def __init__(self, path: str | Path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        new_file = not path.exists()
+        self.file = open(path, "a", newline="")
+        self.writer = csv.writer(self.file)
+        if new_file:
+            self.writer.writerow(["step", "metric", "value"])
+
+    def write(self, record: dict[str, float], step: int):
+        self.writer.writerows((step, key, value) for key, value in record.items())
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class TensorBoardSink:
+    """Writes every value of a record as a scalar, requires tensorboard."""
+    def __init__(self, log_dir: str | Path):
+        from torch.utils.tensorboard import SummaryWriter
+        self.writer = SummaryWriter(str(log_dir))
+
+    def write(self, record: dict[str, float], step: int):
+        for key, value in record.items():
+            self.writer.add_scalar(key, value, step)
+
+    def close(self):
+        self.writer.close()
+
+
+class WandbSink:
+    """Logs records to a wandb run, which is not finished on close."""
+    def __init__(self, run):
+        self.run = run
+
+    def write(self, record: dict[str, float], step: int):
+        self.run.log(record, step=step)
+
+    def close(self):
+        pass
+
+
+LOCAL_SINKS = {
+    "jsonl": lambda directory: JsonlSink(Path(directory, "metrics.jsonl")),
+    "csv": lambda directory: CsvSink(Path(directory, "metrics.csv")),
+    "tensorboard": TensorBoardSink,
+}
+
+
+class MetricsLogger:
+    """Buffers metrics per step and writes them to the sinks from a background thread.
+
+    log() only updates a dict, values may be numbers or scalar tensors, which are converted
+    on the writer thread. flush() hands the buffered steps to the writer, e.g. once per
+    iteration. Errors of the writer are raised on the next flush or close.
+    """
+    def __init__(self, sinks: list):
+        self.sinks = sinks
+        self._buffer: dict[int, dict] = {}
+        self._queue: queue.Queue[dict[int, dict] | None] = queue.Queue()
+        self._error: BaseException | None = None
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def log(self, metrics: dict, step: int):
+        self._buffer.setdefault(step, {}).update(metrics)
+
+    def flush(self):
+        if self._error is not None:
+            raise self._error
+        if self._buffer:
+            self._queue.put(self._buffer)
+            self._buffer = {}
+
+    def _write(self):
+        while (records := self._queue.get()) is not None:
+            try:
+                for step, record in sorted(records.items()):
+                    record = {key: float(value) for key, value in record.items()}
+                    for sink in self.sinks:
+                        sink.write(record, step)
+            except BaseException as e:
+                self._error = e
+
+    def close(self):
+        """Write the remaining metrics and close the sinks."""
+        if self._buffer:
+            self._queue.put(self._buffer)
+            self._buffer = {}
+        self._queue.put(None)
+        self._thread.join()
+        for sink in self.sinks:
+            sink.close()
+        if self._error is not None:
+            raise self._error
+
+
+class _NoProfiler:
+    def start(self):
+        pass
+
+    def step(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+def profiler(enabled: bool, log_dir: str | Path, wait: int, warmup: int, active: int, worker_name: str | None = None):
+    """torch.profiler.profile that records steps wait + warmup to wait + warmup + active once.
+
+    Shapes and memory are recorded and the trace is written to log_dir for the TensorBoard
+    profiler plugin (torch-tb-profiler). Call start() before the first iteration, step() after
+    every iteration and stop() at the end. Returns a no-op with the same interface if not enabled.
+    """
+    if not enabled:
+        return _NoProfiler()
+    activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if torch.cuda.is_available() else [])
+    return torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+        on_trace_ready=torch.profiler.tensorboard_trace_handler(str(log_dir), worker_name=worker_name),
+        record_shapes=True,
+        profile_memory=True,
+    )
@@ -1,4 +1,7 @@
+import random
+import time
 from collections import deque
+from contextlib import contextmanager
 from itertools import cycle
 from pathlib import Path
 
@@ -28,13 +31,35 @@ class NegotiationEnvZoo(ParallelEnv):
         )
         self.render_mode = render_mode
 
-        if env_config["scenario"] == "random":
+        self.env_config = env_config
+        self.used_agents = {a: AGENTS[a] for a in env_config["used_agents"]}
+        # probabilities of the used agents for the "random" and "all" opponents, set by a scheduler
+        self.opponent_weights: np.ndarray | None = None
+        # seeds of the next episodes, every episode then plays on generators of its own seed (evaluation)
+        self.episode_seeds: list[int] = []
+        # opponents of those episodes of a "random" opponent, None samples one
+        self.episode_opponents: list[str | None] = []
+        # states of the global random and np.random of a seeded episode, swapped in while the env runs
+        self._global_rng_state: tuple | None = None
+        self.load_scenario(env_config["scenario"])
+
+    def load_scenario(self, scenario: str | Path | Scenario):
+        """Swap to another scenario, which is used from the next reset on.
+
+        The scenario is "random", a scenario directory or a Scenario object (without utility
+        functions, random ones are sampled on every reset as for directories). The spaces
+        are resized and the environment is reseeded by the next reset, like a new environment.
+        """
+        self.env_config = {**self.env_config, "scenario": scenario}
+        if isinstance(scenario, Scenario):
+            self.scenario = scenario.sample_utility_functions(default_rng(0))
+        elif scenario == "random":
             self.scenario = Scenario.create_random([200, 1000], default_rng(0), 5)
         else:
-            self.scenario = Scenario.from_directory(Path(env_config["scenario"]))
+            self.scenario = Scenario.from_directory(Path(scenario))
 
-        self.env_config = env_config
-        self.used_agents = {a: AGENTS[a] for a in env_config["used_agents"]}
+        if hasattr(self, "np_random"):
+            del self.np_random
 
     def observation_space(self, agent):
         return REQUIRED_RL_AGENT[agent.split("_")[1]].observation_space(self.scenario.utility_functions[0],len(self.used_agents))
@@ -43,18 +68,55 @@ class NegotiationEnvZoo(ParallelEnv):
         return REQUIRED_RL_AGENT[agent.split("_")[1]].action_space(self.scenario.utility_functions[0])
 
     def reset(self, *, seed=None, options=None):
-        if not hasattr(self, "np_random"):
-            self.np_random = default_rng(seed) if seed else default_rng(0)
-
+        episode_opponent = None
+        if self.episode_seeds:
+            seed = self.episode_seeds.pop(0)
+            self.np_random = default_rng(seed)
+            # the opponents draw from the global generators, which get a state of this seed that
+            # only this env uses, so that every model meets the same decisions, also when envs
+            # share a worker
+            self._global_rng_state = random.Random(seed).getstate(), np.random.RandomState(seed).get_state()
+            if self.episode_opponents:
+                episode_opponent = self.episode_opponents.pop(0)
+        else:
+            self._global_rng_state = None
+            if not hasattr(self, "np_random"):
+                self.np_random = default_rng(seed) if seed else default_rng(0)
+
+        with self._global_rng():
+            return self._reset(episode_opponent)
+
+    @contextmanager
+    def _global_rng(self):
+        """Swap the global generators of a seeded episode in, and the previous states back afterwards."""
+        if self._global_rng_state is None:
+            yield
+            return
+        previous = random.getstate(), np.random.get_state()
+        random.setstate(self._global_rng_state[0])
+        np.random.set_state(self._global_rng_state[1])
+        try:
+            yield
+        finally:
+            self._global_rng_state = random.getstate(), np.random.get_state()
+            random.setstate(previous[0])
+            np.random.set_state(previous[1])
+
+    def _reset(self, episode_opponent: str | None):
         self.agents = self.possible_agents
 
-        if self.env_config["scenario"] == "random":
+        if isinstance(self.env_config["scenario"], Scenario):
+            self.scenario = self.env_config["scenario"].sample_utility_functions(self.np_random)
+        elif self.env_config["scenario"] == "random":
             self.scenario = Scenario.create_random([200, 1000], self.np_random, 5)
         else:
             self.scenario = Scenario.from_directory(Path(self.env_config["scenario"]), self.np_random)
 
         self.last_actions = deque(maxlen=2)
         self.opponent_encoding = 0
+        self.opponent = None
+        self.opponent_seconds = 0.0
+        self.episode_steps = 0
 
         if "rounds" in self.env_config["deadline"]:
             self.deadline = Deadline(rounds=self.env_config["deadline"]["rounds"])
@@ -73,17 +135,30 @@ class NegotiationEnvZoo(ParallelEnv):
                 agent_init = agent_class(agent, utility_function, len(self.used_agents))
                 self.observation_spaces[agent] = agent_init.observation_space
                 self.action_spaces[agent] = agent_init.action_space
+            elif agent == "random" and episode_opponent is not None:
+                self.opponent_encoding = self.env_config["used_agents"].index(episode_opponent)
+                self.opponent = episode_opponent
+                agent_init = self.used_agents[episode_opponent](episode_opponent, utility_function, self.deadline)
+            elif agent in ("random", "all") and self.opponent_weights is not None:
+                used_agents_list = list(self.used_agents.items())
+                selected_agent, agent_class = used_agents_list[self.np_random.choice(len(used_agents_list), p=self.opponent_weights)]
+                self.opponent_encoding = self.env_config["used_agents"].index(selected_agent)
+                self.opponent = selected_agent
+                agent_init = agent_class(selected_agent, utility_function, self.deadline)
             elif agent == "random":
                 selected_agent, agent_class = self.np_random.choice(list(self.used_agents.items()))
                 self.opponent_encoding = self.env_config["used_agents"].index(selected_agent)
+                self.opponent = selected_agent
                 agent_init = agent_class(selected_agent, utility_function, self.deadline)
             elif agent == "all":
                 used_agents_list = list(self.used_agents.items())
                 selected_agent, agent_class = used_agents_list[self.worker_id % len(used_agents_list)]
                 self.opponent_encoding = self.env_config["used_agents"].index(selected_agent)
+                self.opponent = selected_agent
                 agent_init = agent_class(selected_agent, utility_function, self.deadline)
             elif agent in self.used_agents:
                 agent_class = self.used_agents[agent]
+                self.opponent = agent
                 agent_init = agent_class(agent, utility_function, self.deadline)
             else:
                 raise ValueError("Agent not recognized")
@@ -99,7 +174,7 @@ class NegotiationEnvZoo(ParallelEnv):
 
         self.agents_iter = cycle(self._agents)
         
-        obs, _, _, _, infos = self.step(None)
+        obs, _, _, _, infos = self._step(None)
 
         return obs, infos
 
@@ -109,6 +184,10 @@ class NegotiationEnvZoo(ParallelEnv):
             self.deadline.advance_round()
 
     def step(self, action_dict):
+        with self._global_rng():
+            return self._step(action_dict)
+
+    def _step(self, action_dict):
         if action_dict:
             if self.current_agent.agent_id not in action_dict:
                 raise ValueError(f"{self.current_agent.agent_id} not in {action_dict}")
@@ -118,6 +197,7 @@ class NegotiationEnvZoo(ParallelEnv):
             else:
                 action["agent_id"] = self.current_agent.agent_id
             self.register_action(action)
+            self.episode_steps += 1
 
         while not self.deadline.reached() and (len(self.last_actions) < 1 or not self.last_actions[-1]["accept"]):
             
@@ -132,7 +212,9 @@ class NegotiationEnvZoo(ParallelEnv):
                     rews = {self.current_agent.agent_id: 0}
                     return obs, rews, {self.current_agent.agent_id: False}, {self.current_agent.agent_id: False}, {}
             elif isinstance(self.current_agent, DefaultParty):
+                start = time.perf_counter()
                 action, timeout = self.current_agent.select_action(self.last_actions)
+                self.opponent_seconds += time.perf_counter() - start
                 if timeout:
                     break
             else:
@@ -160,5 +242,10 @@ class NegotiationEnvZoo(ParallelEnv):
         obs = {agent.agent_id: agent.get_observation(self.last_actions, self.deadline, self.opponent_encoding) for agent in self._agents if isinstance(agent, RLAgent)}
 
         infos = {agent.agent_id: {"utility_all_agents": utility_all_agents, "rounds_played": self.deadline.round, "self_accepted": (self.last_actions[-1]["accept"] and self.last_actions[-1]["agent_id"] == agent.agent_id), "found_agreement": bool(self.last_actions[-1]["accept"])} for agent in self._agents if isinstance(agent, RLAgent)}
+        if self.opponent is not None:
+            # opponent time per step of the RL agent, the cost of the opponent for the env workers
+            for info in infos.values():
+                info["opponent"] = self.opponent
+                info["opponent_seconds"] = self.opponent_seconds / max(self.episode_steps, 1)
 
         return obs, rew, {a: True for a in self.agents}, {a: True for a in self.agents}, infos
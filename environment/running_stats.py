@@ -0,0 +1,32 @@
+from statistics import NormalDist
+
+import numpy as np
+
+
+class RunningStats:
+    """Running mean and variance of a stream of samples (Welford), merged batch by batch."""
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, values: np.ndarray):
+        values = np.asarray(values, dtype=np.float64)
+        if values.size == 0:
+            return
+        count = self.count + values.size
+        delta = values.mean() - self.mean
+        self.m2 += ((values - values.mean()) ** 2).sum() + delta ** 2 * self.count * values.size / count
+        self.mean += delta * values.size / count
+        self.count = count
+
+    @property
+    def variance(self) -> float:
+        return self.m2 / (self.count - 1) if self.count > 1 else float("nan")
+
+    def half_width(self, confidence: float = 0.99) -> float:
+        """Half-width of the normal confidence interval of the mean, inf with fewer than two samples."""
+        if self.count < 2:
+            return float("inf")
+        z = NormalDist().inv_cdf((1 + confidence) / 2)
+        return z * (self.variance / self.count) ** 0.5
@@ -144,11 +144,16 @@ class Scenario:
                     distribution=specials["distribution"],
                     opposition=specials["opposition"],
                 )
-        else:
-            utility_functions = [UtilityFunction.create_random(objectives, np_random) for _ in range(2)]
+            return cls(objectives, utility_functions)
 
+        return cls(objectives).sample_utility_functions(np_random)
 
-        return cls(objectives, utility_functions)
+    def sample_utility_functions(self, np_random: Generator) -> "Scenario":
+        """The scenario itself if it has utility functions, otherwise a copy with random utility functions."""
+        if self.utility_functions:
+            return self
+        utility_functions = [UtilityFunction.create_random(self.objectives, np_random) for _ in range(2)]
+        return Scenario(self.objectives, utility_functions)
 
     def calculate_specials(self):
         if self.nash_outcome:
@@ -0,0 +1,82 @@
+import numpy as np
+
+
+def stratified_weights(order: list[int], num_slots: int) -> np.ndarray:
+    """Opponent probabilities of num_slots env slots that together sample uniformly.
+
+    The uniform distribution over the opponents, sorted by order, is split into num_slots
+    strata of equal mass, slot i samples from stratum i. A worker with a slot of every
+    stratum has the same expected step time as any other, and the mixture of the slots is
+    still uniform.
+    """
+    num_opponents = len(order)
+    opponent_edges = np.arange(num_opponents + 1) / num_opponents
+    slot_edges = np.arange(num_slots + 1) / num_slots
+    overlap = np.clip(
+        np.minimum(slot_edges[1:, None], opponent_edges[None, 1:]) - np.maximum(slot_edges[:-1, None], opponent_edges[None, :-1]),
+        0, None,
+    )
+    weights = np.zeros((num_slots, num_opponents))
+    weights[:, order] = overlap
+    return weights / weights.sum(axis=1, keepdims=True)
+
+
+def balanced_assignment(opponents: list[int], costs: np.ndarray, slot_counts: list[int]) -> list[list[int]]:
+    """Place opponents on workers with slot_counts slots, longest processing time first.
+
+    Every opponent goes to the worker with the lowest total cost that has a free slot.
+    """
+    loads = np.zeros(len(slot_counts))
+    assignment: list[list[int]] = [[] for _ in slot_counts]
+    for opponent in sorted(opponents, key=lambda o: -costs[o]):
+        free = [w for w, count in enumerate(slot_counts) if len(assignment[w]) < count]
+        worker = min(free, key=lambda w: loads[w])
+        assignment[worker].append(opponent)
+        loads[worker] += costs[opponent]
+    return assignment
+
+
+class OpponentScheduler:
+    """Cost-aware opponent probabilities per env that balance the step time of the env workers.
+
+    The cost of an opponent is the moving average of its measured time per env step, reported
+    by the envs at the end of every episode. The distribution over opponents is kept: with
+    "random" the envs of a worker sample from cost strata of the uniform distribution, with
+    "all" every opponent still plays on the same number of envs, but the envs are placed on
+    the workers so that their total costs are balanced. Opponents that were not measured yet
+    get the mean cost.
+    """
+    def __init__(self, opponents: list[str], env_slices: list[slice], mode: str, smoothing: float = 0.1):
+        if mode not in ("random", "all"):
+            raise ValueError(f"Opponents can only be scheduled for random and all, not {mode}")
+        self.opponents = opponents
+        self.env_slices = env_slices
+        self.mode = mode
+        self.smoothing = smoothing
+        self.costs: dict[str, float] = {}
+
+    def update(self, infos: list[dict]):
+        for info in infos:
+            if info and "opponent" in info:
+                opponent, cost = info["opponent"], info["opponent_seconds"]
+                previous = self.costs.get(opponent)
+                self.costs[opponent] = cost if previous is None else previous + self.smoothing * (cost - previous)
+
+    def cost_array(self) -> np.ndarray:
+        default = np.mean(list(self.costs.values())) if self.costs else 0.0
+        return np.array([self.costs.get(opponent, default) for opponent in self.opponents])
+
+    def weights(self) -> np.ndarray:
+        """Probabilities of the opponents for every env, shape (num_envs, num_opponents)."""
+        costs = self.cost_array()
+        if self.mode == "random":
+            order = list(np.argsort(costs, kind="stable"))
+            return np.concatenate([stratified_weights(order, s.stop - s.start) for s in self.env_slices])
+
+        # the opponents of "all", env i plays opponent i % num_opponents
+        num_envs = self.env_slices[-1].stop
+        opponents = [i % len(self.opponents) for i in range(num_envs)]
+        assignment = balanced_assignment(opponents, costs, [s.stop - s.start for s in self.env_slices])
+        weights = np.zeros((num_envs, len(self.opponents)))
+        weights[np.arange(num_envs), np.concatenate(assignment)] = 1
+        return weights
@@ -0,0 +1,63 @@
+import os
+from dataclasses import dataclass
+
+import torch
+from threadpoolctl import threadpool_limits
+
+
+THREAD_VARIABLES = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS")
+
+
+def limit_threads(threads: int, cores: tuple[int, ...] = ()):
+    """Limit the torch and BLAS/OpenMP thread pools of this process and pin it to cores (if any).
+
+    threadpool_limits only reaches the runtimes that are loaded, the environment variables limit
+    the ones that are loaded later, e.g. by the imports of an env.
+    """
+    for variable in THREAD_VARIABLES:
+        os.environ[variable] = str(threads)
+    torch.set_num_threads(threads)
+    threadpool_limits(threads)
+    if cores:
+        os.sched_setaffinity(0, cores)
+
+
+def available_cores() -> tuple[int, ...]:
+    return tuple(sorted(os.sched_getaffinity(0)))
+
+
+@dataclass(frozen=True)
+class CoreLayout:
+    """Thread budget of the learner and the env workers, with the cores to pin them to if pinned.
+
+    The env workers get a single thread each, they spend their time in Python env code.
+    init_worker is picklable, so it can be run at the start of every worker process.
+    """
+    learner_threads: int
+    learner_cores: tuple[int, ...]
+    worker_cores: tuple[tuple[int, ...], ...]
+
+    def init_learner(self):
+        limit_threads(self.learner_threads, self.learner_cores)
+
+    def init_worker(self, index: int):
+        limit_threads(1, self.worker_cores[index])
+
+
+def plan_layout(num_workers: int, learner_threads: int = 0, pin: bool = False, cores: tuple[int, ...] = ()) -> CoreLayout:
+    """Split cores (default: all cores of this process) between the learner and num_workers workers.
+
+    The learner gets the first learner_threads cores, by default the cores that are left when
+    every worker has one, but at least one. The workers are assigned the remaining cores one
+    each, round robin if there are more workers than cores. With too few cores the workers
+    share the cores of the learner. Without pin only the thread counts are set.
+    """
+    cores = tuple(sorted(cores)) or available_cores()
+    if learner_threads <= 0:
+        learner_threads = max(len(cores) - num_workers, 1)
+    learner_cores = cores[:learner_threads]
+    worker_pool = cores[learner_threads:] or cores
+    worker_cores = tuple((worker_pool[i % len(worker_pool)],) for i in range(num_workers))
+    if not pin:
+        return CoreLayout(learner_threads, (), ((),) * num_workers)
+    return CoreLayout(learner_threads, learner_cores, worker_cores)
@@ -0,0 +1,478 @@
+import multiprocessing as mp
+import pickle
+import traceback
+import weakref
+from collections import Counter
+from collections.abc import Callable
+from dataclasses import dataclass
+from functools import partial
+from typing import Any
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+from gymnasium.spaces import Box, Dict, Discrete, MultiDiscrete
+from gymnasium.vector.async_vector_env import CloudpickleWrapper
+from supersuit.vector import ConcatVecEnv
+from supersuit.vector.multiproc_vec import compress_info, decompress_info
+
+
+def space_shape(space) -> tuple[int, ...]:
+    if isinstance(space, MultiDiscrete):
+        return (sum(space.nvec),)
+    elif isinstance(space, Discrete):
+        return ()
+    elif isinstance(space, Box):
+        return space.shape
+    else:
+        raise NotImplementedError
+
+
+class SharedRolloutBuffer:
+    """Rollout storage in shared memory that env workers write into by (step, env) slot.
+
+    Observation and done slot t hold the observation before step t (so slot num_steps is
+    the observation after the last step), reward slot t the reward of step t. dones[t]
+    marks that observation t starts a new episode, like the dones tensor in ppo.py.
+    The buffer can be pickled to worker processes, which attach to the same memory.
+    """
+    def __init__(self, observation_space: Dict, num_steps: int, num_envs: int):
+        self.observation_space = observation_space
+        self.num_steps = num_steps
+        self.num_envs = num_envs
+
+        specs = {f"obs/{k}": ((num_steps + 1, num_envs) + space_shape(s), s.dtype) for k, s in observation_space.items()}
+        specs["rewards"] = ((num_steps, num_envs), np.dtype(np.float32))
+        specs["dones"] = ((num_steps + 1, num_envs), np.dtype(np.float32))
+        self._attach(specs, owner=True)
+
+    def _attach(self, specs: dict, owner: bool, names: dict[str, str] | None = None):
+        self._specs = specs
+        self._owner = owner
+        self._memory = {}
+        self.arrays = {}
+        for key, (shape, dtype) in specs.items():
+            if owner:
+                size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+                self._memory[key] = SharedMemory(create=True, size=size)
+            else:
+                self._memory[key] = SharedMemory(names[key])
+            self.arrays[key] = np.ndarray(shape, dtype=dtype, buffer=self._memory[key].buf)
+            # the memory is unmapped once the array and all its views (e.g. tensors of the learner)
+            # are gone, numpy only keeps the mapping as base, which closing would invalidate
+            weakref.finalize(self.arrays[key], self._memory[key].close)
+
+        self.obs = {k.removeprefix("obs/"): v for k, v in self.arrays.items() if k.startswith("obs/")}
+        self.rewards = self.arrays["rewards"]
+        self.dones = self.arrays["dones"]
+
+    def __getstate__(self):
+        return {
+            "observation_space": self.observation_space,
+            "num_steps": self.num_steps,
+            "num_envs": self.num_envs,
+            "specs": self._specs,
+            "names": {k: m.name for k, m in self._memory.items()},
+        }
+
+    def __setstate__(self, state):
+        self.observation_space = state["observation_space"]
+        self.num_steps = state["num_steps"]
+        self.num_envs = state["num_envs"]
+        self._attach(state["specs"], owner=False, names=state["names"])
+
+    def fits(self, observation_space: Dict) -> bool:
+        """Whether observations of observation_space have the same layout as this buffer."""
+        return all(
+            self._specs.get(f"obs/{k}") == ((self.num_steps + 1, self.num_envs) + space_shape(s), s.dtype)
+            for k, s in observation_space.items()
+        ) and len(observation_space) == len(self.obs)
+
+    def write_obs(self, step: int, envs: slice, obs: dict[str, np.ndarray], dones: np.ndarray):
+        for key, value in obs.items():
+            self.obs[key][step, envs] = value
+        self.dones[step, envs] = dones
+
+    def rollover(self):
+        """Move the observation after the last step to the first slot for the next rollout."""
+        for value in self.obs.values():
+            value[0] = value[self.num_steps]
+        self.dones[0] = self.dones[self.num_steps]
+
+    def close(self, unlink: bool = True):
+        """Release the shared memory, the owner also frees it unless unlink is False.
+
+        The memory stays mapped while views of the arrays are alive, it is unmapped with the last one.
+        """
+        if self._owner and unlink:
+            for memory in self._memory.values():
+                memory.unlink()
+        self.obs = self.rewards = self.dones = self.arrays = None
+        self._memory = {}
+
+
+def _failed_env(error: BaseException, vec_env) -> int | None:
+    """Index of the environment of vec_env in which error was raised, if any."""
+    if vec_env is None:
+        return None
+    par_envs = {id(env.par_env): i for i, env in enumerate(vec_env.vec_envs)}
+    for frame, _ in traceback.walk_tb(error.__traceback__):
+        index = par_envs.get(id(frame.f_locals.get("self")))
+        if index is not None:
+            return index
+    return None
+
+
+def _worker(vec_env_fn, pipe, parent_pipe, buffer: SharedRolloutBuffer, envs: slice, worker_init=None):
+    parent_pipe.close()
+    vec_env = None
+    try:
+        if worker_init is not None:
+            worker_init()
+        vec_env = vec_env_fn()
+        while True:
+            command, data = pipe.recv()
+            if command == "reset":
+                seed, step = data
+                if isinstance(seed, list):
+                    # a seed per env
+                    results = [env.reset(seed=env_seed) for env, env_seed in zip(vec_env.vec_envs, seed)]
+                    obs = vec_env.concat_obs([env_obs for env_obs, _ in results])
+                    infos = [info for _, env_infos in results for info in env_infos]
+                else:
+                    obs, infos = vec_env.reset(seed=seed)
+                buffer.write_obs(step, envs, obs, 0)
+                pipe.send(compress_info(infos))
+            elif command == "step":
+                actions, step = data
+                obs, rewards, terminations, truncations, infos = vec_env.step(actions)
+                buffer.rewards[step, envs] = rewards
+                buffer.write_obs(step + 1, envs, obs, np.logical_or(terminations, truncations))
+                pipe.send(compress_info(infos))
+            elif command == "load_scenario":
+                scenario = pickle.loads(data)
+                for env in vec_env.vec_envs:
+                    env.par_env.load_scenario(scenario)
+                    env.observation_space = env.par_env.observation_space(env.par_env.possible_agents[0])
+                    env.action_space = env.par_env.action_space(env.par_env.possible_agents[0])
+                vec_env.observation_space = vec_env.vec_envs[0].observation_space
+                vec_env.action_space = vec_env.vec_envs[0].action_space
+                pipe.send((vec_env.observation_space, vec_env.action_space))
+            elif command == "set_attr":
+                name, values = data
+                for env, value in zip(vec_env.vec_envs, values):
+                    setattr(env.par_env, name, value)
+                pipe.send(None)
+            elif command == "buffer":
+                # a forked worker holds a copy of the owning buffer, it must not unlink it
+                buffer.close(unlink=False)
+                buffer = data
+                pipe.send(None)
+            elif command == "close":
+                vec_env.close()
+                pipe.send(None)
+                return
+            else:
+                raise ValueError(f"Unknown command {command}")
+    except BaseException as e:
+        # the opponent of the env that raised, for the failure counts of SupervisedVecEnv
+        index = _failed_env(e, vec_env)
+        opponent = None if index is None else getattr(vec_env.vec_envs[index].par_env, "opponent", None)
+        pipe.send((e, traceback.format_exc(), index, opponent))
+
+
+class SharedMemoryVecEnv:
+    """Vector env of worker processes that write into a SharedRolloutBuffer.
+
+    Only the actions and the (non-empty) infos are sent through pipes, observations,
+    rewards and dones are read from envs.buffer. Environments are split over the workers
+    in consecutive groups, and are reset automatically at the end of an episode. The
+    workers are long-lived, load_scenario swaps the scenario of all environments in place.
+    worker_init is called with the index of the worker at the start of every worker process,
+    e.g. to limit its threads.
+    """
+    def __init__(
+        self, env_fns: list, observation_space: Dict, action_space, num_steps: int, num_workers: int = 0,
+        worker_init: Callable[[int], None] | None = None,
+    ):
+        self.num_envs = len(env_fns)
+        self.single_observation_space = self.observation_space = observation_space
+        self.single_action_space = self.action_space = action_space
+        self.is_vector_env = True
+        self.buffer = SharedRolloutBuffer(observation_space, num_steps, self.num_envs)
+
+        num_workers = min(max(num_workers, 1), self.num_envs)
+        envs_per_worker = -(-self.num_envs // num_workers)
+        self.env_slices = [slice(i, min(i + envs_per_worker, self.num_envs)) for i in range(0, self.num_envs, envs_per_worker)]
+
+        self._env_fns = env_fns
+        self._worker_init = worker_init
+        # the state sent to the workers after they started, to set up restarted workers
+        self._scenario: bytes | None = None
+        self._attrs: dict[str, Any] = {}
+        self.pipes, self.processes = [], []
+        for index in range(len(self.env_slices)):
+            pipe, process = self._start_worker(index)
+            self.pipes.append(pipe)
+            self.processes.append(process)
+        self.closed = False
+
+    def _start_worker(self, index: int):
+        envs = self.env_slices[index]
+        parent_pipe, child_pipe = mp.Pipe()
+        init = None if self._worker_init is None else CloudpickleWrapper(partial(self._worker_init, index))
+        process = mp.Process(
+            target=_worker,
+            args=(CloudpickleWrapper(partial(ConcatVecEnv, self._env_fns[envs])), child_pipe, parent_pipe, self.buffer, envs, init),
+            daemon=True,
+        )
+        process.start()
+        child_pipe.close()
+        return parent_pipe, process
+
+    def _send(self, index: int, command: tuple):
+        self.pipes[index].send(command)
+
+    def _receive(self) -> list:
+        results = []
+        for pipe in self.pipes:
+            result = pipe.recv()
+            if isinstance(result, tuple) and isinstance(result[0], BaseException):
+                e, tb = result[:2]
+                print(tb)
+                raise e
+            results.append(result)
+        return results
+
+    def _send_reset(self, seed: int | list[int] | None, step: int):
+        for index, envs in enumerate(self.env_slices):
+            if isinstance(seed, list):
+                self._send(index, ("reset", (seed[envs], step)))
+            else:
+                # the envs of a worker add their index within the worker, so env i gets seed + i
+                self._send(index, ("reset", (None if seed is None else seed + envs.start, step)))
+
+    def reset(self, seed: int | list[int] | None = None, step: int = 0) -> list[dict]:
+        """Reset all environments and write their observations to slot step of the buffer.
+
+        seed is a base seed, env i gets seed + i, or a list with the seed of every env.
+        """
+        self._send_reset(seed, step)
+        return decompress_info(self.num_envs, [s.start for s in self.env_slices], self._receive())
+
+    def step(self, actions: np.ndarray, step: int) -> list[dict]:
+        """Execute the actions for the observations in slot step of the buffer.
+
+        The rewards are written to slot step and the next observations and dones to
+        slot step + 1. Returns the infos of every environment.
+        """
+        for index, envs in enumerate(self.env_slices):
+            self._send(index, ("step", (actions[envs], step)))
+        return decompress_info(self.num_envs, [s.start for s in self.env_slices], self._receive())
+
+    def load_scenario(self, scenario) -> bool:
+        """Swap all environments to another scenario (a path or Scenario object).
+
+        The scenario is pickled once and the same bytes are sent to every worker, a
+        Scenario object never touches the filesystem. Takes effect on the next reset, which should follow. The spaces are resized, and
+        the buffer is only reallocated when the observation layout changes. Returns whether
+        the observation or action shapes changed, so that views of the buffer and storage
+        of the learner have to be recreated.
+        """
+        data = self._scenario = pickle.dumps(scenario, protocol=pickle.HIGHEST_PROTOCOL)
+        for index in range(len(self.pipes)):
+            self._send(index, ("load_scenario", data))
+        observation_space, action_space = self._receive()[0]
+        changed = action_space.shape != self.single_action_space.shape
+        self.single_observation_space = self.observation_space = observation_space
+        self.single_action_space = self.action_space = action_space
+
+        if not self.buffer.fits(observation_space):
+            previous, self.buffer = self.buffer, SharedRolloutBuffer(observation_space, self.buffer.num_steps, self.num_envs)
+            for index in range(len(self.pipes)):
+                self._send(index, ("buffer", self.buffer))
+            self._receive()
+            previous.close()
+            changed = True
+        return changed
+
+    def set_attr(self, name: str, values):
+        """Set attribute name of the parallel env of every environment, values holds a value per env."""
+        self._attrs[name] = values
+        for index, envs in enumerate(self.env_slices):
+            self._send(index, ("set_attr", (name, values[envs])))
+        self._receive()
+
+    def close(self):
+        if self.closed:
+            return
+        # a worker that failed may still be exiting
+        for pipe, process in zip(self.pipes, self.processes):
+            if process.is_alive():
+                try:
+                    pipe.send(("close", None))
+                except (BrokenPipeError, ConnectionError):
+                    pass
+        for pipe, process in zip(self.pipes, self.processes):
+            if process.is_alive():
+                try:
+                    pipe.recv()
+                except (EOFError, ConnectionError):
+                    pass
+            process.join()
+            pipe.close()
+        self.buffer.close()
+        self.closed = True
+
+    def __del__(self):
+        if hasattr(self, "closed"):
+            self.close()
+
+
+@dataclass
+class WorkerFailure:
+    error: BaseException
+    traceback: str | None = None
+    opponent: str | None = None
+    """opponent of the environment that raised, if known"""
+
+
+class SupervisedVecEnv(SharedMemoryVecEnv):
+    """SharedMemoryVecEnv that restarts workers that raise, die or (with timeout) stop responding.
+
+    A failed worker is replaced by a new process with the current scenario and attributes,
+    whose environments are reset with new seeds. On a step, the episodes of all environments
+    of the worker are cut off (truncated): their reward is 0, the next observation starts a new
+    episode (done) and their info is {"worker_failure": True}. failures counts the failures per
+    opponent of the environment that raised ("unknown" if it is not known, e.g. when the worker
+    died). A worker that fails on load_scenario or set_attr, between rollouts, is replaced the
+    same way; unless a scenario was loaded, which requires a reset anyway, its environments are
+    reset to the last slot of the buffer and marked done there, so that the next rollout (after
+    rollover) starts new episodes. A worker that fails again on reset is restarted up to
+    max_retries times in a row, then the last error is raised.
+    """
+    def __init__(self, *args, timeout: float | None = None, max_retries: int = 3, **kwargs):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.failures: Counter[str] = Counter()
+        self._seed = 0
+        self._restarts = 0
+        self._reset_pending = False
+        super().__init__(*args, **kwargs)
+
+    def _send(self, index: int, command: tuple):
+        try:
+            super()._send(index, command)
+        except (BrokenPipeError, ConnectionError):
+            # the worker died, which the receive of its result detects
+            pass
+
+    def _receive_worker(self, index: int):
+        pipe, process = self.pipes[index], self.processes[index]
+        if self.timeout is not None and not pipe.poll(self.timeout):
+            return WorkerFailure(TimeoutError(f"Env worker {index} did not respond within {self.timeout}s"))
+        try:
+            result = pipe.recv()
+        except (EOFError, ConnectionError):
+            process.join(1)
+            return WorkerFailure(RuntimeError(f"Env worker {index} died (exit code {process.exitcode})"))
+        if isinstance(result, tuple) and isinstance(result[0], BaseException):
+            e, tb, _, opponent = result
+            return WorkerFailure(e, tb, opponent)
+        return result
+
+    def _replace_worker(self, index: int) -> WorkerFailure | list:
+        """Start a new worker index with the current scenario and attributes, returns their results."""
+        pipe, process = self.pipes[index], self.processes[index]
+        if process.is_alive():
+            process.kill()
+        process.join()
+        pipe.close()
+        self.pipes[index], self.processes[index] = self._start_worker(index)
+
+        envs = self.env_slices[index]
+        commands = [("load_scenario", self._scenario)] if self._scenario is not None else []
+        commands += [("set_attr", (name, values[envs])) for name, values in self._attrs.items()]
+        results = []
+        for command in commands:
+            self._send(index, command)
+            result = self._receive_worker(index)
+            if isinstance(result, WorkerFailure):
+                return result
+            results.append(result)
+        return results
+
+    def _recover(self, index: int, failure: WorkerFailure, step: int | None) -> list:
+        """Restart worker index and reset its environments to slot step, returns the reset infos.
+
+        With step None the environments are not reset, and the results of replaying the scenario
+        and attributes are returned.
+        """
+        for _ in range(self.max_retries + 1):
+            self.failures[failure.opponent or "unknown"] += 1
+            print(f"Restarting env worker {index} after {failure.error!r}")
+            if failure.traceback is not None:
+                print(failure.traceback)
+            self._restarts += 1
+            result = self._replace_worker(index)
+            if not isinstance(result, WorkerFailure):
+                if step is None:
+                    return result
+                # new seeds, the envs would repeat the episodes of the first reset otherwise
+                seed = self._seed + self._restarts * self.num_envs + self.env_slices[index].start
+                self._send(index, ("reset", (seed, step)))
+                result = self._receive_worker(index)
+                if not isinstance(result, WorkerFailure):
+                    return result
+            failure = result
+        raise failure.error
+
+    def _receive(self) -> list:
+        # results of load_scenario, set_attr and buffer, which a restarted worker gets from the
+        # replay of the current scenario and attributes (and the buffer it is started with)
+        results = []
+        for index, envs in enumerate(self.env_slices):
+            result = self._receive_worker(index)
+            if isinstance(result, WorkerFailure):
+                if self._reset_pending:
+                    # the observations of a new scenario may not fit the buffer yet, the reset
+                    # that follows the scenario starts the episodes. The replay starts with the
+                    # scenario, whose spaces load_scenario expects
+                    replayed = self._recover(index, result, None)
+                    result = replayed[0] if replayed else None
+                else:
+                    num_steps = self.buffer.num_steps
+                    self._recover(index, result, num_steps)
+                    self.buffer.dones[num_steps, envs] = 1
+                    result = None
+            results.append(result)
+        return results
+
+    def load_scenario(self, scenario) -> bool:
+        self._reset_pending = True
+        return super().load_scenario(scenario)
+
+    def reset(self, seed: int | list[int] | None = None, step: int = 0) -> list[dict]:
+        self._reset_pending = False
+        self._seed = (seed[0] if isinstance(seed, list) else seed) or 0
+        self._send_reset(seed, step)
+        results = []
+        for index in range(len(self.pipes)):
+            result = self._receive_worker(index)
+            if isinstance(result, WorkerFailure):
+                result = self._recover(index, result, step)
+            results.append(result)
+        return decompress_info(self.num_envs, [s.start for s in self.env_slices], results)
+
+    def step(self, actions: np.ndarray, step: int) -> list[dict]:
+        for index, envs in enumerate(self.env_slices):
+            self._send(index, ("step", (actions[envs], step)))
+        results = []
+        for index, envs in enumerate(self.env_slices):
+            result = self._receive_worker(index)
+            if isinstance(result, WorkerFailure):
+                self._recover(index, result, step + 1)
+                self.buffer.rewards[step, envs] = 0
+                self.buffer.dones[step + 1, envs] = 1
+                result = [(i, {"worker_failure": True}) for i in range(envs.stop - envs.start)]
+            results.append(result)
+        return decompress_info(self.num_envs, [s.start for s in self.env_slices], results)
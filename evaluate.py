@@ -1,15 +1,23 @@
 from collections import defaultdict
 from dataclasses import dataclass
+from functools import partial
 
 import numpy as np
 import pandas as pd
+import supersuit as ss
 import torch
 import tyro
 from tensordict import TensorDict
 
 from environment.agents.geniusweb import AGENTS
-from environment.agents.policy.PPO import GNN
+from environment.agents.policy.onnx_runtime import OnnxPolicy
+from environment.agents.policy.PPO import GNN, export_inference_policy
+from environment.agents.policy.quantization import load_policy, quantize_policy
+from environment.evaluation_cache import EvaluationCache, file_hash, scenario_hash
+from environment.metrics import profiler
+from environment.running_stats import RunningStats
 from environment.negotiation import NegotiationEnvZoo
+from environment.vector_env import SharedMemoryVecEnv
 from ppo import Args, Policies
 
 
@@ -17,70 +25,276 @@ from ppo import Args, Policies
 class ArgsEval(Args):
     model_paths: tuple[str, ...] | None = None
     episodes: int = 100
+    torchscript: bool = False
+    """select actions with the inference only TorchScript export of the policy"""
+    quantize: bool = False
+    """apply dynamic int8 quantization to the policy (quantized checkpoints are detected automatically)"""
+    eval_cache: str | None = "analysis/cache/evaluation.jsonl"
+    """append-only store of the results of evaluation episodes, which are not played again (None to disable)"""
+    paired: bool = False
+    """also write the differences of my_utility to the first model, paired by episode, with their 99% CIs"""
 
 
-def evaluate_agent(opponent, model_path, args):
-    agent_type = model_path.split("/")[1].split("_")[0]
-    used_agents = [a for a in AGENTS if a.startswith(tuple(args.opponent_sets))]
-    env_config = {
-        "agents": [f"RL_{agent_type}", opponent],
-        "used_agents": used_agents,
-        "scenario": args.scenario,
-        "deadline": {"rounds": args.deadline, "ms": 10000},
-        "random_agent_order": args.random_agent_order,
-    }
-    env = NegotiationEnvZoo(env_config)
-    env.single_action_space = env.action_space(f"RL_{agent_type}")
-    env.single_observation_space = env.observation_space(f"RL_{agent_type}")
-    agent: GNN = Policies[agent_type].value(env, args).to("cpu")
-    agent.load_state_dict(torch.load(model_path))
+METRICS = ["my_utility", "opp_utility", "rounds_played", "self_accepted", "found_agreement"]
+
+
+def eval_env(env_config):
+    return ss.pettingzoo_env_to_vec_env_v1(NegotiationEnvZoo(env_config))
+
+
+def load_eval_policy(model_path: str, agent_type: str, envs: SharedMemoryVecEnv, args: ArgsEval):
+    """Batched action selection of a model, maps observations and the action nvec to numpy actions."""
+    if model_path.endswith(".onnx"):
+        # exported with export_onnx.py, runs on onnxruntime without torch
+        onnx_policy = OnnxPolicy(model_path, seed=args.seed)
+        return lambda obs, nvec: onnx_policy({k: v.numpy() for k, v in obs.items()}, nvec)
+
+    agent: GNN = load_policy(Policies[agent_type].value(envs, args), model_path, "cpu")
+    if args.quantize:
+        agent = quantize_policy(agent)
     agent.train(False)
+    scripted = None
+
+    def policy(obs: TensorDict, nvec: tuple[int, ...]) -> np.ndarray:
+        nonlocal scripted
+        agent.action_nvec = nvec
+        with torch.no_grad():
+            if args.torchscript:
+                if scripted is None:
+                    scripted = export_inference_policy(agent, obs)
+                return scripted(dict(obs.items()), torch.tensor(nvec)).numpy()
+            action, _, _, _ = agent.get_action_and_value(obs)
+        return action.numpy()
+
+    return policy
+
+
+def model_type(model_path: str) -> str:
+    return model_path.split("/")[1].split("_")[0]
+
+
+def action_backend(model_path: str, args: ArgsEval) -> str:
+    """The backend that selects the actions of a model, their actions can differ (e.g. the weights of a quantized policy)."""
+    if model_path.endswith(".onnx"):
+        return "onnx"
+    return ("torchscript" if args.torchscript else "torch") + ("-int8" if args.quantize else "")
+
+
+class Evaluator:
+    """Env workers and policies of models of the same policy type, reused for many scenarios and episodes.
+
+    Every model has num_envs envs of a "random" opponent over the used agents. An episode either
+    samples its opponent like in training or plays a given one, so the envs of a model can be
+    spread over the episodes of all its opponents. Every step the actions of all envs of a model
+    are selected in a single batch. The env workers are started on the first episodes that are not
+    in the cache, and load_scenario swaps the scenario of the running workers.
+    """
+    def __init__(self, model_paths: list[str], used_agents: list[str], args: ArgsEval, scenario, num_envs: int):
+        self.model_paths = model_paths
+        self.agent_type = model_type(model_paths[0])
+        self.used_agents = used_agents
+        self.args = args
+        self.num_envs = num_envs
+        self.scenario = scenario
+        self.scenario_key = None
+        self.config = {
+            "deadline": {"rounds": args.deadline, "ms": 10000},
+            "random_agent_order": args.random_agent_order,
+            "opponent_sets": list(args.opponent_sets),
+            "used_agents": used_agents,
+        }
+        self.model_keys = [f"{file_hash(model_path)}:{action_backend(model_path, args)}" for model_path in model_paths]
+        self.envs = None
+        self.trace = None
+
+    def _start(self):
+        env_config = {
+            "agents": [f"RL_{self.agent_type}", "random"],
+            "used_agents": self.used_agents,
+            "scenario": self.scenario,
+            "deadline": self.config["deadline"],
+            "random_agent_order": self.args.random_agent_order,
+        }
+        env = eval_env(env_config)
+        num_envs = self.num_envs * len(self.model_paths)
+        # a single observation slot, the next observation is moved back to it after every step
+        self.envs = SharedMemoryVecEnv(
+            [partial(eval_env, env_config)] * num_envs, env.observation_space, env.action_space, 1, self.args.num_workers or num_envs,
+        )
+        self.policies = [load_eval_policy(model_path, self.agent_type, self.envs, self.args) for model_path in self.model_paths]
+        self.trace = profiler(
+            self.args.profile, self.args.profile_dir, self.args.profile_wait, self.args.profile_warmup, self.args.profile_active,
+            f"evaluation_{self.agent_type}",
+        )
+        self.trace.start()
+
+    def load_scenario(self, scenario):
+        self.scenario = scenario
+        self.scenario_key = None
+        if self.envs is not None:
+            self.envs.load_scenario(scenario)
+
+    def key(self, model_index: int, opponent: str, seed: int) -> tuple:
+        if self.scenario_key is None:
+            self.scenario_key = scenario_hash(self.scenario)
+        return EvaluationCache.key(self.model_keys[model_index], opponent, self.scenario_key, self.config, seed)
+
+    def run(self, episodes: dict[tuple[int, str], list[int]], cache: EvaluationCache | None = None) -> dict[tuple[int, str], list[dict]]:
+        """Results of the episodes of every (model index, opponent) pair, given by their seeds.
+
+        An episode plays on generators seeded with its seed, "random" samples its opponent from
+        the used agents. The result of an episode holds the METRICS and the played_opponent.
+        Episodes found in the cache are not played again, new episodes are added to it.
+        """
+        results = {pair: [None] * len(seeds) for pair, seeds in episodes.items()}
+        pending = defaultdict(list)
+        for (i, opponent), seeds in episodes.items():
+            for e, seed in enumerate(seeds):
+                record = cache.get(self.key(i, opponent, seed)) if cache is not None else None
+                if record is None:
+                    pending[i].append(((i, opponent), e))
+                else:
+                    results[i, opponent][e] = record
+        if not pending:
+            return results
+        if self.envs is None:
+            self._start()
+
+        # the episodes of a model are spread over its envs, an env plays its episodes in order
+        assignments = [[] for _ in range(self.envs.num_envs)]
+        for i, jobs in pending.items():
+            for j, job in enumerate(jobs):
+                assignments[i * self.num_envs + j % self.num_envs].append(job)
+        envs = self.envs
+        envs.set_attr("episode_seeds", [[episodes[pair][e] for pair, e in jobs] for jobs in assignments])
+        envs.set_attr("episode_opponents", [[None if pair[1] == "random" else pair[1] for pair, _ in jobs] for jobs in assignments])
+        nvec = tuple(envs.single_action_space.nvec)
+        obs = TensorDict({k: torch.from_numpy(v) for k, v in envs.buffer.obs.items()}, batch_size=(2, envs.num_envs))
+        envs.reset()
+        played = np.zeros(envs.num_envs, dtype=np.int64)
+        num_episodes = np.array([len(jobs) for jobs in assignments])
+        # envs that finished their episodes keep stepping until all are done, their episodes are ignored
+        while (played < num_episodes).any():
+            actions = np.zeros((envs.num_envs,) + envs.single_action_space.shape, dtype=np.int64)
+            for i, policy in enumerate(self.policies):
+                env_slice = slice(i * self.num_envs, (i + 1) * self.num_envs)
+                actions[env_slice] = policy(obs[0][env_slice], nvec)
+            infos = envs.step(actions, 0)
+            envs.buffer.rollover()
+
+            for env_index, info in enumerate(infos):
+                if info and played[env_index] < num_episodes[env_index]:
+                    pair, e = assignments[env_index][played[env_index]]
+                    utilities = info["utility_all_agents"]
+                    record = dict(zip(METRICS, [
+                        utilities[f"RL_{self.agent_type}"], utilities[info["opponent"]],
+                        info["rounds_played"], info["self_accepted"], info["found_agreement"],
+                    ]))
+                    record["played_opponent"] = info["opponent"]
+                    results[pair][e] = record
+                    if cache is not None:
+                        cache.add(self.key(pair[0], pair[1], episodes[pair][e]), record)
+                    played[env_index] += 1
+            self.trace.step()
+        return results
+
+    def close(self):
+        if self.envs is not None:
+            self.trace.stop()
+            self.envs.close()
+
+
+def evaluate_episodes(
+    model_paths: list[str],
+    opponents: list[str],
+    args: ArgsEval,
+    scenario=None,
+    seeds: list[int] | None = None,
+    cache: EvaluationCache | None = None,
+) -> dict[tuple[int, str], np.ndarray]:
+    """Metrics of every episode of every model against every opponent, by (model index, opponent).
+
+    Episode e of a pair plays on generators seeded with seeds[e] (default: seed + 1 + e) in the
+    scenario (default: args.scenario), shape (episodes, len(METRICS)). The models of a policy type
+    share an Evaluator, with their share of args.num_envs envs each.
+    """
+    scenario = args.scenario if scenario is None else scenario
+    seeds = list(range(args.seed + 1, args.seed + 1 + args.episodes)) if seeds is None else list(seeds)
+    used_agents = [a for a in AGENTS if a.startswith(tuple(args.opponent_sets))]
+    models_by_type = defaultdict(list)
+    for i, model_path in enumerate(model_paths):
+        models_by_type[model_type(model_path)].append(i)
+
+    results = {}
+    for model_indices in models_by_type.values():
+        evaluator = Evaluator(
+            [model_paths[i] for i in model_indices], used_agents, args, scenario, max(args.num_envs // len(model_indices), 1),
+        )
+        try:
+            episodes = evaluator.run({(m, opponent): seeds for m in range(len(model_indices)) for opponent in opponents}, cache)
+        finally:
+            evaluator.close()
+        for (m, opponent), records in episodes.items():
+            results[model_indices[m], opponent] = np.array([[record[k] for k in METRICS] for record in records])
+    return results
+
 
+def evaluate(model_paths: list[str], opponents: list[str], args: ArgsEval, cache: EvaluationCache | None = None) -> dict[tuple[int, str], dict[str, float]]:
+    """Mean metrics of args.episodes episodes of every model against every opponent, by (model index, opponent)."""
+    results = evaluate_episodes(model_paths, opponents, args, cache=cache)
+    return {pair: dict(zip(METRICS, episodes.mean(axis=0))) for pair, episodes in results.items()}
 
-    log_metrics = defaultdict(lambda: .0)
-    for episode in range(1, args.episodes + 1):
-        next_obs = env.reset(seed=args.seed+episode)[0]
-        terminations = {f"RL_{agent_type}": False}
 
-        while not terminations[f"RL_{agent_type}"]:
-            next_obs = {k: torch.from_numpy(v[np.newaxis, ...]) for k, v in next_obs[f"RL_{agent_type}"].items() if k != "opponent_encoding"}
-            next_obs = TensorDict(next_obs, batch_size=1)
-            agent.action_nvec = tuple(env.action_space(f"RL_{agent_type}").nvec)
-            with torch.no_grad():
-                action, _, _, _ = agent.get_action_and_value(next_obs)
+def paired_differences(results: dict[tuple[int, str], np.ndarray], confidence: float = 0.99, reference: int = 0) -> pd.DataFrame:
+    """Mean difference of my_utility of every model to the reference model per opponent, paired by episode.
 
-            # TRY NOT TO MODIFY: execute the game and log data.
-            next_obs, _, terminations, _, infos = env.step({f"RL_{agent_type}": action.numpy()[0]})
+    Every model plays the same episodes (scenario, agent order, opponent and seeds), so the
+    episode to episode variation cancels in the differences. Next to the CI half-width of the
+    paired differences the half-width of the difference of the independent means is reported.
+    """
+    column = METRICS.index("my_utility")
+    rows = {}
+    for (model, opponent), episodes in results.items():
+        if model == reference or (reference, opponent) not in results:
+            continue
+        # adaptive evaluation can stop at a different number of episodes, the first ones are the same
+        count = min(len(episodes), len(results[reference, opponent]))
+        utilities, reference_utilities = episodes[:count, column], results[reference, opponent][:count, column]
+        paired, model_stats, reference_stats = RunningStats(), RunningStats(), RunningStats()
+        paired.update(utilities - reference_utilities)
+        model_stats.update(utilities)
+        reference_stats.update(reference_utilities)
+        rows[model, opponent] = {
+            "my_utility_diff": paired.mean,
+            "paired_CI": paired.half_width(confidence),
+            "unpaired_CI": (model_stats.half_width(confidence) ** 2 + reference_stats.half_width(confidence) ** 2) ** 0.5,
+            "count": count,
+        }
+    return pd.DataFrame.from_dict(rows, orient="index").rename_axis(["model", "opponent"])
 
-        info = infos[f"RL_{agent_type}"]
-        log_metrics["my_utility"] += info["utility_all_agents"][f"RL_{agent_type}"]
-        log_metrics["opp_utility"] += info["utility_all_agents"][opponent]
-        log_metrics["rounds_played"] += info["rounds_played"]
-        log_metrics["self_accepted"] += info["self_accepted"]
-        log_metrics["found_agreement"] += info["found_agreement"]
 
-    log_metrics = {k: v/episode for k, v in log_metrics.items()}
+def evaluate_agent(opponent, model_path, args, cache=None):
+    return evaluate([model_path], [opponent], args, cache)[(0, opponent)], opponent
 
-    return log_metrics, opponent
 
 def main():
     args = tyro.cli(ArgsEval)
     used_agents = [a for a in AGENTS if a.startswith(tuple(args.opponent_sets))]
     assert args.model_paths is not None
+    cache = EvaluationCache(args.eval_cache) if args.eval_cache else None
     if args.debug:
-        print(evaluate_agent(used_agents[0], args.model_paths[0], args))
+        print(evaluate_agent(used_agents[0], args.model_paths[0], args, cache))
     else:
         iterables = [list(range(len(args.model_paths))), sorted(used_agents)]
         index = pd.MultiIndex.from_product(iterables, names=["model", "opponent"])
         data = pd.DataFrame(columns=["my_utility", "opp_utility","rounds_played", "self_accepted", "found_agreement"], index=index)
 
-        for i, model_path in enumerate(args.model_paths):
-            results = []
-            for opponent in used_agents:
-                results.append(evaluate_agent(opponent, model_path, args))
-            for result in results:
-                data.loc[(i, result[1]), result[0].keys()] = list(result[0].values())
+        results = evaluate_episodes(list(args.model_paths), used_agents, args, cache=cache)
+        for (i, opponent), episodes in results.items():
+            data.loc[(i, opponent), METRICS] = episodes.mean(axis=0)
         data.to_csv("analysis/data/evaluation.csv")
+        if args.paired:
+            paired_differences(results).to_csv("analysis/data/evaluation_paired.csv")
 
     
 
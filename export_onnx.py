@@ -0,0 +1,50 @@
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import tyro
+
+from environment.agents.geniusweb import AGENTS
+from environment.agents.policy.onnx_export import export_onnx
+from environment.agents.policy.quantization import load_policy
+from environment.negotiation import NegotiationEnvZoo
+from evaluate import ArgsEval
+from ppo import Policies
+
+DEFAULT_MODELS = [str(i) for policy in ("GNN", "HigaEtAl") for i in sorted(Path("models", policy).glob("*/*"))]
+
+
+@dataclass
+class ArgsExport(ArgsEval):
+    output_dir: str = "models_onnx"
+    """directory to write the ONNX models to (keeps the models/<policy>/... layout)"""
+
+
+def save_onnx(model_path: str, args: ArgsExport) -> Path:
+    agent_type = model_path.split("/")[1].split("_")[0]
+    env = NegotiationEnvZoo({
+        "agents": [f"RL_{agent_type}", args.opponent],
+        "used_agents": [a for a in AGENTS if a.startswith(tuple(args.opponent_sets))],
+        "scenario": args.scenario,
+        "deadline": {"rounds": args.deadline, "ms": 10000},
+        "random_agent_order": args.random_agent_order,
+    })
+    env.single_action_space = env.action_space(f"RL_{agent_type}")
+    env.single_observation_space = env.observation_space(f"RL_{agent_type}")
+    agent = load_policy(Policies[agent_type].value(env, args), model_path)
+
+    obs = env.reset(seed=args.seed)[0][f"RL_{agent_type}"]
+    example_batch = {k: v[np.newaxis, ...] for k, v in obs.items()}
+    output_path = Path(args.output_dir, *Path(model_path).parts[1:])
+    output_path = output_path.with_name(f"{output_path.name}.onnx")
+    return export_onnx(agent, example_batch, output_path)
+
+
+def main():
+    args = tyro.cli(ArgsExport)
+    for model_path in args.model_paths or DEFAULT_MODELS:
+        print(f"saved {save_onnx(model_path, args)}")
+
+
+if __name__ == "__main__":
+    main()
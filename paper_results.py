@@ -1,9 +1,11 @@
+import math
 import random
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
 from dataclasses import dataclass
 from pathlib import Path
 from statistics import NormalDist
-from uuid import uuid4
 
 import numpy as np
 import pandas as pd
@@ -13,12 +15,12 @@ import plotly.io as pio
 import torch
 import tyro
 from numpy.random import default_rng
-from tensordict import TensorDict
 
 from environment.agents.geniusweb import AGENTS
-from environment.agents.policy.PPO import GNN
-from environment.scenario import Scenario
-from ppo import Args, Policies, concat_envs
+from environment.evaluation_cache import EvaluationCache
+from environment.running_stats import RunningStats
+from evaluate import METRICS, Evaluator, paired_differences
+from ppo import RANDOM_SCENARIOS, Args, is_random_scenarios, random_scenario
 
 pio.kaleido.scope.mathjax = None
 
@@ -27,14 +29,14 @@ TESTS = [
         "name": "GNN_basic_random_on_basic_random",
         "module": "GNN",
         "models": [str(i) for i in Path("models", "GNN", "basic_opponents_random_scenarios").iterdir()],
-        "scenario": f"environment/scenarios/random_tmp_GNN_basic_random_on_basic_random_{uuid4()}",
+        "scenario": RANDOM_SCENARIOS,
         "opponent_sets": ("BASIC",),
     },
     {
         "name": "GNN_all_random_on_all_random",
         "module": "GNN",
         "models": [str(i) for i in Path("models", "GNN", "all_opponents_random_scenarios").iterdir()],
-        "scenario": f"environment/scenarios/random_tmp_GNN_all_random_on_all_random_{uuid4()}",
+        "scenario": RANDOM_SCENARIOS,
         "opponent_sets": ("ANL2022", "ANL2023", "BASIC"),
     },
     {
@@ -75,6 +77,66 @@ class ArgsEval(Args):
 
     episodes_per_agent: int = 1000
     episodes_per_scenario_per_agent: int = 20
+    torchscript: bool = False
+    """select actions with the inference only TorchScript export of the policy"""
+    quantize: bool = False
+    """apply dynamic int8 quantization to the policy (quantized checkpoints are detected automatically)"""
+    eval_cache: str | None = "analysis/cache/evaluation.jsonl"
+    """append-only store of the results of evaluation episodes, which are not played again (None to disable)"""
+    model_processes: int = 1
+    """number of models that are evaluated in parallel, each in a process with its own env workers"""
+    paired: bool = False
+    """also write the differences of my_utility to the first model, paired by episode, with their CIs"""
+    ci_target: float | None = None
+    """adaptive evaluation: stop playing an opponent once the CI half-width of my_utility is below this, its episodes go to the other opponents"""
+    ci_confidence: float = 0.99
+    """confidence level of the adaptive evaluation and paired difference intervals"""
+    ci_min_episodes: int = 40
+    """episodes against an opponent before adaptive evaluation can stop playing it"""
+
+
+def evaluate_model(model_path: str, opponents: list[str], scenarios: list, episodes_per_scenario: int, args: ArgsEval) -> dict[str, np.ndarray]:
+    """Metrics of the episodes of a model against every opponent, by opponent.
+
+    The episodes are played in rounds, round r on scenario r (cycling through the scenarios), on
+    num_envs envs that are started once. By default the opponent of every episode is sampled, with
+    "all" (and adaptive evaluation) every opponent plays episodes_per_scenario episodes a round.
+    The episodes are added to the evaluation cache as they finish, so an interrupted run resumes
+    from the finished episodes. With a ci_target an opponent is no longer played once the CI
+    half-width of my_utility is below it, and the rounds continue for the other opponents until
+    the budget of episodes_per_agent episodes per opponent is spent.
+    """
+    cache = EvaluationCache(args.eval_cache) if args.eval_cache else None
+    evaluator = Evaluator([model_path], opponents, args, scenarios[0], args.num_envs)
+    sampled = args.opponent == "random" and args.ci_target is None
+    episodes = defaultdict(list)
+    stats = {opponent: RunningStats() for opponent in opponents}
+    active = list(opponents)
+    budget = args.episodes_per_agent * len(opponents)
+    num_rounds = len(scenarios) if args.ci_target is None else math.inf
+    r = 0
+    try:
+        while active and r < num_rounds and budget > 0:
+            print(f"{model_path}: round {r + 1}, {len(active)} opponents")
+            seeds = list(range(args.seed + r * episodes_per_scenario + 1, args.seed + (r + 1) * episodes_per_scenario + 1))
+            evaluator.load_scenario(scenarios[r % len(scenarios)])
+            jobs = {(0, "random"): seeds} if sampled else {(0, opponent): seeds for opponent in active}
+            round_episodes = defaultdict(list)
+            for records in evaluator.run(jobs, cache).values():
+                for record in records:
+                    round_episodes[record["played_opponent"]].append([record[m] for m in METRICS])
+            for opponent, results in round_episodes.items():
+                episodes[opponent].append(np.array(results))
+                stats[opponent].update(episodes[opponent][-1][:, METRICS.index("my_utility")])
+            budget -= len(seeds) * (1 if sampled else len(active))
+            r += 1
+            if args.ci_target is not None:
+                active = [
+                    o for o in active if stats[o].count < args.ci_min_episodes or stats[o].half_width(args.ci_confidence) >= args.ci_target
+                ]
+    finally:
+        evaluator.close()
+    return {opponent: np.concatenate(results) for opponent, results in episodes.items()}
 
 
 def main():
@@ -91,90 +153,45 @@ def main():
     torch.backends.cudnn.deterministic = args.torch_deterministic
     scenario_rng = default_rng(args.seed)
 
-    device = torch.device("cuda:0" if torch.cuda.is_available() and args.cuda else "cpu")
-
-    # env setup
     used_agents = [a for a in AGENTS if a.startswith(tuple(test_data["opponent_sets"]))]
-    args.episodes = args.episodes_per_agent * len(used_agents)
-    args.episodes_per_scenario = args.episodes_per_scenario_per_agent * len(used_agents)
-    envs = None
 
-    if args.opponent == "all":
-        args.num_envs = len(used_agents)
+    # every model plays the same scenarios and episode seeds
+    if is_random_scenarios(test_data["scenario"]):
+        num_scenarios = math.ceil(args.episodes_per_agent / args.episodes_per_scenario_per_agent)
+        scenarios = [random_scenario(scenario_rng, args.scenario_archive, s + 1) for s in range(num_scenarios)]
+        episodes_per_scenario = args.episodes_per_scenario_per_agent
+    else:
+        scenarios = [test_data["scenario"]]
+        # adaptive evaluation decides after every round of episodes_per_scenario_per_agent episodes
+        episodes_per_scenario = args.episodes_per_agent if args.ci_target is None else args.episodes_per_scenario_per_agent
+    if args.opponent == "random" and args.ci_target is None:
+        # the opponents are sampled, a round has the episodes of all opponents
+        episodes_per_scenario *= len(used_agents)
 
     iterables = [list(range(len(test_data["models"]))), sorted(used_agents)]
     index = pd.MultiIndex.from_product(iterables, names=["model", "opponent"])
     data = pd.DataFrame(columns=["my_utility", "opp_utility", "count", "rounds_played", "self_accepted", "found_agreement"], index=index)
 
-    for model_index, model_path in enumerate(test_data["models"]):
-        print(f"model_index: {model_index}")
-        agent_type = model_path.split("/")[1].split("_")[0]
-
-        episodes = 0
-        iteration = 0
-        log_metrics = defaultdict(lambda: defaultdict(lambda: .0))
-        # TRY NOT TO MODIFY: start the game
-        while episodes < args.episodes:
-            if test_data["scenario"].startswith("environment/scenarios/random_tmp") or iteration == 0:
-                if test_data["scenario"].startswith("environment/scenarios/random_tmp"):
-                    scenario = Scenario.create_random([200, 1000], scenario_rng, 5, True)
-                    scenario.to_directory(Path(test_data["scenario"]))
-                
-                if envs:
-                    envs.close()
-            
-                env_config = {
-                    "agents": [f"RL_{agent_type}", args.opponent],
-                    "used_agents": used_agents,
-                    "scenario": test_data["scenario"],
-                    "deadline": {"rounds": args.deadline, "ms": 10000},
-                    "random_agent_order": args.random_agent_order,
-                }
-                envs = concat_envs(env_config, args.num_envs, num_cpus=args.num_envs)
-                agent: GNN = Policies[agent_type].value(envs, args).to(device)
-                agent.load_state_dict(torch.load(model_path, map_location=device))
-                agent.train(False)
-                agent.action_nvec = tuple(envs.single_action_space.nvec)
-
-                next_obs, _ = envs.reset(seed=args.seed + iteration)
-                next_obs = TensorDict(next_obs, batch_size=(args.num_envs,), device=device)
-
-            episodes_on_this_scenario = 0
-            print(episodes)
-            while episodes_on_this_scenario < args.episodes_per_scenario:
-
-                # ALGO LOGIC: action logic
-                with torch.no_grad():
-                    action, _, _, _ = agent.get_action_and_value(next_obs)
-
-                # TRY NOT TO MODIFY: execute the game and log data.
-                next_obs, _, terminations, truncations, infos = envs.step(action.cpu().numpy())
-                next_done_bool = np.logical_or(terminations, truncations)
-                next_obs = TensorDict(next_obs, batch_size=(args.num_envs,), device=device)
-
-                if next_done_bool.any():
-                    for info in infos:
-                        if info:
-                            for agent_id, utility in info["utility_all_agents"].items():
-                                if agent_id != f"RL_{test_data['module']}":
-                                    log_metrics[agent_id]["opp_utility"] += utility
-                                    log_metrics[agent_id]["my_utility"] += info["utility_all_agents"][f"RL_{test_data['module']}"]
-                                    log_metrics[agent_id]["count"] += 1
-                                    log_metrics[agent_id]["rounds_played"] += info["rounds_played"]
-                                    log_metrics[agent_id]["self_accepted"] += info["self_accepted"]
-                                    log_metrics[agent_id]["found_agreement"] += info["found_agreement"]
-                                    episodes += 1
-                                    episodes_on_this_scenario += 1
-            iteration += 1
-
-
-        for opp_id, values in log_metrics.items():
-            result = {k: v / values["count"] for k, v in values.items() if k != "count"}
-            result["count"] = values["count"]
-            data.loc[(model_index, opp_id), result.keys()] = list(result.values())
-
-
-    data.to_csv(results_dir / f"{test_data['name']}.csv")
+    models = test_data["models"]
+    all_episodes = {}
+    with ProcessPoolExecutor(args.model_processes) if args.model_processes > 1 else nullcontext() as pool:
+        if pool is None:
+            finished = ((i, evaluate_model(model_path, used_agents, scenarios, episodes_per_scenario, args)) for i, model_path in enumerate(models))
+        else:
+            futures = {pool.submit(evaluate_model, model_path, used_agents, scenarios, episodes_per_scenario, args): i for i, model_path in enumerate(models)}
+            finished = ((futures[future], future.result()) for future in as_completed(futures))
+
+        for model_index, results in finished:
+            for opponent, episodes in results.items():
+                all_episodes[model_index, opponent] = episodes
+                result = dict(zip(METRICS, episodes.mean(axis=0)))
+                result["count"] = len(episodes)
+                data.loc[(model_index, opponent), result.keys()] = list(result.values())
+            # written after every model, the models that are not finished yet are empty
+            data.to_csv(results_dir / f"{test_data['name']}.csv")
+
+    if args.paired:
+        paired_differences(all_episodes, args.ci_confidence).to_csv(results_dir / f"{test_data['name']}_paired.csv")
     data_plot = pd.read_csv(results_dir / f"{test_data['name']}.csv", index_col=[0, 1])
     plot_results(data_plot, test_data["name"])
 
@@ -1,7 +1,10 @@
+import copy
+import os
 import random
 import time
 from collections import defaultdict
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, fields, replace
 from datetime import datetime
 from enum import Enum
 from functools import partial
@@ -13,27 +16,29 @@ import cloudpickle
 import numpy as np
 import supersuit as ss
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.optim as optim
 import tyro
-from gymnasium.spaces import Box, Discrete, MultiDiscrete
 from numpy.random import default_rng
 from supersuit.vector import MakeCPUAsyncConstructor
 from tensordict import TensorDict
 from torch import Tensor
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
 
 from environment.agents.geniusweb import AGENTS
+from environment.agents.policy.gae import compute_gae
 from environment.agents.policy.PPO import GNN, HigaEtAl
+from environment.autotune import Calibration, TuneConfig, cache_key, iteration_estimate, load_cached, save_cached, staged_search
+from environment.checkpoint import CheckpointManager, rng_state, set_rng_state
+from environment.metrics import LOCAL_SINKS, MetricsLogger, PhaseTimer, WandbSink, profiler
 from environment.negotiation import NegotiationEnvZoo
 from environment.scenario import Scenario
+from environment.scheduler import OpponentScheduler
+from environment.threads import available_cores, plan_layout
+from environment.vector_env import SharedMemoryVecEnv, SupervisedVecEnv
 
-MAP_DTYPE = {
-    "int32": torch.int32,
-    "int64": torch.int64,
-    "float32": torch.float32,
-    "float64": torch.float64,
-    "bool": torch.bool,
-}
+RANDOM_SCENARIOS = "environment/scenarios/random_tmp"
 
 
 class Policies(Enum):
@@ -49,10 +54,18 @@ class Args:
     opponent: Literal["all", "random"] = "random"
     opponent_sets: tuple[Literal["ANL2022","ANL2023","CSE3210","BASIC"], ...] = ("BASIC",)
     scenario: str = "environment/scenarios/fixed_utility"
+    """scenario directory, a path starting with environment/scenarios/random_tmp trains on a new random scenario every iteration"""
+    scenario_archive: str | None = None
+    """directory to archive the generated random scenarios in, they are only kept in memory otherwise"""
     random_agent_order: bool = True
+    balance_opponents: bool = False
+    """place the opponents (random or all) on the env workers by their measured step time, so that the workers are
+    equally fast, keeping the distribution over the opponents (requires multiple envs per worker)"""
 
     # GNN policy settings
     gat_v2: bool = False
+    star_tree_gat: bool = True
+    """use the GAT implementation specialised to the GraphObs tree instead of torch_geometric (ignored for gat_v2)"""
     add_self_loops: bool = True
     hidden_size: int = 256
     heads: int = 4
@@ -72,6 +85,42 @@ class Args:
     """the wandb's project name"""
     wandb_entity: str | None = None
     """the entity (team) of wandb's project"""
+    metrics_dir: str = "runs"
+    """directory to write the metrics to, in a subdirectory per run"""
+    metrics_sinks: tuple[Literal["jsonl", "csv", "tensorboard"], ...] = ("jsonl",)
+    """local backends for the training metrics (wandb is added with --wandb)"""
+    checkpoint_dir: str = "checkpoints"
+    """directory to save the training checkpoints to, in a subdirectory per run"""
+    checkpoint_interval: int = 10
+    """save a checkpoint every N iterations and after the last one (0 to disable)"""
+    checkpoint_keep: int = 3
+    """the number of most recent checkpoints to keep"""
+    resume: str | None = None
+    """checkpoint file, or checkpoint directory of a run (latest checkpoint), to continue training from"""
+    profile: bool = False
+    """record a torch.profiler trace with shapes and memory of a window of iterations (batched env steps in evaluate.py)"""
+    profile_wait: int = 1
+    """the number of iterations before the profiler warms up"""
+    profile_warmup: int = 1
+    """the number of iterations the profiler runs without recording"""
+    profile_active: int = 2
+    """the number of iterations to record"""
+    profile_dir: str = "profiles"
+    """directory to write the TensorBoard traces to"""
+    autotune: bool = False
+    """pick num_workers, num_envs and torch_threads with calibration rollouts (cached per host, policy and opponents)"""
+    autotune_cache: str = "autotune.json"
+    """file with the configurations chosen by autotune, delete an entry to tune again"""
+    autotune_steps: int = 20
+    """the number of steps of every calibration rollout"""
+    autotune_workers: tuple[int, ...] = ()
+    """candidate numbers of env workers (default: powers of two up to the CPU count)"""
+    autotune_envs_per_worker: tuple[int, ...] = (1, 2, 4)
+    """candidate numbers of envs per worker"""
+    autotune_threads: tuple[int, ...] = ()
+    """candidate numbers of learner torch threads (default: powers of two up to the CPU count)"""
+    autotune_max_trials: int = 0
+    """the maximum number of configurations to measure (0: no limit)"""
 
     # Algorithm specific arguments
     total_timesteps: int = 2000000
@@ -80,6 +129,17 @@ class Args:
     """the learning rate of the optimizer"""
     num_envs: int = 30
     """the number of parallel game environments"""
+    num_workers: int = 0
+    """the number of env worker processes (0 for one per env)"""
+    torch_threads: int = 0
+    """the number of torch threads of the learner (0 for the torch default)"""
+    restart_workers: bool = True
+    """restart env workers that crash (e.g. an opponent raises), their episodes are truncated"""
+    worker_timeout: float | None = None
+    """seconds after which an env worker that does not respond to a step is restarted (restart_workers only)"""
+    cpu_layout: Literal["default", "budget", "pinned"] = "default"
+    """default: torch and BLAS thread pools of their own in every process, budget: one thread per env worker and
+    the remaining cores (or torch_threads) for the learner, pinned: budget with the processes pinned to disjoint cores"""
     num_steps: int = 200
     """the number of steps to run in each environment per policy rollout"""
     anneal_lr: bool = True
@@ -106,24 +166,52 @@ class Args:
     """the maximum norm for the gradient clipping"""
     target_kl: float | None = None
     """the target KL divergence threshold"""
+    async_actor: bool = False
+    """collect the next rollout with a copy of the policy while the learner updates on the previous one"""
+    importance_clip: float = 1.0
+    """truncation of the importance weights of the learner over the stale actor policy (async_actor only)"""
 
     # to be filled in runtime
     batch_size: int = 0
-    """the batch size (computed in runtime)"""
+    """the batch size of a rank (computed in runtime)"""
     minibatch_size: int = 0
-    """the mini-batch size (computed in runtime)"""
+    """the mini-batch size of a rank (computed in runtime)"""
     num_iterations: int = 0
     """the number of iterations (computed in runtime)"""
 
 
-def concat_envs(env_config, num_vec_envs, num_cpus=0):
-    def vec_env_args(env, num_envs):
-        def env_fn(worker_id):
-            env_copy = cloudpickle.loads(cloudpickle.dumps(env))
-            env_copy.par_env.worker_id = worker_id
-            return env_copy
-        return [partial(env_fn, i) for i in range(num_envs)], env.observation_space, env.action_space
+def is_random_scenarios(scenario: str) -> bool:
+    return scenario.startswith(RANDOM_SCENARIOS)
+
+
+def random_scenario(scenario_rng, archive_dir: str | None = None, index: int = 0) -> Scenario:
+    # only the objectives, the environments sample utility functions on every reset
+    scenario = Scenario.create_random([200, 1000], scenario_rng, 5, True)
+    if archive_dir is not None:
+        scenario.to_directory(Path(archive_dir, f"{index:06d}"))
+    return scenario
 
+
+def make_env_config(args: Args, scenario) -> dict:
+    used_agents = [a for a in AGENTS if a.startswith(tuple(args.opponent_sets))]
+    return {
+        "agents": [f"RL_{args.policy.name}", args.opponent],
+        "used_agents": used_agents,
+        "scenario": scenario,
+        "deadline": {"rounds": args.deadline, "ms": 10000},
+        "random_agent_order": args.random_agent_order,
+    }
+
+
+def vec_env_args(env, num_envs):
+    def env_fn(worker_id):
+        env_copy = cloudpickle.loads(cloudpickle.dumps(env))
+        env_copy.par_env.worker_id = worker_id
+        return env_copy
+    return [partial(env_fn, i) for i in range(num_envs)], env.observation_space, env.action_space
+
+
+def concat_envs(env_config, num_vec_envs, num_cpus=0):
     env = NegotiationEnvZoo(env_config)
     vec_env = ss.pettingzoo_env_to_vec_env_v1(env)
     num_cpus = min(num_cpus, num_vec_envs)
@@ -135,29 +223,185 @@ def concat_envs(env_config, num_vec_envs, num_cpus=0):
     return vec_env
 
 
-def init_tensors(batch_size, envs, device) -> tuple[TensorDict, Tensor]:
+def shared_memory_envs(
+    env_config, num_vec_envs, num_steps, num_cpus=0, worker_init=None, supervised=False, timeout=None,
+) -> SharedMemoryVecEnv:
+    env = ss.pettingzoo_env_to_vec_env_v1(NegotiationEnvZoo(env_config))
+    if supervised:
+        return SupervisedVecEnv(*vec_env_args(env, num_vec_envs), num_steps, num_cpus, worker_init, timeout=timeout)
+    return SharedMemoryVecEnv(*vec_env_args(env, num_vec_envs), num_steps, num_cpus, worker_init)
+
+
+def init_tensors(batch_size, envs: SharedMemoryVecEnv, device) -> tuple[TensorDict, Tensor, Tensor, Tensor]:
     # ALGO Logic: Storage setup
-    obs = {}
-    for obs_key, obs_space in envs.single_observation_space.items():
-        if isinstance(obs_space, MultiDiscrete):
-            shape = (sum(obs_space.nvec),)
-        elif isinstance(obs_space, Discrete):
-            shape = () #TODO, fix to one hot?
-        elif isinstance(obs_space, Box):
-            shape = obs_space.shape
-        else:
-            raise NotImplementedError
-        obs[obs_key] = torch.zeros(batch_size + shape, dtype=MAP_DTYPE[str(obs_space.dtype)])
-    obs: TensorDict = TensorDict(obs, batch_size=batch_size, device=device)
+    # observations, rewards and dones are written to shared memory by the env workers,
+    # observation and done slot num_steps hold the next observation after the rollout
+    buffer = envs.buffer
+    obs = {k: torch.from_numpy(v) for k, v in buffer.obs.items()}
+    obs: TensorDict = TensorDict(obs, batch_size=(batch_size[0] + 1, batch_size[1]))
+    rewards, dones = torch.from_numpy(buffer.rewards), torch.from_numpy(buffer.dones)
     actions: torch.Tensor = torch.zeros(batch_size + envs.single_action_space.shape).to(device)
 
-    return obs, actions
+    return obs, actions, rewards, dones
+
+@dataclass
+class Rollout:
+    """Storage of one rollout, obs and dones hold an extra slot with the next observation."""
+    obs: TensorDict
+    actions: Tensor
+    logprobs: Tensor
+    values: Tensor
+    rewards: Tensor
+    dones: Tensor
+    action_nvec: tuple[int, ...]
+    policy_version: int
+    """number of learner updates of the policy that collected the rollout"""
+    log_metrics: dict[str, list[float]]
+    """sum and count of every episode metric"""
+    timings: dict[str, float]
+    """seconds spent per phase of the rollout"""
+    worker_failures: dict[str, int]
+    """number of env worker failures per opponent since the start of training"""
+
+    def clone(self) -> "Rollout":
+        """Copy of the storage, which the env workers and the actor overwrite on the next rollout."""
+        tensors = {f.name: getattr(self, f.name) for f in fields(self)}
+        return replace(self, **{k: v.clone() for k, v in tensors.items() if isinstance(v, (Tensor, TensorDict))})
+
+
+def calibration_rollout(args: Args, envs: SharedMemoryVecEnv, agent: GNN, device) -> tuple[float, float, float]:
+    """Seconds of a rollout of args.autotune_steps steps, of its policy inference and of a forward/backward pass over it."""
+    steps = envs.buffer.num_steps
+    obs, actions, _, _ = init_tensors((steps, envs.num_envs), envs, device)
+    agent.action_nvec = tuple(envs.single_action_space.nvec)
+    envs.reset(seed=args.seed)
+    timer = PhaseTimer()
+    for step in range(steps):
+        with timer.phase("inference"), torch.no_grad():
+            action, _, _, _ = agent.get_action_and_value(obs[step].to(device))
+            actions[step] = action
+            action = action.cpu().numpy()
+        with timer.phase("env_step"):
+            envs.step(action, step)
+
+    # minibatches of the size of training, a pass over the batch is the work of an update epoch
+    minibatch_size = max(envs.num_envs * args.num_steps // args.num_minibatches, 1)
+    with timer.phase("update"):
+        b_obs = agent.collate(obs[:steps].reshape(-1).to(device))
+        b_actions = actions.reshape((-1,) + actions.shape[2:]).long()
+        for mb_inds in torch.arange(len(b_actions)).split(minibatch_size):
+            _, logprob, entropy, value = agent.get_action_and_value(b_obs[mb_inds], b_actions[mb_inds])
+            (logprob.mean() + entropy.mean() + value.mean()).backward()
+        agent.zero_grad()
+    timings = timer.summary(prefix="")
+    return timings["inference"] + timings["env_step"], timings["inference"], timings["update"]
+
+
+def autotune(args: Args, device) -> TuneConfig:
+    """The configuration with the highest SPS in calibration rollouts, or the cached one of this host and opponents.
+
+    The (workers, envs per worker) pairs are measured first, each with its own env workers,
+    then the torch thread counts on the envs of the fastest pair. The calibration uses its own
+    scenario generator, so the scenarios of training are the same as without autotune.
+    """
+    key = cache_key(args.policy.name, args.opponent, args.opponent_sets)
+    config = load_cached(args.autotune_cache, key)
+    if config is not None:
+        print(f"autotune: using the cached configuration of {key}: {config}")
+        return config
+
+    scenario = random_scenario(default_rng(args.seed)) if is_random_scenarios(args.scenario) else args.scenario
+    env_config = make_env_config(args, scenario)
+    envs, agent, layout = None, None, None
+
+    def measure(config: TuneConfig) -> Calibration:
+        nonlocal envs, agent, layout
+        # the envs are kept while only the thread count changes
+        if layout != (config.num_workers, config.envs_per_worker):
+            if envs is not None:
+                envs.close()
+            layout = (config.num_workers, config.envs_per_worker)
+            envs = shared_memory_envs(env_config, config.num_envs, args.autotune_steps, num_cpus=config.num_workers)
+            agent = args.policy.value(envs, args).to(device)
+        torch.set_num_threads(config.torch_threads)
+        # the first rollout warms up the workers and thread pools
+        calibration_rollout(args, envs, agent, device)
+        rollout_seconds, inference_seconds, update_seconds = calibration_rollout(args, envs, agent, device)
+        sps, utilization = iteration_estimate(
+            config.num_envs, args.autotune_steps, rollout_seconds, inference_seconds, update_seconds, args.update_epochs,
+        )
+        print(
+            f"autotune: {config.num_workers} workers x {config.envs_per_worker} envs, {config.torch_threads} threads: "
+            f"SPS {sps:.0f}, learner utilization {utilization:.2f}"
+        )
+        return Calibration(config, sps, utilization)
+
+    try:
+        calibrations = staged_search(
+            measure, args.autotune_workers, args.autotune_envs_per_worker, args.autotune_threads,
+            torch.get_num_threads(), args.autotune_max_trials,
+        )
+    finally:
+        if envs is not None:
+            envs.close()
+
+    best = max(calibrations, key=lambda c: c.sps)
+    print(f"autotune: chose {best.config}")
+    save_cached(args.autotune_cache, key, best)
+    return best.config
+
+
+def init_distributed() -> tuple[int, int]:
+    """Join the gloo process group when launched with torchrun, returns the rank and world size."""
+    if "WORLD_SIZE" not in os.environ:
+        return 0, 1
+    dist.init_process_group("gloo")
+    return dist.get_rank(), dist.get_world_size()
+
+
+def all_reduce_gradients(parameters: list[nn.Parameter], world_size: int):
+    """Average the gradients over all ranks with a single all-reduce."""
+    grads = [p.grad if p.grad is not None else torch.zeros_like(p) for p in parameters]
+    flat = _flatten_dense_tensors(grads)
+    dist.all_reduce(flat)
+    flat /= world_size
+    for p, grad in zip(parameters, _unflatten_dense_tensors(flat, grads)):
+        p.grad = grad
+
+
+def gather_log_metrics(log_metrics: dict[str, list[float]], world_size: int) -> dict[str, list[float]]:
+    """Sum the episode metric sums and counts of all ranks."""
+    if world_size == 1:
+        return log_metrics
+    gathered = [None] * world_size
+    dist.all_gather_object(gathered, log_metrics)
+    merged = defaultdict(lambda: [.0, 0])
+    for rank_metrics in gathered:
+        for metric, (value, count) in rank_metrics.items():
+            merged[metric][0] += value
+            merged[metric][1] += count
+    return dict(merged)
+
 
 def main():
     args = tyro.cli(Args)
+    # with torchrun every rank runs num_envs / world size envs and minibatches of
+    # minibatch_size / world size, the gradients of every minibatch are averaged
+    rank, world_size = init_distributed()
+    device = torch.device("cuda:0" if torch.cuda.is_available() and args.cuda else "cpu")
+    if args.autotune:
+        if world_size > 1:
+            raise ValueError("autotune with a single process, then pass the chosen configuration to torchrun")
+        config = autotune(args, device)
+        args.num_workers, args.num_envs, args.torch_threads = config.num_workers, config.num_envs, config.torch_threads
+    if args.torch_threads > 0:
+        torch.set_num_threads(args.torch_threads)
+    if args.num_envs % world_size:
+        raise ValueError(f"num_envs ({args.num_envs}) must be divisible by the number of ranks ({world_size})")
+    args.num_envs //= world_size
     args.batch_size = int(args.num_envs * args.num_steps)
     args.minibatch_size = int(args.batch_size // args.num_minibatches)
-    args.num_iterations = args.total_timesteps // args.batch_size
+    args.num_iterations = args.total_timesteps // (args.batch_size * world_size)
     if args.debug:
         args.num_envs = 2
         args.batch_size = 20
@@ -165,9 +409,17 @@ def main():
         args.num_iterations = 2
         args.update_epochs = 1
 
-    run_name = f"{args.policy.name}_{datetime.now().strftime('%y-%m-%d_%H:%M:%S')}_{uuid4()}"
-
-    if args.wandb:
+    checkpoint = CheckpointManager.load(args.resume, map_location="cpu") if args.resume else None
+    if checkpoint is not None:
+        run_name = checkpoint["run_name"]
+    else:
+        run_name = f"{args.policy.name}_{datetime.now().strftime('%y-%m-%d_%H:%M:%S')}_{uuid4()}"
+    if world_size > 1:
+        run_names = [run_name]
+        dist.broadcast_object_list(run_names, src=0)
+        run_name = run_names[0]
+
+    if args.wandb and rank == 0:
         import wandb
         logger = wandb.init(
             entity="brenting",
@@ -179,135 +431,209 @@ def main():
     
 
     # TRY NOT TO MODIFY: seeding
-    random.seed(args.seed)
-    np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
+    random.seed(args.seed + rank)
+    np.random.seed(args.seed + rank)
+    torch.manual_seed(args.seed + rank)
     torch.backends.cudnn.deterministic = args.torch_deterministic
+    # the same scenarios on every rank
     scenario_rng = default_rng(args.seed)
 
-    device = torch.device("cuda:0" if torch.cuda.is_available() and args.cuda else "cpu")
-
     # env setup
-    used_agents = [a for a in AGENTS if a.startswith(tuple(args.opponent_sets))]
-    env_config = {
-        "agents": [f"RL_{args.policy.name}", args.opponent],
-        "used_agents": used_agents,
-        "scenario": args.scenario,
-        "deadline": {"rounds": args.deadline, "ms": 10000},
-        "random_agent_order": args.random_agent_order,
-    }
-    envs = concat_envs(env_config, args.num_envs, num_cpus=args.num_envs)
+    random_scenarios = is_random_scenarios(args.scenario)
+    env_config = make_env_config(args, random_scenario(scenario_rng, args.scenario_archive, 1) if random_scenarios else args.scenario)
+    num_workers = min(args.num_workers or args.num_envs, args.num_envs)
+    layout = None
+    if args.cpu_layout != "default":
+        # the ranks of torchrun split the cores
+        cores = np.array_split(available_cores(), world_size)[rank]
+        layout = plan_layout(num_workers, args.torch_threads, args.cpu_layout == "pinned", tuple(int(c) for c in cores))
+        print(f"cpu layout: {layout}")
+    envs = shared_memory_envs(
+        env_config, args.num_envs, args.num_steps, num_workers, worker_init=None if layout is None else layout.init_worker,
+        supervised=args.restart_workers, timeout=args.worker_timeout,
+    )
+    if layout is not None:
+        # after starting the workers, which would inherit the affinity of the learner
+        layout.init_learner()
+    scheduler = OpponentScheduler(env_config["used_agents"], envs.env_slices, args.opponent) if args.balance_opponents else None
 
     agent: GNN = args.policy.value(envs, args).to(device)
     optimizer = optim.Adam(agent.parameters(), lr=args.learning_rate, eps=1e-5)
+    if world_size > 1:
+        for tensor in agent.state_dict().values():
+            dist.broadcast(tensor, src=0)
+
+    # continues bit-for-bit for random scenarios without async_actor, with a fixed scenario
+    # the episodes that were in progress are restarted
+    start_iteration, global_step = 1, 0
+    if checkpoint is not None:
+        agent.load_state_dict(checkpoint["agent"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        if len(checkpoint["rng"]) != world_size:
+            raise ValueError(f"The checkpoint was saved with {len(checkpoint['rng'])} ranks, resume with the same number")
+        set_rng_state(checkpoint["rng"][rank], scenario_rng)
+        start_iteration, global_step = checkpoint["iteration"] + 1, checkpoint["global_step"]
+    checkpoints = CheckpointManager(Path(args.checkpoint_dir, run_name), args.checkpoint_interval, args.checkpoint_keep)
 
     batch_size = (args.num_steps, args.num_envs)
     logprobs = torch.zeros(batch_size).to(device)
-    rewards = torch.zeros(batch_size).to(device)
-    dones = torch.zeros(batch_size).to(device)
     values = torch.zeros(batch_size).to(device)
+    obs, actions, rewards, dones = init_tensors(batch_size, envs, device)
+
+    def collect_rollout(iteration: int, policy: GNN, policy_version: int) -> Rollout:
+        nonlocal obs, actions, rewards, dones
+        if scheduler is not None:
+            # applies to the episodes that start in this rollout
+            envs.set_attr("opponent_weights", scheduler.weights())
+        if random_scenarios or iteration == start_iteration:
+            if random_scenarios and iteration > 1:
+                scenario = random_scenario(scenario_rng, args.scenario_archive, iteration)
+                if envs.load_scenario(scenario):
+                    obs, actions, rewards, dones = init_tensors(batch_size, envs, device)
+
+            policy.action_nvec = tuple(envs.single_action_space.nvec)
+            # the envs of all ranks get the seeds of a single process run
+            envs.reset(seed=args.seed + rank * args.num_envs)
+        else:
+            envs.buffer.rollover()
 
-    # TRY NOT TO MODIFY: start the game
-    global_step = 0
-    start_time = time.time()
-
-    for iteration in range(1, args.num_iterations + 1):
-        if args.scenario.startswith("environment/scenarios/random_tmp") or iteration == 1:
-            if args.scenario.startswith("environment/scenarios/random_tmp"):
-                scenario = Scenario.create_random([200, 1000], scenario_rng, 5, True)
-                scenario.to_directory(Path(args.scenario))
-            
-            envs = concat_envs(env_config, args.num_envs, num_cpus=args.num_envs)
-            agent.action_nvec = tuple(envs.single_action_space.nvec)
-            obs, actions = init_tensors(batch_size, envs, device)
-
-            next_obs, _ = envs.reset(seed=args.seed)
-            next_obs = TensorDict(next_obs, batch_size=(args.num_envs,), device=device)
-            next_done = torch.zeros(args.num_envs).to(device)
-
-        # Annealing the rate if instructed to do so.
-        if args.anneal_lr:
-            frac = 1.0 - (iteration - 1.0) / args.num_iterations
-            lrnow = frac * args.learning_rate
-            optimizer.param_groups[0]["lr"] = lrnow
-
-        utility_all_agents = defaultdict(lambda: .0)
-        count_all_agents = defaultdict(lambda: 0)
         log_metrics = defaultdict(lambda: [.0, 0])
+        timer = PhaseTimer()
         for step in range(0, args.num_steps):
-            global_step += args.num_envs
-            obs[step] = next_obs
-            dones[step] = next_done
+            with timer.phase("obs_to_tensordict"):
+                next_obs = obs[step].to(device)
 
             # ALGO LOGIC: action logic
-            with torch.no_grad():
-                action, logprob, _, value = agent.get_action_and_value(next_obs)
+            with timer.phase("inference"), torch.no_grad():
+                action, logprob, _, value = policy.get_action_and_value(next_obs)
                 values[step] = value.flatten()
-            actions[step] = action
-            logprobs[step] = logprob
+                actions[step] = action
+                logprobs[step] = logprob
+                action = action.cpu().numpy()
 
             # TRY NOT TO MODIFY: execute the game and log data.
-            next_obs, reward, terminations, truncations, infos = envs.step(action.cpu().numpy())
-            next_done_bool = np.logical_or(terminations, truncations)
-            rewards[step] = torch.tensor(reward).to(device).view(-1)
-            next_obs, next_done = TensorDict(next_obs, batch_size=(args.num_envs,), device=device), torch.Tensor(next_done_bool).to(device)
+            with timer.phase("env_step"):
+                infos = envs.step(action, step)
+            reward, next_done_bool = envs.buffer.rewards[step], envs.buffer.dones[step + 1].astype(bool)
 
             if next_done_bool.any():
+                if scheduler is not None:
+                    scheduler.update(infos)
+                failed = np.array([bool(info.get("worker_failure")) for info in infos])
                 for info in infos:
-                    if info:
+                    if info and not info.get("worker_failure"):
                         for agent_id, utility in info["utility_all_agents"].items():
-                            utility_all_agents[agent_id] += utility
-                            count_all_agents[agent_id] += 1
+                            log_metrics[f"utility/{agent_id}"][0] += utility
+                            log_metrics[f"utility/{agent_id}"][1] += 1
                         log_metrics["rounds_played"][0] += info["rounds_played"]
                         log_metrics["rounds_played"][1] += 1
                         log_metrics["self_accepted"][0] += info["self_accepted"]
                         log_metrics["self_accepted"][1] += 1
                         log_metrics["found_agreement"][0] += info["found_agreement"]
                         log_metrics["found_agreement"][1] += 1
-                log_metrics["episode_reward_mean"][0] += reward[next_done_bool].sum()
-                log_metrics["episode_reward_mean"][1] += next_done_bool.sum()
-        
-        if args.wandb:
-            for metric, (value, count) in log_metrics.items():
-                logger.log({metric: value / count}, step=global_step)
+                        if "opponent" in info:
+                            log_metrics[f"opponent_seconds/{info['opponent']}"][0] += info["opponent_seconds"]
+                            log_metrics[f"opponent_seconds/{info['opponent']}"][1] += 1
+                # episodes cut off by a worker failure have no reward
+                finished = next_done_bool & ~failed
+                if finished.any():
+                    log_metrics["episode_reward_mean"][0] += reward[finished].sum()
+                    log_metrics["episode_reward_mean"][1] += finished.sum()
+
+        rollout = Rollout(
+            obs, actions, logprobs, values, rewards, dones, policy.action_nvec, policy_version, dict(log_metrics), timer.summary(),
+            dict(getattr(envs, "failures", {})),
+        )
+        # the actor continues with the next rollout while the learner trains on this one
+        return rollout.clone() if args.async_actor else rollout
+
+    # the actor policy lags one update behind the learner, it is only written between updates
+    actor = copy.deepcopy(agent) if args.async_actor else agent
+    executor = ThreadPoolExecutor(max_workers=1) if args.async_actor else None
+
+    # TRY NOT TO MODIFY: start the game
+    start_step = global_step
+    start_time = iteration_time = time.time()
+    timer = PhaseTimer()
+    # only rank 0 logs, the episode metrics of all ranks are gathered
+    sinks = [LOCAL_SINKS[sink](Path(args.metrics_dir, run_name)) for sink in args.metrics_sinks] if rank == 0 else []
+    metrics = MetricsLogger(sinks + ([WandbSink(logger)] if args.wandb and rank == 0 else []))
+    trace_name = run_name if world_size == 1 else f"{run_name}_rank{rank}"
+    trace = profiler(args.profile, args.profile_dir, args.profile_wait, args.profile_warmup, args.profile_active, trace_name)
+    trace.start()
+    rollout = collect_rollout(start_iteration, agent, start_iteration - 1)
+
+    for iteration in range(start_iteration, args.num_iterations + 1):
+        if args.async_actor and iteration < args.num_iterations:
+            actor.load_state_dict(agent.state_dict())
+            next_rollout = executor.submit(collect_rollout, iteration + 1, actor, iteration - 1)
+        global_step += args.batch_size * world_size
+        agent.action_nvec = rollout.action_nvec
+        staleness = iteration - 1 - rollout.policy_version
+
+        # Annealing the rate if instructed to do so.
+        if args.anneal_lr:
+            frac = 1.0 - (iteration - 1.0) / args.num_iterations
+            lrnow = frac * args.learning_rate
+            optimizer.param_groups[0]["lr"] = lrnow
+
+        for metric, (value, count) in gather_log_metrics(rollout.log_metrics, world_size).items():
+            metrics.log({metric: value / count}, global_step)
+            if not metric.startswith(("utility/", "opponent_seconds/")) and rank == 0:
                 print(f"{metric}: {value / count}")
-            for agent_id, utility in utility_all_agents.items():
-                logger.log({f"utility/{agent_id}": utility / count_all_agents[agent_id]}, step=global_step)
+
+        # flatten the batch, the graph structure is collated once for all minibatches
+        with timer.phase("collate"):
+            b_obs = agent.collate(rollout.obs[:args.num_steps].reshape(-1).to(device))
+            b_logprobs = rollout.logprobs.reshape(-1)
+            b_actions = rollout.actions.reshape((-1,) + rollout.actions.shape[2:]).long()
+        rollout_values = rollout.values
+
+        b_importance = None
+        if args.async_actor:
+            # decoupled PPO: clip the ratio to the learner policy before this update and correct
+            # for the stale actor policy with truncated importance weights
+            with timer.phase("importance_weights"), torch.no_grad():
+                prox_logprobs, prox_values = [], []
+                for mb_inds in torch.arange(args.batch_size).split(args.minibatch_size):
+                    _, logprob, _, value = agent.get_action_and_value(b_obs[mb_inds], b_actions[mb_inds])
+                    prox_logprobs.append(logprob)
+                    prox_values.append(value.flatten())
+                prox_logprobs = torch.cat(prox_logprobs)
+                importance = (prox_logprobs - b_logprobs).exp()
+                b_importance = importance.clamp(max=args.importance_clip)
+                b_logprobs = prox_logprobs
+                rollout_values = torch.cat(prox_values).view(batch_size)
 
         # bootstrap value if not done
-        with torch.no_grad():
-            next_value = agent.get_value(next_obs).reshape(1, -1)
-            advantages = torch.zeros_like(rewards).to(device)
-            lastgaelam = 0
-            for t in reversed(range(args.num_steps)):
-                if t == args.num_steps - 1:
-                    nextnonterminal = 1.0 - next_done
-                    nextvalues = next_value
-                else:
-                    nextnonterminal = 1.0 - dones[t + 1]
-                    nextvalues = values[t + 1]
-                delta = rewards[t] + args.gamma * nextvalues * nextnonterminal - values[t]
-                advantages[t] = lastgaelam = delta + args.gamma * args.gae_lambda * nextnonterminal * lastgaelam
-            returns = advantages + values
-
-        # flatten the batch
-        b_obs = obs.reshape(-1)
-        b_logprobs = logprobs.reshape(-1)
-        b_actions = actions.reshape((-1,) + envs.single_action_space.shape)
+        with timer.phase("gae"), torch.no_grad():
+            next_value = agent.get_value(rollout.obs[args.num_steps].to(device)).reshape(1, -1)
+            next_done = rollout.dones[args.num_steps].to(device)
+            advantages, returns = compute_gae(
+                rollout.rewards.to(device), rollout_values, rollout.dones[:args.num_steps].to(device),
+                next_value, next_done, args.gamma, args.gae_lambda,
+            )
+
         b_advantages = advantages.reshape(-1)
         b_returns = returns.reshape(-1)
-        b_values = values.reshape(-1)
+        b_values = rollout_values.reshape(-1)
 
         # Optimizing the policy and value network
         b_inds = np.arange(args.batch_size)
         clipfracs = []
         for epoch in range(args.update_epochs):
-            np.random.shuffle(b_inds)
+            with timer.phase("collate"):
+                np.random.shuffle(b_inds)
+                # a single gather per epoch, the minibatches are contiguous slices of it
+                epoch_inds = torch.from_numpy(b_inds).to(device)
+                epoch_obs, epoch_actions = b_obs[epoch_inds], b_actions[epoch_inds]
+
             for start in range(0, args.batch_size, args.minibatch_size):
                 end = start + args.minibatch_size
                 mb_inds = b_inds[start:end]
 
-                _, newlogprob, entropy, newvalue = agent.get_action_and_value(b_obs[mb_inds], b_actions.long()[mb_inds])
+                forward_start = time.perf_counter()
+                _, newlogprob, entropy, newvalue = agent.get_action_and_value(epoch_obs[start:end], epoch_actions[start:end])
                 logratio = newlogprob - b_logprobs[mb_inds]
                 ratio = logratio.exp()
 
@@ -324,7 +650,10 @@ def main():
                 # Policy loss
                 pg_loss1 = -mb_advantages * ratio
                 pg_loss2 = -mb_advantages * torch.clamp(ratio, 1 - args.clip_coef, 1 + args.clip_coef)
-                pg_loss = torch.max(pg_loss1, pg_loss2).mean() #NOTE: identical
+                pg_loss = torch.max(pg_loss1, pg_loss2) #NOTE: identical
+                if b_importance is not None:
+                    pg_loss = b_importance[mb_inds] * pg_loss
+                pg_loss = pg_loss.mean()
 
                 # Value loss
                 newvalue = newvalue.view(-1)
@@ -347,9 +676,17 @@ def main():
 
                 optimizer.zero_grad()
                 loss.backward()
+                if world_size > 1:
+                    all_reduce_gradients(list(agent.parameters()), world_size)
                 total_norm = nn.utils.clip_grad_norm_(agent.parameters(), args.max_grad_norm)
-                optimizer.step()
-
+                timer.add("forward_backward", time.perf_counter() - forward_start)
+                with timer.phase("optimizer_step"):
+                    optimizer.step()
+
+            if args.target_kl is not None and world_size > 1:
+                # all ranks have to stop at the same epoch
+                dist.all_reduce(approx_kl)
+                approx_kl /= world_size
             if args.target_kl is not None and approx_kl > args.target_kl:
                 break
             
@@ -358,26 +695,84 @@ def main():
         var_y = np.var(y_true)
         explained_var = np.nan if var_y == 0 else 1 - np.var(y_true - y_pred) / var_y
 
+        # the SPS of this iteration, next to the average since the start
+        now = time.time()
+        iteration_sps = int(args.batch_size * world_size / (now - iteration_time))
+        iteration_time = now
         # TRY NOT TO MODIFY: record rewards for plotting purposes
-        if args.wandb:
-            logger.log({"learning_rate": optimizer.param_groups[0]["lr"]}, global_step)
-            logger.log({"losses/unclipped_value": newvalue.detach().mean().cpu().numpy()}, global_step)
-            logger.log({"losses/gradient_norm": total_norm.detach().cpu().numpy()}, global_step)
-            logger.log({"losses/total_loss": loss.item()}, global_step)
-            logger.log({"losses/value_loss": v_loss.item()}, global_step)
-            logger.log({"losses/policy_loss": pg_loss.item()}, global_step)
-            logger.log({"losses/entropy": entropy_loss.item()}, global_step)
-            logger.log({"losses/old_approx_kl": old_approx_kl.item()}, global_step)
-            logger.log({"losses/approx_kl": approx_kl.item()}, global_step)
-            logger.log({"losses/clipfrac": np.mean(clipfracs)}, global_step)
-            logger.log({"losses/explained_variance": explained_var}, global_step)
-            logger.log({"SPS": int(global_step / (time.time() - start_time))}, global_step)
-        print("SPS:", int(global_step / (time.time() - start_time)))
-
-        model_path = f"models/{run_name}"
-        torch.save(agent.state_dict(), model_path)
-
+        # scalar tensors are converted to floats on the writer thread
+        metrics.log({
+            "learning_rate": optimizer.param_groups[0]["lr"],
+            "losses/unclipped_value": newvalue.detach().mean(),
+            "losses/gradient_norm": total_norm.detach(),
+            "losses/total_loss": loss.detach(),
+            "losses/value_loss": v_loss.detach(),
+            "losses/policy_loss": pg_loss.detach(),
+            "losses/entropy": entropy_loss.detach(),
+            "losses/old_approx_kl": old_approx_kl,
+            "losses/approx_kl": approx_kl,
+            "losses/clipfrac": np.mean(clipfracs),
+            "losses/explained_variance": explained_var,
+            "SPS": int((global_step - start_step) / (time.time() - start_time)),
+            "iteration_SPS": iteration_sps,
+            "async/staleness": staleness,
+        }, global_step)
+        metrics.log({f"worker_failures/{opponent}": count for opponent, count in rollout.worker_failures.items()}, global_step)
+        if b_importance is not None:
+            metrics.log({
+                "async/importance_weight": b_importance.mean(),
+                "async/importance_clipfrac": (importance > args.importance_clip).float().mean(),
+            }, global_step)
+        if rank == 0:
+            print("SPS:", int((global_step - start_step) / (time.time() - start_time)))
+            print("iteration SPS:", iteration_sps)
+            if args.async_actor:
+                print("staleness:", staleness)
+
+        if checkpoints.due(iteration, last=iteration == args.num_iterations):
+            with timer.phase("checkpoint"):
+                rng_states = [rng_state(scenario_rng)]
+                if world_size > 1:
+                    rng_states = [None] * world_size
+                    dist.all_gather_object(rng_states, rng_state(scenario_rng))
+                if rank == 0:
+                    checkpoints.save(iteration, {
+                        "run_name": run_name,
+                        "iteration": iteration,
+                        "global_step": global_step,
+                        "agent": agent.state_dict(),
+                        "optimizer": optimizer.state_dict(),
+                        "rng": rng_states,
+                    })
+
+        # the rollout phases overlap with the update with async_actor, rollout_wait is the time
+        # the learner is blocked on the next rollout
+        timings = rollout.timings
+        if iteration < args.num_iterations:
+            with timer.phase("rollout_wait"):
+                rollout = next_rollout.result() if args.async_actor else collect_rollout(iteration + 1, agent, iteration)
+        timings = {**timings, **timer.summary()}
+        timer.reset()
+
+        metrics.log(timings, global_step)
+        metrics.flush()
+        if rank == 0:
+            print("time:", ", ".join(f"{name.removeprefix('time/')} {seconds:.2f}s" for name, seconds in timings.items()))
+        trace.step()
+
+    trace.stop()
+    if executor is not None:
+        executor.shutdown()
+    checkpoints.close()
+    metrics.close()
     envs.close()
+    if world_size > 1:
+        dist.destroy_process_group()
+    if rank > 0:
+        return
+
+    model_path = f"models/{run_name}"
+    torch.save(agent.state_dict(), model_path)
     
     if args.wandb:
         artifact = wandb.Artifact("model", type="model")
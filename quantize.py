@@ -0,0 +1,80 @@
+from dataclasses import dataclass, replace
+from pathlib import Path
+
+import pandas as pd
+import tyro
+
+from environment.agents.geniusweb import AGENTS
+from environment.agents.policy.quantization import load_policy, quantize_policy, save_policy
+from environment.negotiation import NegotiationEnvZoo
+from evaluate import ArgsEval, evaluate
+from ppo import Policies
+
+DEFAULT_MODELS = [
+    *[str(i) for i in sorted(Path("models", "GNN", "basic_opponents_fixed_scenario").iterdir())],
+    *[str(i) for i in sorted(Path("models", "HigaEtAl", "basic_opponents_fixed_scenario").iterdir())],
+]
+
+
+@dataclass
+class ArgsQuantize(ArgsEval):
+    output_dir: str | None = "models_int8"
+    """directory to write the quantized checkpoints to (keeps the models/<policy>/... layout), None to skip"""
+    report: bool = True
+    """compare the quantized against the float policies on the scenario and opponent sets"""
+
+
+def save_quantized(model_path: str, args: ArgsQuantize) -> Path:
+    agent_type = model_path.split("/")[1].split("_")[0]
+    env = NegotiationEnvZoo({
+        "agents": [f"RL_{agent_type}", args.opponent],
+        "used_agents": [a for a in AGENTS if a.startswith(tuple(args.opponent_sets))],
+        "scenario": args.scenario,
+        "deadline": {"rounds": args.deadline, "ms": 10000},
+        "random_agent_order": args.random_agent_order,
+    })
+    env.single_action_space = env.action_space(f"RL_{agent_type}")
+    env.single_observation_space = env.observation_space(f"RL_{agent_type}")
+    agent = quantize_policy(load_policy(Policies[agent_type].value(env, args), model_path))
+
+    output_path = Path(args.output_dir, *Path(model_path).parts[1:])
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    save_policy(agent, output_path)
+    return output_path
+
+
+def main():
+    args = tyro.cli(ArgsQuantize)
+    model_paths = args.model_paths or DEFAULT_MODELS
+
+    if args.output_dir is not None:
+        for model_path in model_paths:
+            print(f"saved {save_quantized(model_path, args)}")
+
+    if not args.report:
+        return
+
+    used_agents = sorted(a for a in AGENTS if a.startswith(tuple(args.opponent_sets)))
+    rows = {(i, opponent): {"model": model_path, "opponent": opponent} for i, model_path in enumerate(model_paths) for opponent in used_agents}
+    for quantize in (False, True):
+        suffix = "int8" if quantize else "float"
+        for pair, metrics in evaluate(list(model_paths), used_agents, replace(args, quantize=quantize)).items():
+            rows[pair].update({f"{k}_{suffix}": v for k, v in metrics.items()})
+    rows = list(rows.values())
+
+    data = pd.DataFrame(rows).set_index(["model", "opponent"])
+    for metric in ("found_agreement", "my_utility", "opp_utility"):
+        data[f"{metric}_diff"] = data[f"{metric}_int8"] - data[f"{metric}_float"]
+
+    results_dir = Path("analysis", "data")
+    results_dir.mkdir(parents=True, exist_ok=True)
+    data.to_csv(results_dir / "quantization_report.csv")
+
+    summary = data.groupby(lambda index: index[0].split("/")[1])[[
+        "found_agreement_float", "found_agreement_int8", "my_utility_float", "my_utility_int8", "opp_utility_float", "opp_utility_int8",
+    ]].mean()
+    print(summary.to_string())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Helpers shared by the test modules: small policy inputs and a counting env for the vectorized envs."""
+from collections import deque
+from types import SimpleNamespace
+
+import numpy as np
+import supersuit as ss
+import torch
+from gymnasium.spaces import Box, Dict, Discrete, MultiDiscrete
+from numpy.random import default_rng
+from pettingzoo import ParallelEnv
+from tensordict import TensorDict
+
+from environment.agents.rl_agent import GraphObs
+from environment.deadline import Deadline
+from environment.scenario import Scenario
+
+
+def gnn_args(**kwargs):
+    args = dict(hidden_size=256, heads=4, gnn_layers=4, out_layers=1, gat_v2=False, add_self_loops=True, star_tree_gat=True)
+    args.update(kwargs)
+    return SimpleNamespace(**args)
+
+
+def graph_obs_batch(batch_size, seed=0, scenario=None):
+    rng = default_rng(seed)
+    if scenario is None:
+        scenario = Scenario.create_random(400, rng)
+    agent = GraphObs("RL_GNN", scenario.utility_functions[0], 1)
+    nvec = [len(v) for v in scenario.objectives.values()]
+    deadline = Deadline(rounds=batch_size + 3)
+    last_actions = deque(maxlen=2)
+
+    observations = []
+    for _ in range(batch_size):
+        observations.append(agent.get_observation(last_actions, deadline, 0))
+        last_actions.append({"agent_id": "opponent", "outcome": rng.integers(0, nvec), "accept": 0})
+        deadline.advance_round()
+
+    batch = {k: torch.from_numpy(np.stack([o[k] for o in observations])) for k in observations[0] if k != "opponent_encoding"}
+    return TensorDict(batch, batch_size=batch_size), tuple([2] + nvec)
+
+
+NUM_STEPS = 12
+
+
+class CountingEnv(ParallelEnv):
+    """Single agent env with episodes of a seed dependent length."""
+    metadata = {"name": "counting_env"}
+
+    def __init__(self, scenario=3):
+        self.possible_agents = ["RL_test"]
+        self.render_mode = None
+        self.scenario = scenario
+
+    def load_scenario(self, scenario):
+        self.scenario = scenario
+
+    def observation_space(self, agent):
+        return Dict({
+            "features": Box(0, np.inf, shape=(self.scenario, 2), dtype=np.float32),
+            "mask": Box(0, 1, shape=(2,), dtype=bool),
+            "encoding": Discrete(4),
+        })
+
+    def action_space(self, agent):
+        return MultiDiscrete([2] * (self.scenario - 1), dtype=np.int64)
+
+    def obs(self):
+        features = np.full((self.scenario, 2), self.t, dtype=np.float32) + self.offset
+        return {"features": features, "mask": np.array([self.t % 2 == 0, True]), "encoding": self.t % 4}
+
+    def reset(self, seed=None, options=None):
+        self.rng = getattr(self, "rng", np.random.default_rng(seed))
+        self.agents = self.possible_agents
+        self.t, self.length, self.offset = 0, self.rng.integers(1, 5), self.rng.random()
+        return {"RL_test": self.obs()}, {"RL_test": {}}
+
+    def step(self, actions):
+        self.t += 1
+        done = self.t >= self.length
+        reward = float(actions["RL_test"].sum()) + self.offset
+        info = {"length": self.t} if done else {}
+        return {"RL_test": self.obs()}, {"RL_test": reward}, {"RL_test": done}, {"RL_test": False}, {"RL_test": info}
+
+
+def env_fn():
+    return ss.pettingzoo_env_to_vec_env_v1(CountingEnv())
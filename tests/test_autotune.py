@@ -0,0 +1,48 @@
+import pytest
+
+from environment.autotune import (
+    Calibration, TuneConfig, cache_key, iteration_estimate, load_cached, powers_of_two, save_cached, staged_search,
+)
+
+
+def test_staged_search():
+    assert powers_of_two(1) == (1,)
+    assert powers_of_two(6) == (1, 2, 4, 6)
+    assert powers_of_two(8) == (1, 2, 4, 8)
+
+    def measure(config: TuneConfig) -> Calibration:
+        # fastest with 2 workers x 2 envs and 4 threads
+        sps = 100 - abs(config.num_workers - 2) - abs(config.envs_per_worker - 2) - abs(config.torch_threads - 4)
+        return Calibration(config, sps, 0.5)
+
+    calibrations = staged_search(measure, envs_per_worker=(1, 2, 4), default_threads=2, cpu_count=64)
+    configs = [c.config for c in calibrations]
+    # 7 x 3 pairs with 2 threads, then 6 more thread counts instead of the 7 x 3 x 7 grid
+    assert len(configs) == 21 + 6
+    assert all(c.torch_threads == 2 for c in configs[:21])
+    assert configs[21:] == [TuneConfig(2, 2, t) for t in (1, 4, 8, 16, 32, 64)]
+    assert max(calibrations, key=lambda c: c.sps).config == TuneConfig(2, 2, 4)
+
+    assert len(staged_search(measure, envs_per_worker=(1, 2), default_threads=3, max_trials=5, cpu_count=8)) == 5
+    assert [c.config for c in staged_search(measure, (3,), (2,), (1,))] == [TuneConfig(3, 2, 1)]
+
+
+def test_iteration_estimate():
+    # 4 envs x 10 steps in 1s of rollout (0.25s inference) and 2 epochs of 0.5s
+    sps, utilization = iteration_estimate(4, 10, 1.0, 0.25, 0.5, 2)
+    assert sps == pytest.approx(20)
+    assert utilization == pytest.approx(0.625)
+
+
+def test_cache(tmp_path):
+    path = tmp_path / "autotune.json"
+    key = cache_key("GNN", "random", ("BASIC", "ANL2022"), host="host")
+    assert key == cache_key("GNN", "random", ("ANL2022", "BASIC"), host="host")
+    assert key != cache_key("GNN", "random", ("ANL2022", "BASIC"), host="other")
+    assert load_cached(path, key) is None
+
+    save_cached(path, key, Calibration(TuneConfig(4, 2, 1), 100.0, 0.5))
+    other = cache_key("GNN", "all", ("BASIC",), host="host")
+    save_cached(path, other, Calibration(TuneConfig(1, 1, 2), 50.0, 0.9))
+    assert load_cached(path, key) == TuneConfig(4, 2, 1)
+    assert load_cached(path, other) == TuneConfig(1, 1, 2)
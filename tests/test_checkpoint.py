@@ -0,0 +1,50 @@
+import random
+
+import numpy as np
+import torch
+from numpy.random import default_rng
+
+from environment.checkpoint import CheckpointManager, rng_state, set_rng_state
+
+
+def test_retention_and_load(tmp_path):
+    checkpoints = CheckpointManager(tmp_path, interval=2, keep_last=2)
+    assert [i for i in range(1, 8) if checkpoints.due(i, last=i == 7)] == [2, 4, 6, 7]
+    for iteration in (2, 4, 6, 7):
+        checkpoints.save(iteration, {"iteration": iteration})
+    checkpoints.close()
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["checkpoint_000006.pt", "checkpoint_000007.pt"]
+    assert CheckpointManager.load(tmp_path)["iteration"] == 7
+    assert CheckpointManager.load(tmp_path / "checkpoint_000006.pt")["iteration"] == 6
+
+
+def test_state_is_copied(tmp_path):
+    model = torch.nn.Linear(3, 2)
+    optimizer = torch.optim.Adam(model.parameters())
+    model(torch.ones(1, 3)).sum().backward()
+    optimizer.step()
+
+    checkpoints = CheckpointManager(tmp_path, interval=1)
+    expected = {k: v.clone() for k, v in model.state_dict().items()}
+    checkpoints.save(1, {"agent": model.state_dict(), "optimizer": optimizer.state_dict()})
+    # training continues while the checkpoint is written
+    with torch.no_grad():
+        model.weight.add_(1)
+    optimizer.step()
+    checkpoints.close()
+
+    state = CheckpointManager.load(tmp_path)
+    for key, value in expected.items():
+        torch.testing.assert_close(state["agent"][key], value)
+    assert state["optimizer"]["state"][0]["step"] == 1
+
+
+def test_rng_state():
+    scenario_rng = default_rng(1)
+    state = rng_state(scenario_rng)
+    draws = (random.random(), np.random.rand(), torch.rand(1).item(), scenario_rng.random())
+
+    scenario_rng = default_rng(2)
+    set_rng_state(state, scenario_rng)
+    assert draws == (random.random(), np.random.rand(), torch.rand(1).item(), scenario_rng.random())
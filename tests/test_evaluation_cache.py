@@ -0,0 +1,44 @@
+import shutil
+
+from numpy.random import default_rng
+
+from environment.evaluation_cache import EvaluationCache, file_hash, scenario_hash
+from environment.scenario import Scenario
+
+
+def test_scenario_hash(tmp_path):
+    scenario = Scenario.create_random(400, default_rng(0), no_utility_functions=True)
+    assert scenario_hash(scenario) == scenario_hash(Scenario.create_random(400, default_rng(0), no_utility_functions=True))
+    assert scenario_hash(scenario) != scenario_hash(Scenario.create_random(400, default_rng(1), no_utility_functions=True))
+    assert scenario_hash(scenario) != scenario_hash(scenario.sample_utility_functions(default_rng(0)))
+
+    # a directory by its content, not its path
+    shutil.copytree("environment/scenarios/fixed_utility", tmp_path / "copy")
+    assert scenario_hash("environment/scenarios/fixed_utility") == scenario_hash(tmp_path / "copy")
+    (tmp_path / "copy" / "utility_function_A.json").write_text("{}")
+    assert scenario_hash("environment/scenarios/fixed_utility") != scenario_hash(tmp_path / "copy")
+
+
+def test_cache(tmp_path):
+    model = tmp_path / "model"
+    model.write_bytes(b"weights")
+    config = {"deadline": {"rounds": 40, "ms": 10000}, "random_agent_order": False}
+    keys = [EvaluationCache.key(file_hash(model), "BASIC_a", scenario_hash("random"), config, seed) for seed in range(3)]
+
+    cache = EvaluationCache(tmp_path / "cache" / "evaluation.jsonl")
+    assert cache.get(keys[0]) is None
+    cache.add(keys[0], {"my_utility": 0.5})
+    cache.add(keys[1], {"my_utility": 0.25})
+
+    # the episodes are stored as soon as they are added
+    cache = EvaluationCache(tmp_path / "cache" / "evaluation.jsonl")
+    assert cache.get(keys[0]) == {"my_utility": 0.5} and keys[1] in cache and keys[2] not in cache
+    config_reordered = {"random_agent_order": False, "deadline": {"ms": 10000, "rounds": 40}}
+    assert EvaluationCache.key(file_hash(model), "BASIC_a", scenario_hash("random"), config_reordered, 1) in cache
+
+    # entries of an earlier version of the episode seeding are not used
+    with open(tmp_path / "cache" / "evaluation.jsonl") as f:
+        lines = f.readlines()
+    with open(tmp_path / "cache" / "evaluation.jsonl", "a") as f:
+        f.write(lines[0].replace(f'"version": {EvaluationCache.VERSION}', '"version": 1').replace('"seed": 0', '"seed": 2'))
+    assert keys[2] not in EvaluationCache(tmp_path / "cache" / "evaluation.jsonl")
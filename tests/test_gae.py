@@ -0,0 +1,40 @@
+import pytest
+import torch
+
+from benchmarks.gae import reference_gae
+from environment.agents.policy.gae import compute_gae
+
+
+def rollout(num_steps, num_envs, done_prob, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    rewards = torch.rand(num_steps, num_envs, generator=generator)
+    values = torch.randn(num_steps, num_envs, generator=generator)
+    dones = (torch.rand(num_steps, num_envs, generator=generator) < done_prob).float()
+    next_value = torch.randn(1, num_envs, generator=generator)
+    next_done = (torch.rand(num_envs, generator=generator) < done_prob).float()
+    return rewards, values, dones, next_value, next_done
+
+
+@pytest.mark.parametrize("gamma,gae_lambda", [(1.0, 0.95), (0.99, 0.95), (1.0, 1.0), (0.9, 0.0)])
+@pytest.mark.parametrize("done_prob", [0.0, 0.05, 0.5, 1.0])
+@pytest.mark.parametrize("num_steps,block_size", [(200, 64), (37, 8), (1, 64), (16, 1)])
+def test_compute_gae_matches_reference(gamma, gae_lambda, done_prob, num_steps, block_size):
+    data = rollout(num_steps, 5, done_prob)
+    advantages, returns = compute_gae(*data, gamma, gae_lambda, block_size=block_size)
+    expected_advantages, expected_returns = reference_gae(*data, gamma, gae_lambda)
+
+    torch.testing.assert_close(advantages, expected_advantages)
+    torch.testing.assert_close(returns, expected_returns)
+
+
+def test_compute_gae_done_boundaries():
+    # episodes of one negotiation step: the advantage is the reward minus the value
+    rewards, values, _, next_value, _ = rollout(10, 3, 0.0)
+    dones, next_done = torch.ones(10, 3), torch.ones(3)
+    advantages, _ = compute_gae(rewards, values, dones, next_value, next_done, 1.0, 0.95)
+    torch.testing.assert_close(advantages, rewards - values)
+
+    # only the last observation starts a new episode, the final value is not bootstrapped
+    dones, next_done = torch.zeros(10, 3), torch.ones(3)
+    advantages, _ = compute_gae(rewards, values, dones, next_value, next_done, 1.0, 1.0)
+    torch.testing.assert_close(advantages, rewards.flip(0).cumsum(0).flip(0) - values)
@@ -0,0 +1,71 @@
+import csv
+import json
+import time
+
+import pytest
+import torch
+
+from environment.agents.policy.PPO import GNN
+from environment.metrics import LOCAL_SINKS, MetricsLogger, PhaseTimer, profiler
+from tests.helpers import gnn_args, graph_obs_batch
+
+
+def test_phase_timer():
+    timer = PhaseTimer()
+    for _ in range(2):
+        with timer.phase("sleep"):
+            time.sleep(0.01)
+    timer.add("other", 1.5)
+
+    summary = timer.summary()
+    assert summary["time/sleep"] >= 0.02
+    assert summary["time/other"] == 1.5
+    timer.reset()
+    assert timer.summary() == {}
+
+
+def test_metrics_logger(tmp_path):
+    metrics = MetricsLogger([LOCAL_SINKS["jsonl"](tmp_path), LOCAL_SINKS["csv"](tmp_path)])
+    metrics.log({"time/gae": 0.5}, step=10)
+    metrics.log({"loss": torch.tensor(2.0)}, step=10)
+    metrics.flush()
+    metrics.log({"time/gae": 0.25}, step=20)
+    metrics.close()
+
+    records = [json.loads(line) for line in (tmp_path / "metrics.jsonl").read_text().splitlines()]
+    assert records == [{"step": 10, "time/gae": 0.5, "loss": 2.0}, {"step": 20, "time/gae": 0.25}]
+    with open(tmp_path / "metrics.csv", newline="") as file:
+        rows = list(csv.reader(file))
+    assert rows == [["step", "metric", "value"], ["10", "time/gae", "0.5"], ["10", "loss", "2.0"], ["20", "time/gae", "0.25"]]
+
+
+def test_metrics_logger_raises_sink_errors():
+    class FailingSink:
+        def write(self, record, step):
+            raise OSError("disk full")
+
+        def close(self):
+            pass
+
+    metrics = MetricsLogger([FailingSink()])
+    metrics.log({"loss": 1.0}, step=1)
+    with pytest.raises(OSError, match="disk full"):
+        metrics.close()
+
+
+def test_profiler_labels(tmp_path):
+    torch.manual_seed(0)
+    batch, nvec = graph_obs_batch(8)
+    agent = GNN(None, gnn_args(gnn_layers=2))
+    agent.action_nvec = nvec
+
+    trace = profiler(True, tmp_path, wait=1, warmup=1, active=1)
+    trace.start()
+    for _ in range(3):
+        agent.get_action_and_value(batch)
+        trace.step()
+    trace.stop()
+
+    events = json.loads(next(tmp_path.glob("*.pt.trace.json")).read_text())["traceEvents"]
+    names = {event.get("name") for event in events}
+    assert {"GNN.encoders", "GNN.graph_batching", "GNN.gnn_layers", "FusedMultiCategorical.sample"} <= names
@@ -0,0 +1,69 @@
+import subprocess
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+from numpy.random import default_rng
+
+pytest.importorskip("onnxruntime")
+
+from environment.agents.policy.onnx_export import export_onnx
+from environment.agents.policy.onnx_runtime import OnnxPolicy
+from environment.agents.policy.PPO import GNN, HigaEtAl
+from environment.agents.rl_agent import HigaEtAl as HigaEtAlObs
+from environment.scenario import Scenario
+from tests.helpers import gnn_args, graph_obs_batch
+
+
+def test_onnx_matches_torch_gnn(tmp_path):
+    model_path = next(Path("models", "GNN", "all_opponents_random_scenarios").iterdir())
+    agent = GNN(None, gnn_args()).eval()
+    agent.load_state_dict(torch.load(model_path, map_location="cpu"))
+    example_batch, _ = graph_obs_batch(4, seed=0)
+    policy = OnnxPolicy(export_onnx(agent, example_batch, tmp_path / "GNN.onnx"))
+    assert policy.policy == "GNN" and policy.greedy
+
+    # dynamic batch size and scenario size
+    for batch_size, seed in [(1, 1), (16, 2), (7, 3)]:
+        batch, agent.action_nvec = graph_obs_batch(batch_size, seed=seed)
+        logits = policy.action_logits({k: v.numpy() for k, v in batch.items()})
+        with torch.no_grad():
+            expected = agent.get_action_logits(batch)
+        torch.testing.assert_close(torch.from_numpy(logits), expected, rtol=1e-4, atol=1e-4)
+
+        action = policy({k: v.numpy() for k, v in batch.items()}, agent.action_nvec)
+        np.testing.assert_array_equal(action, agent.get_action_and_value(batch)[0].numpy())
+
+
+def test_onnx_matches_torch_higa(tmp_path):
+    scenario = Scenario.create_random(400, default_rng(0))
+    utility_function = scenario.utility_functions[0]
+    envs = SimpleNamespace(
+        single_observation_space=HigaEtAlObs.observation_space(utility_function, 1),
+        single_action_space=HigaEtAlObs.action_space(utility_function),
+    )
+    agent = HigaEtAl(envs, None).eval()
+
+    def batch(batch_size):
+        self_bid = torch.rand(batch_size, envs.single_observation_space["self_bid"].shape[0])
+        return {"self_bid": self_bid, "opponent_bid": torch.rand_like(self_bid), "time": torch.rand(batch_size, 1)}
+
+    policy = OnnxPolicy(export_onnx(agent, batch(2), tmp_path / "HigaEtAl.onnx"), seed=0)
+    assert policy.policy == "HigaEtAl" and not policy.greedy
+
+    example = batch(32)
+    logits = policy.action_logits({k: v.numpy() for k, v in example.items()})
+    with torch.no_grad():
+        torch.testing.assert_close(torch.from_numpy(logits), agent.get_action_logits(example), rtol=1e-4, atol=1e-5)
+
+    action = policy({k: v.numpy() for k, v in example.items()}, agent.action_nvec)
+    assert action.shape == (32, len(agent.action_nvec))
+    assert (action < np.array(agent.action_nvec)).all()
+
+
+def test_onnx_runtime_does_not_import_torch():
+    code = "import sys; import environment.agents.policy.onnx_runtime; assert 'torch' not in sys.modules"
+    subprocess.run([sys.executable, "-c", code], check=True, cwd=Path(__file__).parents[1])
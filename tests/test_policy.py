@@ -0,0 +1,210 @@
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+import torch
+from numpy.random import default_rng
+from torch_geometric.data import Batch, Data
+
+from environment.agents.policy.PPO import (
+    GNN,
+    FusedMultiCategorical,
+    HigaEtAl,
+    MultiCategorical,
+    export_inference_policy,
+    select_action,
+)
+from environment.agents.policy.quantization import is_quantized_policy, load_policy, quantize_policy, save_policy
+from environment.agents.policy.star_tree_gat import StarTreeGAT
+from environment.agents.rl_agent import HigaEtAl as HigaEtAlObs
+from environment.scenario import Scenario
+from tests.helpers import gnn_args, graph_obs_batch
+
+NVECS = [(2, 3), (2, 5, 4, 6), (2, 2, 9, 3, 7, 5, 2, 8)]
+
+
+def random_logits(nvec, batch_size=64):
+    logits = torch.randn(batch_size, sum(nvec)) * 3
+    # mask the accept action like the GNN policy does on the first turn
+    logits[::2, 1] += torch.finfo(torch.float32).min
+    return logits
+
+
+@pytest.mark.parametrize("nvec", NVECS)
+def test_fused_matches_reference(nvec):
+    logits = random_logits(nvec)
+    reference = MultiCategorical(logits, nvec)
+    fused = FusedMultiCategorical(logits, nvec)
+
+    action = reference.sample()
+    assert torch.equal(fused.mode(), reference.mode())
+    torch.testing.assert_close(fused.log_prob(action), reference.log_prob(action))
+    torch.testing.assert_close(fused.entropy(), reference.entropy())
+
+    other_logits = random_logits(nvec)
+    torch.testing.assert_close(
+        fused.kl(FusedMultiCategorical(other_logits, nvec)),
+        reference.kl(MultiCategorical(other_logits, nvec)),
+    )
+
+
+@pytest.mark.parametrize("nvec", NVECS)
+def test_fused_gradients(nvec):
+    logits = random_logits(nvec).requires_grad_()
+    action = MultiCategorical(logits, nvec).sample()
+
+    reference = MultiCategorical(logits, nvec)
+    grad_ref = torch.autograd.grad((reference.log_prob(action) + reference.entropy()).sum(), logits)[0]
+    fused = FusedMultiCategorical(logits, nvec)
+    grad_fused = torch.autograd.grad((fused.log_prob(action) + fused.entropy()).sum(), logits)[0]
+
+    torch.testing.assert_close(grad_fused, grad_ref)
+
+
+def test_fused_sample_distribution():
+    torch.manual_seed(0)
+    nvec = (2, 3, 5)
+    logits = random_logits(nvec, batch_size=1).expand(20000, -1)
+    samples = FusedMultiCategorical(logits, nvec).sample()
+
+    assert samples.shape == (20000, len(nvec))
+    assert (samples[:, 0] == 0).all()  # masked accept action is never sampled
+    assert (samples < torch.tensor(nvec)).all()
+
+    probs = MultiCategorical(logits[:1], nvec).cats
+    for i, cat in enumerate(probs):
+        frequencies = torch.bincount(samples[:, i], minlength=nvec[i]) / len(samples)
+        torch.testing.assert_close(frequencies, cat.probs[0], atol=0.02, rtol=0)
+
+
+@pytest.mark.parametrize("add_self_loops", [True, False])
+def test_star_tree_gat_matches_pyg(add_self_loops):
+    torch.manual_seed(0)
+    batch, nvec = graph_obs_batch(16)
+    pyg = GNN(None, gnn_args(star_tree_gat=False, add_self_loops=add_self_loops, gnn_layers=3, out_layers=2))
+    star_tree = GNN(None, gnn_args(add_self_loops=add_self_loops, gnn_layers=3, out_layers=2))
+    assert isinstance(star_tree.gnn_layers, StarTreeGAT)
+    star_tree.load_state_dict(pyg.state_dict())
+
+    for outputs, expected in zip(star_tree.forward_graph(batch), pyg.forward_graph(batch)):
+        torch.testing.assert_close(outputs, expected, rtol=1e-4, atol=1e-5)
+
+    pyg.action_nvec = star_tree.action_nvec = nvec
+    action = pyg.get_action_and_value(batch)[0]
+    _, logprob, entropy, value = star_tree.get_action_and_value(batch, action)
+    _, logprob_pyg, entropy_pyg, value_pyg = pyg.get_action_and_value(batch, action)
+    torch.testing.assert_close(logprob, logprob_pyg, rtol=1e-4, atol=1e-5)
+    torch.testing.assert_close(entropy, entropy_pyg, rtol=1e-4, atol=1e-5)
+    torch.testing.assert_close(value, value_pyg, rtol=1e-4, atol=1e-5)
+
+    grads = torch.autograd.grad((logprob + entropy + value.squeeze(-1)).sum(), star_tree.parameters())
+    grads_pyg = torch.autograd.grad((logprob_pyg + entropy_pyg + value_pyg.squeeze(-1)).sum(), pyg.parameters())
+    for grad, grad_pyg in zip(grads, grads_pyg):
+        torch.testing.assert_close(grad, grad_pyg, rtol=1e-3, atol=1e-5)
+
+
+def test_batch_edge_index_matches_pyg():
+    batch, _ = graph_obs_batch(6)
+    num_nodes = 1 + batch["objective_nodes"].shape[1] + batch["value_nodes"].shape[1]
+    graph_batch = Batch.from_data_list([Data(num_nodes=num_nodes, edge_index=e) for e in batch["edge_indices"]])
+    assert torch.equal(GNN.batch_edge_index(batch["edge_indices"], num_nodes), graph_batch.edge_index)
+
+
+@pytest.mark.parametrize("star_tree_gat", [True, False])
+def test_collate(star_tree_gat):
+    torch.manual_seed(0)
+    batch, nvec = graph_obs_batch(16)
+    agent = GNN(None, gnn_args(star_tree_gat=star_tree_gat, gnn_layers=2))
+    agent.action_nvec = nvec
+    collated = agent.collate(batch.clone())
+
+    inds = torch.randperm(16)[:8]
+    action = agent.get_action_and_value(batch)[0]
+    for outputs, expected in zip(agent.get_action_and_value(collated[inds], action[inds]), agent.get_action_and_value(batch[inds], action[inds])):
+        torch.testing.assert_close(outputs, expected)
+
+
+def test_star_tree_gat_loads_checkpoint():
+    model_path = next(Path("models", "GNN", "all_opponents_fixed_scenario").iterdir())
+    state_dict = torch.load(model_path, map_location="cpu")
+    batch, _ = graph_obs_batch(8)
+
+    pyg = GNN(None, gnn_args(star_tree_gat=False))
+    star_tree = GNN(None, gnn_args())
+    pyg.load_state_dict(state_dict)
+    star_tree.load_state_dict(state_dict)
+
+    for outputs, expected in zip(star_tree.forward_graph(batch), pyg.forward_graph(batch)):
+        torch.testing.assert_close(outputs, expected, rtol=1e-4, atol=1e-4)
+
+
+def test_select_action_matches_mode():
+    nvec = (2, 3, 5, 4)
+    logits = random_logits(nvec)
+    action = select_action(logits, torch.tensor(nvec), greedy=True)
+    assert torch.equal(action, MultiCategorical(logits, nvec).mode())
+
+    torch.manual_seed(0)
+    samples = select_action(logits[:1].expand(20000, -1), torch.tensor(nvec), greedy=False)
+    for i, cat in enumerate(MultiCategorical(logits[:1], nvec).cats):
+        frequencies = torch.bincount(samples[:, i], minlength=nvec[i]) / len(samples)
+        torch.testing.assert_close(frequencies, cat.probs[0], atol=0.02, rtol=0)
+
+
+def test_export_inference_policy():
+    model_path = next(Path("models", "GNN", "all_opponents_random_scenarios").iterdir())
+    agent = GNN(None, gnn_args()).eval()
+    agent.load_state_dict(torch.load(model_path, map_location="cpu"))
+    example_batch, agent.action_nvec = graph_obs_batch(4, seed=0)
+    policy = export_inference_policy(agent, example_batch)
+
+    # the exported policy is not tied to the batch size or the scenario it was traced with
+    for batch_size, seed in [(1, 1), (16, 2)]:
+        batch, agent.action_nvec = graph_obs_batch(batch_size, seed=seed)
+        expected = agent.get_action_and_value(batch)[0]
+        action = policy(dict(batch.items()), torch.tensor(agent.action_nvec))
+        assert torch.equal(action, expected)
+
+
+def test_export_inference_policy_higa():
+    scenario = Scenario.create_random(400, default_rng(0))
+    utility_function = scenario.utility_functions[0]
+    envs = SimpleNamespace(
+        single_observation_space=HigaEtAlObs.observation_space(utility_function, 1),
+        single_action_space=HigaEtAlObs.action_space(utility_function),
+    )
+    agent = HigaEtAl(envs, None).eval()
+    batch = {"self_bid": torch.rand(8, envs.single_observation_space["self_bid"].shape[0]), "time": torch.rand(8, 1)}
+    batch["opponent_bid"] = torch.rand_like(batch["self_bid"])
+
+    greedy = export_inference_policy(agent, batch, greedy=True)
+    probs = MultiCategorical(agent.get_action_logits(batch), agent.action_nvec)
+    assert torch.equal(greedy(batch, torch.tensor(agent.action_nvec)), probs.mode())
+
+    sampled = export_inference_policy(agent, batch)
+    action = sampled(batch, torch.tensor(agent.action_nvec))
+    assert action.shape == (8, len(agent.action_nvec))
+    assert (action < torch.tensor(agent.action_nvec)).all()
+
+
+def test_quantized_policy(tmp_path):
+    model_path = next(Path("models", "GNN", "basic_opponents_fixed_scenario").iterdir())
+    agent = load_policy(GNN(None, gnn_args()), model_path).eval()
+    quantized = quantize_policy(agent)
+    assert is_quantized_policy(quantized) and not is_quantized_policy(agent)
+
+    scenario = Scenario.from_directory(Path("environment", "scenarios", "fixed_utility"))
+    batch, agent.action_nvec = graph_obs_batch(37, scenario=scenario)
+    quantized.action_nvec = agent.action_nvec
+    agreement = quantized.get_action_and_value(batch)[0] == agent.get_action_and_value(batch)[0]
+    assert agreement.float().mean() > 0.9
+
+    # quantized checkpoints are loaded directly
+    save_policy(quantized, tmp_path / "model")
+    loaded = load_policy(GNN(None, gnn_args()), tmp_path / "model")
+    assert is_quantized_policy(loaded)
+    torch.testing.assert_close(loaded.get_action_logits(batch), quantized.get_action_logits(batch))
+
+    loaded.eval().action_nvec = agent.action_nvec
+    policy = export_inference_policy(loaded, batch)
+    assert torch.equal(policy(dict(batch.items()), torch.tensor(agent.action_nvec)), loaded.get_action_and_value(batch)[0])
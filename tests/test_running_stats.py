@@ -0,0 +1,15 @@
+import numpy as np
+
+from environment.running_stats import RunningStats
+
+
+def test_running_stats():
+    values = np.random.default_rng(0).normal(0.5, 0.2, 100)
+    stats = RunningStats()
+    assert stats.half_width() == float("inf")
+    for batch in np.split(values, [1, 20, 21, 60]):
+        stats.update(batch)
+    assert stats.count == 100
+    np.testing.assert_allclose(stats.mean, values.mean())
+    np.testing.assert_allclose(stats.variance, values.var(ddof=1))
+    np.testing.assert_allclose(stats.half_width(0.99), 2.5758 * values.std(ddof=1) / 10, rtol=1e-4)
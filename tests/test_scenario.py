@@ -1,3 +1,4 @@
+import pickle
 from pathlib import Path
 import shutil
 
@@ -40,3 +41,14 @@ def test_save_and_load():
     scenario = Scenario.from_directory(Path("tests/test_scenarios/objectives"))
     utility_after = scenario.get_utilities(bid)
     assert utility_before != utility_after
+
+
+def test_pickle():
+    scenario = Scenario.create_random([200, 1000], default_rng(0), 5, True)
+    restored = pickle.loads(pickle.dumps(scenario))
+    assert list(restored.iter_outcomes()) == list(scenario.iter_outcomes())
+
+    # objectives only scenarios sample the same utility functions after the round trip
+    bid = next(scenario.iter_outcomes())
+    utilities = scenario.sample_utility_functions(default_rng(1)).get_utilities(bid)
+    assert restored.sample_utility_functions(default_rng(1)).get_utilities(bid) == utilities
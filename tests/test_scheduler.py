@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from environment.scheduler import OpponentScheduler, balanced_assignment, stratified_weights
+
+
+@pytest.mark.parametrize("num_opponents,num_slots", [(4, 2), (3, 2), (2, 5), (7, 3)])
+def test_stratified_weights(num_opponents, num_slots):
+    order = list(np.random.default_rng(0).permutation(num_opponents))
+    weights = stratified_weights(order, num_slots)
+    np.testing.assert_allclose(weights.sum(axis=1), 1)
+    # together the slots sample uniformly
+    np.testing.assert_allclose(weights.mean(axis=0), 1 / num_opponents)
+    # the first slot has the cheapest opponents
+    assert weights[0, order[0]] > 0 and weights[0, order[-1]] == (1 if num_opponents == 1 else 0)
+
+
+def test_balanced_assignment():
+    costs = np.array([4.0, 1.0, 1.0, 2.0])
+    assignment = balanced_assignment([0, 1, 2, 3, 0, 1], costs, [3, 3])
+    assert sorted(o for worker in assignment for o in worker) == [0, 0, 1, 1, 2, 3]
+    assert sorted(sum(costs[worker]) for worker in assignment) == [6, 7]
+    assert [len(worker) for worker in balanced_assignment([0, 0, 0, 1], costs, [1, 3])] == [1, 3]
+
+
+def test_scheduler():
+    opponents = ["fast", "slow", "medium", "fast2"]
+    env_slices = [slice(0, 4), slice(4, 8)]
+    scheduler = OpponentScheduler(opponents, env_slices, "random", smoothing=0.5)
+    # without measurements every worker samples uniformly
+    np.testing.assert_allclose(scheduler.weights()[:4].mean(axis=0), 0.25)
+
+    scheduler.update([{}, {"opponent": "slow", "opponent_seconds": 2.0}, {"opponent": "medium", "opponent_seconds": 1.0}])
+    scheduler.update([{"opponent": "slow", "opponent_seconds": 1.0}, {"opponent": "fast", "opponent_seconds": 0.1}])
+    assert scheduler.costs == {"slow": 1.5, "medium": 1.0, "fast": 0.1}
+    np.testing.assert_allclose(scheduler.cost_array(), [0.1, 1.5, 1.0, (1.5 + 1.0 + 0.1) / 3])
+
+    weights = scheduler.weights()
+    np.testing.assert_allclose(weights.mean(axis=0), 0.25)
+    # every worker has one env per opponent, sorted by cost
+    np.testing.assert_array_equal(weights[:4], weights[4:])
+    assert weights[0, 0] == 1 and weights[3, 1] == 1
+
+    scheduler = OpponentScheduler(opponents[:3], [slice(0, 3), slice(3, 6)], "all")
+    scheduler.update([{"opponent": "slow", "opponent_seconds": 2.0}])
+    weights = scheduler.weights()
+    assert (weights.sum(axis=0) == 2).all()
+    # the two slow envs are on different workers
+    assert weights[:3, 1].sum() == 1 and weights[3:, 1].sum() == 1
+
+    with pytest.raises(ValueError):
+        OpponentScheduler(opponents, env_slices, "BASIC_a")
@@ -0,0 +1,54 @@
+import os
+from pathlib import Path
+
+import pytest
+import torch
+from threadpoolctl import threadpool_info
+
+from environment.threads import THREAD_VARIABLES, limit_threads, plan_layout
+from environment.vector_env import SharedMemoryVecEnv
+from tests.helpers import NUM_STEPS, env_fn
+
+
+def test_plan_layout():
+    cores = tuple(range(8))
+    layout = plan_layout(5, pin=True, cores=cores)
+    assert layout.learner_threads == 3
+    assert layout.learner_cores == (0, 1, 2)
+    assert layout.worker_cores == ((3,), (4,), (5,), (6,), (7,))
+
+    # more workers than cores, round robin over the cores left for the workers
+    layout = plan_layout(4, learner_threads=2, pin=True, cores=(0, 1, 2, 3, 4))
+    assert layout.learner_cores == (0, 1)
+    assert layout.worker_cores == ((2,), (3,), (4,), (2,))
+
+    # a single core is shared
+    layout = plan_layout(3, pin=True, cores=(5,))
+    assert layout.learner_cores == (5,)
+    assert layout.worker_cores == ((5,),) * 3
+
+    layout = plan_layout(3, pin=False, cores=cores)
+    assert layout.learner_threads == 5
+    assert layout.learner_cores == () and layout.worker_cores == ((),) * 3
+
+
+def record_threads(directory: Path, threads: int, index: int):
+    limit_threads(threads)
+    blas_threads = {pool["num_threads"] for pool in threadpool_info()}
+    variables = {os.environ[variable] for variable in THREAD_VARIABLES}
+    Path(directory, str(index)).write_text(f"{torch.get_num_threads()} {max(blas_threads, default=threads)} {' '.join(variables)}")
+
+
+@pytest.mark.parametrize("threads", [1, 2])
+def test_worker_init(tmp_path, threads):
+    env = env_fn()
+    envs = SharedMemoryVecEnv(
+        [env_fn] * 3, env.observation_space, env.action_space, NUM_STEPS, 2,
+        worker_init=lambda index: record_threads(tmp_path, threads, index),
+    )
+    try:
+        envs.reset(seed=1)
+    finally:
+        envs.close()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["0", "1"]
+    assert all(p.read_text() == f"{threads} {threads} {threads}" for p in tmp_path.iterdir())
@@ -0,0 +1,213 @@
+import gc
+import os
+import pickle
+import time
+
+import numpy as np
+import pytest
+import supersuit as ss
+import torch
+from supersuit.vector import ConcatVecEnv
+
+from environment.vector_env import SharedMemoryVecEnv, SharedRolloutBuffer, SupervisedVecEnv
+from tests.helpers import NUM_STEPS, CountingEnv, env_fn
+
+
+@pytest.mark.parametrize("num_envs,num_workers", [(4, 4), (5, 2), (3, 1)])
+def test_shared_memory_vec_env_matches_sequential(num_envs, num_workers):
+    env = env_fn()
+    envs = SharedMemoryVecEnv([env_fn] * num_envs, env.observation_space, env.action_space, NUM_STEPS, num_workers)
+    # the same envs stepped in this process, grouped and seeded like the workers
+    reference = [ConcatVecEnv([env_fn] * (s.stop - s.start)) for s in envs.env_slices]
+    rng = np.random.default_rng(0)
+
+    try:
+        envs.reset(seed=1)
+        obs = [r.reset(seed=1 + s.start)[0] for r, s in zip(reference, envs.env_slices)]
+        for step in range(NUM_STEPS):
+            actions = np.stack([env.action_space.sample() for _ in range(num_envs)])
+            infos = envs.step(actions, step)
+            results = [r.step(actions[s]) for r, s in zip(reference, envs.env_slices)]
+
+            expected_obs = {k: np.concatenate([o[k] for o in obs]) for k in obs[0]}
+            for key, value in expected_obs.items():
+                np.testing.assert_array_equal(envs.buffer.obs[key][step], value)
+            np.testing.assert_array_equal(envs.buffer.rewards[step], np.concatenate([r[1] for r in results]))
+            dones = np.concatenate([np.logical_or(r[2], r[3]) for r in results])
+            np.testing.assert_array_equal(envs.buffer.dones[step + 1], dones)
+            assert [bool(info) for info in infos] == list(dones)
+            obs = [r[0] for r in results]
+
+        # the last observation starts the next rollout
+        last_obs = {k: v[NUM_STEPS].copy() for k, v in envs.buffer.obs.items()}
+        envs.buffer.rollover()
+        for key, value in last_obs.items():
+            np.testing.assert_array_equal(envs.buffer.obs[key][0], value)
+    finally:
+        envs.close()
+
+
+def test_shared_memory_vec_env_reset_seed_per_env():
+    env = env_fn()
+    envs = SharedMemoryVecEnv([env_fn] * 3, env.observation_space, env.action_space, NUM_STEPS, 2)
+    try:
+        seeds = [7, 7, 3]
+        envs.reset(seed=seeds)
+        for i, seed in enumerate(seeds):
+            expected = env_fn().reset(seed=seed)[0]["features"]
+            np.testing.assert_array_equal(envs.buffer.obs["features"][0, i], expected[0])
+    finally:
+        envs.close()
+
+
+def test_shared_rollout_buffer_pickle():
+    buffer = SharedRolloutBuffer(env_fn().observation_space, NUM_STEPS, 2)
+    attached = pickle.loads(pickle.dumps(buffer))
+    attached.rewards[3, 1] = 5.0
+    attached.obs["features"][4] = 1.0
+    assert buffer.rewards[3, 1] == 5.0
+    assert (buffer.obs["features"][4] == 1.0).all()
+    attached.close()
+    buffer.close()
+
+
+def test_shared_rollout_buffer_close_keeps_views():
+    buffer = SharedRolloutBuffer(env_fn().observation_space, NUM_STEPS, 2)
+    rewards = torch.from_numpy(buffer.rewards)
+    memory = buffer._memory["rewards"]
+    rewards[3, 1] = 5.0
+    buffer.close()
+    # a view of the learner stays valid after close, the memory is unmapped with the last view
+    assert rewards[3, 1] == 5.0 and memory.buf is not None
+    del rewards
+    gc.collect()
+    assert memory.buf is None
+
+
+def test_shared_memory_vec_env_load_scenario():
+    env = env_fn()
+    envs = SharedMemoryVecEnv([env_fn] * 3, env.observation_space, env.action_space, NUM_STEPS, 2)
+    try:
+        envs.reset(seed=1)
+        views = envs.buffer.obs["features"]
+
+        # same layout, the buffer is kept
+        buffer = envs.buffer
+        assert not envs.load_scenario(3)
+        assert envs.buffer is buffer
+
+        # new layout, the buffer is reallocated and the workers write into the new one
+        assert envs.load_scenario(5)
+        assert envs.buffer is not buffer
+        assert envs.single_action_space.shape == (4,)
+        envs.reset(seed=1)
+        envs.step(np.stack([envs.single_action_space.sample() for _ in range(3)]), 0)
+        assert envs.buffer.obs["features"].shape == (NUM_STEPS + 1, 3, 5, 2)
+        # t + offset, or the offset of a new episode
+        assert (envs.buffer.obs["features"][1] > 0).all()
+
+        # views of the previous buffer stay valid until they are dropped
+        assert views.shape == (NUM_STEPS + 1, 3, 3, 2) and views.sum() > 0
+    finally:
+        envs.close()
+
+
+class FlakyEnv(CountingEnv):
+    """CountingEnv that fails once in the way set by the fail attribute, while a marker file exists."""
+    opponent = "flaky"
+    fail = None
+
+    def reset(self, seed=None, options=None):
+        if self.fail == ("reset", None):
+            raise ValueError("reset failed")
+        return super().reset(seed, options)
+
+    def step(self, actions):
+        if self.fail is not None and self.fail[1] is not None and os.path.exists(self.fail[1]):
+            os.remove(self.fail[1])
+            if self.fail[0] == "raise":
+                raise ValueError("Action cannot be None")
+            elif self.fail[0] == "exit":
+                os._exit(1)
+            elif self.fail[0] == "hang":
+                time.sleep(60)
+        return super().step(actions)
+
+
+def flaky_env_fn():
+    return ss.pettingzoo_env_to_vec_env_v1(FlakyEnv())
+
+
+@pytest.mark.parametrize("mode,opponent", [("raise", "flaky"), ("exit", "unknown"), ("hang", "unknown")])
+def test_supervised_vec_env_restarts_worker(tmp_path, mode, opponent):
+    env = flaky_env_fn()
+    envs = SupervisedVecEnv([flaky_env_fn] * 4, env.observation_space, env.action_space, NUM_STEPS, 2, timeout=3)
+    marker = tmp_path / "fail"
+    try:
+        envs.reset(seed=1)
+        actions = np.ones((4, 2), dtype=np.int64)
+        envs.step(actions, 0)
+        # only the second env of the second worker fails
+        envs.set_attr("fail", [None, None, None, (mode, str(marker))])
+        marker.touch()
+        first_worker = envs.processes[0]
+        infos = envs.step(actions, 1)
+
+        assert envs.failures == {opponent: 1}
+        assert envs.processes[0] is first_worker
+        assert [bool(info.get("worker_failure")) for info in infos] == [False, False, True, True]
+        np.testing.assert_array_equal(envs.buffer.dones[2, 2:], 1)
+        np.testing.assert_array_equal(envs.buffer.rewards[1, 2:], 0)
+        # the restarted worker starts new episodes and keeps stepping
+        assert (envs.buffer.obs["features"][2, 2:] < 1).all()
+        for step in range(2, NUM_STEPS):
+            envs.step(actions, step)
+        assert envs.failures == {opponent: 1}
+    finally:
+        envs.close()
+
+
+def test_supervised_vec_env_restarts_worker_between_rollouts():
+    env = flaky_env_fn()
+    envs = SupervisedVecEnv([flaky_env_fn] * 4, env.observation_space, env.action_space, NUM_STEPS, 2, timeout=3)
+    try:
+        envs.reset(seed=1)
+        for step in range(NUM_STEPS):
+            envs.step(np.ones((4, 2), dtype=np.int64), step)
+
+        # a worker that died after the rollout is restarted by set_attr, its envs start new episodes
+        envs.processes[1].kill()
+        envs.processes[1].join()
+        envs.set_attr("opponent", ["a", "b", "c", "d"])
+        assert envs.failures == {"unknown": 1} and all(p.is_alive() for p in envs.processes)
+        np.testing.assert_array_equal(envs.buffer.dones[NUM_STEPS, 2:], 1)
+        envs.buffer.rollover()
+        for step in range(NUM_STEPS):
+            envs.step(np.ones((4, 2), dtype=np.int64), step)
+
+        # and by load_scenario, which gets the spaces of the new scenario from the restarted worker
+        envs.processes[0].kill()
+        envs.processes[0].join()
+        assert envs.load_scenario(4)
+        assert envs.failures == {"unknown": 2}
+        assert envs.single_action_space.shape == (3,) and envs.buffer.obs["features"].shape == (NUM_STEPS + 1, 4, 4, 2)
+        envs.reset(seed=1)
+        for step in range(NUM_STEPS):
+            envs.step(np.ones((4, 3), dtype=np.int64), step)
+        assert envs.failures == {"unknown": 2}
+    finally:
+        envs.close()
+
+
+def test_supervised_vec_env_gives_up(tmp_path):
+    env = flaky_env_fn()
+    envs = SupervisedVecEnv([flaky_env_fn] * 2, env.observation_space, env.action_space, NUM_STEPS, 2, max_retries=2)
+    try:
+        envs.reset(seed=1)
+        # the attribute is restored in restarted workers, so they keep failing
+        envs.set_attr("fail", [None, ("reset", None)])
+        with pytest.raises(ValueError, match="reset failed"):
+            envs.reset(seed=1)
+        assert envs.failures == {"flaky": 3}
+    finally:
+        envs.close()